@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+import time
+import threading
+
+
+RELEASES = ["spock", "watson", "sherlock"]
+
+class Dashboard(object):
+    """
+    Data behind the index page: the active release lines and their recent
+    builds, fetched with one KV get and one query and kept until the
+    poller reports a write (``invalidate``) or ``ttl`` runs out.
+    """
+    def __init__(self, db, ttl=60, how_many=5):
+        self.db = db
+        self.ttl = ttl
+        self.how_many = how_many
+        self._lock = threading.Lock()
+        self._projects = None
+        self._expires = 0
+        self._generation = 0
+        self.hits = 0
+        self.refreshes = 0
+
+    def projects(self):
+        with self._lock:
+            if self._projects is not None and time.time() < self._expires:
+                self.hits += 1
+                return self._projects
+            generation = self._generation
+        projects = self._load()
+        with self._lock:
+            # a write reported while loading may not be in what was loaded
+            if generation == self._generation:
+                self._projects = projects
+                self._expires = time.time() + self.ttl
+            self.refreshes += 1
+        return projects
+
+    def invalidate(self):
+        with self._lock:
+            self._projects = None
+            self._generation += 1
+
+    def _load(self):
+        rel_lines = self.db.get_release_lines()
+        lines = []
+        for rl in RELEASES:
+            for pr in rel_lines.get(rl, []):
+                lines.append((rl, pr))
+        builds = self.db.get_recent_builds_multi(list(set(pr['version'] for rl, pr in lines)), self.how_many)
+        projects = []
+        for rl, pr in lines:
+            p = {}
+            p['name'] = pr['name']
+            p['manifest'] = pr['input_manifest_file']
+            p['builds'] = builds.get(pr['version'], [])
+            p['rl'] = rl
+            projects.append(p)
+        return projects
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'refreshes': self.refreshes, 'cached': self._projects is not None}
@@ -114,48 +114,51 @@ class buildDB(object):
         history = latest - how_many;
 
     def get_recent_builds(self, version, how_many=5):
+        return self.get_recent_builds_multi([version], how_many).get(version, [])
+
+    def get_recent_builds_multi(self, versions, how_many=5):
         '''
-        rel_line_info = self.get_release_line_info(release, rel_line)
-        q_substr = ''
-        last_good = "unknown"
-        if rel_line_info:
-            query = self.q_get_latest_good.format(rel_line_info['product_branch'])
-            last_good = self.db.n1ql_query(query).get_single_result()["$1"]
-            q_substr = q_substr + " AND product_branch = '%s'" %rel_line_info['product_branch']
-            if rel_line_info.has_key('start'):
-                q_substr = q_substr + ' AND build_num >= %d' %rel_line_info['start']
-            if rel_line_info.has_key('end'):
-                q_substr = q_substr + ' AND build_num < %d' %rel_line_info['end']
+        The last how_many top level builds of every version, in one query:
+        a UNION ALL of one ORDER BY/LIMIT branch per version, projecting only
+        what the dashboard shows and the commit count, not the commits.
+        Returns a dict of version -> builds, newest first.
         '''
-        q_substr = ''
-        query = self.q_short_history.format(version, q_substr, str(how_many))
-        q2 = N1QLQuery(query)
-        rows = []
+        ret = dict((v, []) for v in versions)
+        if not versions:
+            return ret
+        branch = "SELECT d.* FROM (SELECT version, build_num, timestamp, job_build_num, " \
+                 "ARRAY_LENGTH(incomplete) AS n_incomplete, ARRAY_LENGTH(failed) AS n_failed, " \
+                 "unit_result, sanity_result, qe_sanity IS NOT MISSING AS qe_sanity, " \
+                 "ARRAY_LENGTH(commits) AS num_commits " \
+                 "FROM `build-history` WHERE type = 'top_level_build' AND version = ${0} " \
+                 "ORDER BY build_num DESC LIMIT $how_many) AS d"
+        params = {'how_many': int(how_many)}
+        for i, v in enumerate(versions):
+            params['v{}'.format(i)] = v
+        query = ' UNION ALL '.join(branch.format('v{}'.format(i)) for i in range(len(versions)))
+        q2 = N1QLQuery(query, **params)
+        q2.adhoc = False
         for row in self.db.n1ql_query(q2):
             result = "pass"
-            row = row['build-history']
-            if row['incomplete']:
+            if row.get('n_incomplete'):
                 result = "building"
             else:
-                if row['failed']:
+                if row.get('n_failed'):
                     result = "fail"
-            all_distro = row['failed'] + row['incomplete'] + row['passed']
-            #q2 = N1QLQuery("SELECT distro, url from `build-history` WHERE Meta(`build-history`).id in $a", a=all_distro)
-            #urls = []
-            #for url in self.db.n1ql_query(q2):
-            #    urls.append((url['distro'], url['url']))
-            rows.append({
+            ret[row['version']].append({
                            'build_num': row['build_num'],
                            'version': row['version'],
                            'timestamp': convert_to_human_readable(row['timestamp']),
                            'url': "http://server.jenkins.couchbase.com/job/watson-build/%s" %row['job_build_num'],
                            'result': result,
-                           'unit_result': row.get('unit_result', 'skip'),
-                           'sanity_result': row.get('sanity_result', 'skip'),
-                           'num_commits': len(row['commits']),
-                           'qe_sanity': row.has_key('qe_sanity'),
+                           'unit_result': row.get('unit_result') or 'skip',
+                           'sanity_result': row.get('sanity_result') or 'skip',
+                           'num_commits': row.get('num_commits') or 0,
+                           'qe_sanity': row.get('qe_sanity') is True,
                         })
-        return rows
+        for v in ret:
+            ret[v].sort(key=lambda r: r['build_num'], reverse=True)
+        return ret
 
     def get_long_history(self, release, rel_line=None, how_many=25):
         q_substr = ''
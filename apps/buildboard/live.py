@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+import json
+import time
+import Queue
+import logging
+import threading
+
+
+logger = logging.getLogger()
+
+# what a browser shows of a build; a change in any of these is a delta
+_FIELDS = ('result', 'unit_result', 'sanity_result', 'num_commits', 'qe_sanity', 'timestamp')
+# tells a browser that fell behind to reload, then ends its stream
+_RESET = 'event: reset\ndata: {}\n\n'
+_CLOSE = object()
+
+class LiveFeed(object):
+    """
+    One thread shared by every connected browser: it reloads the dashboard
+    (one query) when the poller reports a write, or every ``interval``
+    seconds, diffs it against what it had and puts the build deltas on the
+    queue of every subscriber.  However many boards are open, Couchbase
+    sees the same load.
+    """
+    def __init__(self, dashboard, interval=30, backlog=100):
+        self.dashboard = dashboard
+        self.interval = interval
+        self.backlog = backlog
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._wake = threading.Event()
+        self._builds = None
+        self.published = 0
+
+    def start(self):
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def changed(self):
+        self._wake.set()
+
+    def subscribe(self):
+        q = Queue.Queue(self.backlog)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("live feed refresh failed: {}".format(e))
+
+    def _snapshot(self):
+        builds = {}
+        for p in self.dashboard.projects():
+            for b in p['builds']:
+                key = '{}-{}'.format(b['version'], b['build_num'])
+                builds[key] = dict((f, b.get(f)) for f in _FIELDS)
+                builds[key].update({'id': key, 'project': p['name'], 'version': b['version'],
+                                    'build_num': b['build_num']})
+        return builds
+
+    def refresh(self):
+        builds = self._snapshot()
+        old = self._builds
+        self._builds = builds
+        if old is None:
+            return
+        for key, b in builds.items():
+            if not old.has_key(key):
+                self.publish('new', b)
+                continue
+            changes = [f for f in _FIELDS if b[f] != old[key][f] and f != 'timestamp']
+            if changes:
+                delta = dict(b)
+                delta['changed'] = changes
+                self.publish('update', delta)
+
+    def publish(self, event, data):
+        msg = 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(msg)
+            except Queue.Full:
+                self._drop(q)
+        self.published += 1
+
+    def _drop(self, q):
+        # a browser that stopped reading: the deltas it missed are gone, so
+        # instead of them it gets a reset (it reloads the page) and its
+        # stream ends
+        self.unsubscribe(q)
+        try:
+            while True:
+                q.get_nowait()
+        except Queue.Empty:
+            pass
+        q.put_nowait(_RESET)
+        q.put_nowait(_CLOSE)
+
+    def stream(self, heartbeat=15):
+        '''
+        The text/event-stream of one browser.
+        '''
+        q = self.subscribe()
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    msg = q.get(timeout=heartbeat)
+                except Queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if msg is _CLOSE:
+                    return
+                yield msg
+        finally:
+            self.unsubscribe(q)
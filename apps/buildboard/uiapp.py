@@ -1,33 +1,68 @@
 #!/usr/bin/python
 
+import os
+import hmac
 import json
 import re
+import urllib
 import urllib2
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, Response, request, render_template, jsonify, stream_with_context
 from db import buildDB
+from dashboard import Dashboard
+from live import LiveFeed
 
 app = Flask(__name__)
 
 BLDHISTORY_BUCKET = 'couchbase://cb-bbdb:8091/build-history'
 bldDB = buildDB(BLDHISTORY_BUCKET)
+dashboard = Dashboard(bldDB)
+live = LiveFeed(dashboard)
+live.start()
 _JIRA_PATTERN = r'(\b[A-Z]+-\d+\b)'
 _REW_PATTERN = r'(http://review.couchbase.org/\d+)'
+_REST_URL = 'http://172.23.123.43:8282'
+_CL_PAGE = 500
+# who may invalidate the dashboard: callers sending this token, or with no
+# token set, callers from these hosts (the pollers)
+_INVALIDATE_TOKEN = os.environ.get('BBDB_INVALIDATE_TOKEN', '')
+_INVALIDATE_HOSTS = os.environ.get('BBDB_INVALIDATE_HOSTS', '127.0.0.1').split(',')
+
+def _from_poller():
+    if _INVALIDATE_TOKEN:
+        return hmac.compare_digest(str(request.headers.get('X-Invalidate-Token', '')), _INVALIDATE_TOKEN)
+    return request.remote_addr in _INVALIDATE_HOSTS
 
 @app.route('/')
 def index():
-    projects = []
-    rel_lines = bldDB.get_release_lines()
-    for rl in ["spock", "watson", "sherlock"]:
-        per_release = rel_lines[rl]
-        for pr in per_release:
-            recent_builds = bldDB.get_recent_builds(pr['version'])
-            p = {}
-            p['name'] = pr['name']
-            p['manifest'] = pr['input_manifest_file']
-            p['builds'] = recent_builds
-            p['rl'] = rl
-            projects.append(p)
-    return render_template('index.html', projects=projects)
+    return render_template('index.html', projects=dashboard.projects())
+
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    # the poller calls this (constants: cache_invalidate_urls) with the
+    # builds it wrote since it last called
+    if not _from_poller():
+        return jsonify({'error': 'not allowed'}), 403
+    builds = (request.get_json(silent=True) or {}).get('builds')
+    if builds is None:
+        builds = [{'ver': request.args.get('ver')}]
+    if not builds or [b for b in builds if not isinstance(b, dict) or not b.get('ver')]:
+        return jsonify({'error': 'ver is required'}), 400
+    dashboard.invalidate()
+    live.changed()
+    return jsonify({'invalidated': 'dashboard'})
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'dashboard': dashboard.stats(),
+                    'live': {'subscribers': live.subscribers(), 'published': live.published}})
+
+@app.route('/events')
+def events():
+    # server-sent build deltas for the index page, see live.LiveFeed
+    res = Response(live.stream(), mimetype='text/event-stream')
+    res.headers['Cache-Control'] = 'no-cache'
+    res.headers['X-Accel-Buffering'] = 'no'
+    return res
 
 @app.route('/changelog')
 def changelog():
@@ -36,46 +71,65 @@ def changelog():
 @app.route('/getchangelog', methods=['GET'])
 def getchangelog():
     ver = request.args.get('rel')
-    fromb = request.args.get('fromb')
-    tob = request.args.get('tob')
-    output = get_cl_from_rest(ver, fromb, tob)
-    return render_template('showchangelog.html', cl=output)
-
-def get_cl_from_rest(ver, fb, tb):
-    sel_from = int(fb)
-    sel_to = int(tb)
-    f = urllib2.urlopen("http://172.23.123.43:8282/changelog?ver={0}&from={1}&to={2}".format(ver, sel_from, sel_to))
-    ret = json.loads(f.read())
-    cl = {}
-    for commit in ret['log']:
-        if not cl.has_key(commit['repo']):
-            cl[commit['repo']] = []
-        cl[commit['repo']].append(commit)
-    return text_output(cl)
+    fromb = request.args.get('fromb', type=int)
+    tob = request.args.get('tob', type=int)
+    if fromb is None or tob is None:
+        return jsonify({'error': 'fromb and tob must be build numbers'}), 400
+    def render():
+        # the page head goes out before the changelog is fetched
+        for chunk in iter_text_output(iter_cl_from_rest(ver, fromb, tob)):
+            yield chunk
+    return Response(stream_with_context(stream_template('showchangelog.html', cl=render())))
+
+def stream_template(name, **context):
+    app.update_template_context(context)
+    t = app.jinja_env.get_template(name)
+    rv = t.stream(context)
+    rv.enable_buffering(5)
+    return rv
+
+def iter_cl_from_rest(ver, fb, tb):
+    # pages through the changelog as NDJSON, a line at a time, grouped by
+    # repo on the server so it can be rendered as it comes
+    after = ''
+    while True:
+        f = urllib2.urlopen("{0}/changelog?ver={1}&from={2}&to={3}&format=ndjson&order=repo&limit={4}&after={5}".format(
+            _REST_URL, ver, fb, tb, _CL_PAGE, urllib.quote(after)))
+        count = 0
+        for line in f:
+            if not line.strip():
+                continue
+            count += 1
+            commit = json.loads(line)
+            after = commit['cursor']
+            yield commit
+        f.close()
+        if count < _CL_PAGE:
+            return
 
 def subs_url(output):
     out1 = re.sub(_JIRA_PATTERN, r'<a href="https://issues.couchbase.com/browse/\1">\1</a>', output)
     out2 = re.sub(_REW_PATTERN, r'<a href="\1">\1</a>', out1)
     return out2
 
-def text_output(cl_dict):
-    ret = ""
-    keys = cl_dict.keys()
-    keys.sort()
-    for k in keys:
-        ret = ret + "CHANGELOG for %s\n\n" %k
-        val = cl_dict[k]
-        for v in val:
-            ret = ret + " * Commit: <a href='%s'>%s</a> " %(v.get('url', ''), v.get('sha', ''))
-            ret = ret + "(in build: %s)\n" %v.get('build_num', '')
-            ret = ret + "   Author: %s\n" %v.get('author', '')['name']
-            message = subs_url(v.get('message', ''))
-            ret = ret + "   %s\n\n\n" %message.replace('\n', '\n   ')
-
-    if not ret:
-        ret = "There was an error or there are no changes between these builds"
-    return ret
+def iter_text_output(commits):
+    # commits come grouped by repo, see iter_cl_from_rest
+    repo = None
+    for v in commits:
+        if repo is None or v['repo'] != repo:
+            repo = v['repo']
+            yield "CHANGELOG for %s\n\n" %repo
+        message = subs_url(v.get('message', ''))
+        yield "".join([
+            " * Commit: <a href='%s'>%s</a> " %(v.get('url', ''), v.get('sha', '')),
+            "(in build: %s)\n" %v.get('build_num', ''),
+            "   Author: %s\n" %v.get('author', {}).get('name', ''),
+            "   %s\n\n\n" %message.replace('\n', '\n   '),
+        ])
 
+    if repo is None:
+        yield "There was an error or there are no changes between these builds"
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=8000)
+    # threaded: every open board holds a connection to /events
+    app.run(debug=True, host='0.0.0.0', port=8000, threaded=True)
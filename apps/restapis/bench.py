@@ -0,0 +1,61 @@
+#!/usr/bin/python
+"""
+Per endpoint latency of a running restapis app:
+
+    python bench.py [base url] [version] [requests per endpoint]
+
+Run it against the app before and after a change and compare the tables.
+"""
+import sys
+import time
+import requests
+
+
+ENDPOINTS = [
+    ('/builds/lastunit', {'ver': '{ver}'}),
+    ('/builds/lastsanity', {'ver': '{ver}'}),
+    ('/builds/lastsanity', {'ver': '{ver}', 'passed': '1'}),
+    ('/builds/lastunitsanity', {'ver': '{ver}'}),
+    ('/builds/lastqe', {'ver': '{ver}'}),
+    ('/builds/totest', {'ver': '{ver}', 'type': 'unit'}),
+    ('/builds/totest', {'ver': '{ver}', 'type': 'sanity'}),
+    ('/builds/info', {'ver': '{ver}', 'bnum': '{bnum}'}),
+    ('/builds/tickets', {'ver': '{ver}', 'bnum': '{bnum}'}),
+    ('/changelog', {'ver': '{ver}', 'from': '{frm}', 'to': '{bnum}'}),
+    ('/builds/hasticket', {'id': 'MB-20000'}),
+]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+def bench(base, ver, count):
+    sess = requests.Session()
+    bnum = sess.get(base + '/builds/lastunit', params={'ver': ver}).json()['build_num']
+    fields = {'ver': ver, 'bnum': bnum, 'frm': max(int(bnum) - 10, 0)}
+    print '{:<24} {:<28} {:>8} {:>8} {:>8} {:>8}'.format('endpoint', 'params', 'mean', 'p50', 'p95', 'max')
+    for path, params in ENDPOINTS:
+        params = dict((k, v.format(**fields)) for k, v in params.items())
+        times = []
+        for i in range(count):
+            start = time.time()
+            res = sess.get(base + path, params=params)
+            times.append((time.time() - start) * 1000)
+            if res.status_code != 200:
+                print '{} returned {}'.format(path, res.status_code)
+                break
+        shown = ','.join('{}={}'.format(k, v) for k, v in sorted(params.items()) if k != 'ver')
+        print '{:<24} {:<28} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+            path, shown, sum(times) / len(times), percentile(times, 50), percentile(times, 95), max(times))
+
+if __name__ == '__main__':
+    base = 'http://localhost:8080'
+    ver = '4.7.0'
+    count = 50
+    if len(sys.argv) > 1:
+        base = sys.argv[1].rstrip('/')
+    if len(sys.argv) > 2:
+        ver = sys.argv[2]
+    if len(sys.argv) > 3:
+        count = int(sys.argv[3])
+    bench(base, ver, count)
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    Thread-safe LRU cache whose entries also expire ``ttl`` seconds after
+    they were put, unless put with ttl=None: those never expire and only
+    go when evicted or invalidated.
+
+    Every entry carries a set of tags; ``invalidate(tag)`` drops all the
+    entries with that tag.
+    """
+    def __init__(self, maxsize=4096, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._tags = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        '''
+        Returns (found, value).
+        '''
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                self._drop(key, entry)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._data[key] = entry
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, value, tags=(), ttl=0):
+        '''
+        ttl=0 takes the cache's default, None never expires.
+        '''
+        if ttl == 0:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._drop(key, old)
+            self._data[key] = (value, expires, tuple(tags))
+            for t in tags:
+                self._tags.setdefault(t, set()).add(key)
+            while len(self._data) > self.maxsize:
+                k, entry = self._data.popitem(last=False)
+                self._drop(k, entry)
+                self.evictions += 1
+
+    def _drop(self, key, entry):
+        for t in entry[2]:
+            keys = self._tags.get(t)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[t]
+
+    def invalidate(self, *tags):
+        dropped = 0
+        with self._lock:
+            for t in tags:
+                for key in list(self._tags.get(t, ())):
+                    entry = self._data.pop(key, None)
+                    if entry is not None:
+                        self._drop(key, entry)
+                        dropped += 1
+            self.invalidations += dropped
+        return dropped
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+            self._tags.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(float(self.hits) / lookups, 3) if lookups else 0,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 import os
+import sys
 import logging
 import time
 from random import shuffle
@@ -11,16 +12,76 @@ from couchbase.bucket import LOCKMODE_WAIT
 from couchbase.exceptions import CouchbaseError, KeyExistsError, NotFoundError
 from couchbase.views.iterator import RowProcessor
 
+# the poller's modules, after this app's own (both have a db module)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from buildsummary import summary_id
+
 
 logger = logging.getLogger()
 
+# GSI indexes the queries below are written against: (bucket, name, definition)
+_INDEXES = [
+    ('build-history', 'idx_builds',
+     "CREATE INDEX `idx_builds` ON `build-history`(type, version, build_num DESC, "
+     "unit, unit_result, sanity_result, qe_sanity, failed, incomplete)"),
+    ('build-history', 'idx_commit_fixes',
+     "CREATE INDEX `idx_commit_fixes` ON `build-history`(DISTINCT ARRAY f FOR f IN fixes END, in_build) "
+     "WHERE type = 'commit'"),
+    ('build-history', 'idx_changefeed',
+     "CREATE INDEX `idx_changefeed` ON `build-history`(META().cas, type)"),
+    ('default', 'idx_vms',
+     "CREATE INDEX `idx_vms` ON `default`(os, state, expires, purpose, ip)"),
+]
+
+# conflicting writers a CAS loop waits out before giving up
+_CAS_RETRIES = 20
+# how often (seconds) a pool that runs short may be rescanned for vms whose
+# reservation expired
+_POOL_RESCAN = 60
+
+def parse_cursor(after):
+    '''
+    Splits a changelog cursor ('<build_num>:<commit id>', see DB.iter_log)
+    into the build number and commit id; ValueError if it isn't one.
+    '''
+    bnum, sep, cid = after.partition(':')
+    if not sep or not cid:
+        raise ValueError("bad changelog cursor {}".format(after))
+    return int(bnum), cid
+
 class DB(object):
-    def __init__(self):
+    def __init__(self, create_indexes=True):
         vm_bucket = 'couchbase://cb-bbdb:8091/default'
         bld_bucket = 'couchbase://cb-bbdb:8091/build-history'
 
         self.vmdb = Bucket(vm_bucket, lockmode=LOCKMODE_WAIT)
         self.blddb = Bucket(bld_bucket, lockmode=LOCKMODE_WAIT)
+        if create_indexes:
+            self.ensure_indexes()
+
+    def _query(self, bucket, statement, *args, **kwargs):
+        '''
+        Runs a parameterized statement as a prepared one: the plan is
+        prepared once per statement text and reused after that, with the
+        values passed as positional ($1, $2, ..) or named ($name) params.
+        '''
+        q = N1QLQuery(statement, *args, **kwargs)
+        q.adhoc = False
+        return bucket.n1ql_query(q)
+
+    def ensure_indexes(self):
+        existing = set()
+        q = N1QLQuery("SELECT name, keyspace_id FROM system:indexes")
+        for row in self.blddb.n1ql_query(q):
+            existing.add((row['keyspace_id'], row['name']))
+        for keyspace, name, statement in _INDEXES:
+            if (keyspace, name) in existing:
+                continue
+            logger.info("creating index {0} on {1}".format(name, keyspace))
+            try:
+                self.blddb.n1ql_query(N1QLQuery(statement)).execute()
+            except CouchbaseError as e:
+                logger.warning("Couldn't create index {0}: {1}".format(name, e))
 
     def get_bld_doc(self, ver, bld):
         docid = '{}-{}'.format(ver, bld)
@@ -49,8 +110,30 @@ class DB(object):
         except CouchbaseError as e:
             return ''
 
+        self._summary_last_qe(doc['version'], int(doc['build_num']))
         return ver
 
+    def get_summary(self, version):
+        # kept up to date by the poller (DB.update_build_summary); a version
+        # it hasn't written builds of since has none and is queried instead
+        return self.get_doc(summary_id(version))
+
+    def _summary_last_qe(self, version, bnum):
+        docid = summary_id(version)
+        for attempt in range(10):
+            try:
+                result = self.blddb.get(docid)
+                doc = result.value
+                if doc['last_qe'] >= bnum:
+                    return
+                doc['last_qe'] = bnum
+                self.blddb.replace(docid, doc, cas=result.cas)
+                return
+            except KeyExistsError:
+                continue
+            except CouchbaseError as e:
+                return
+
     def get_vm_doc(self, ip):
         try:
             result = self.vmdb.get(ip)
@@ -61,6 +144,111 @@ class DB(object):
 
         return result
 
+    def _pool_id(self, plat, purpose):
+        return 'vmpool-{}-{}'.format(plat, purpose)
+
+    def _update_pool(self, plat, purpose, add=(), remove=(), refilled=None):
+        '''
+        Adds/removes ips to/from the free list of the (os, purpose) pool doc,
+        retrying on CAS conflicts; creates the doc if it isn't there yet.
+        '''
+        docid = self._pool_id(plat, purpose)
+        for attempt in range(_CAS_RETRIES):
+            try:
+                try:
+                    result = self.vmdb.get(docid)
+                    doc, cas = result.value, result.cas
+                except NotFoundError:
+                    doc, cas = {'type': 'vm_pool', 'os': plat, 'purpose': purpose, 'free': [], 'refilled': 0}, None
+                free = [ip for ip in doc['free'] if ip not in remove]
+                free += [ip for ip in add if ip not in free]
+                if free == doc['free'] and refilled is None and cas is not None:
+                    return doc
+                doc['free'] = free
+                if refilled is not None:
+                    doc['refilled'] = refilled
+                if cas is None:
+                    self.vmdb.insert(docid, doc)
+                else:
+                    self.vmdb.replace(docid, doc, cas=cas)
+                return doc
+            except KeyExistsError:
+                continue
+            except CouchbaseError as e:
+                logger.warning("Couldn't update vm pool {0}: {1}".format(docid, e))
+                return None
+        logger.warning("Gave up updating vm pool {0} after {1} conflicts".format(docid, _CAS_RETRIES))
+        return None
+
+    def _refill_pool(self, plat, purpose):
+        # the one scan left: finds vms the pool doesn't know of yet and
+        # reservations that have expired, at most once per _POOL_RESCAN
+        now = int(time.time())
+        ips = [row['ip'] for row in self._query(self.vmdb, "SELECT ip FROM `default` WHERE os = $os AND (state = 'available' OR expires < $now) AND $purpose IN purpose",
+                                               os=plat, now=now, purpose=purpose)]
+        return self._update_pool(plat, purpose, add=ips, refilled=now)
+
+    def _free_vms(self, plat, purpose, refill=True):
+        try:
+            doc = self.vmdb.get(self._pool_id(plat, purpose)).value
+        except NotFoundError:
+            doc = None
+        except CouchbaseError as e:
+            logger.warning("Couldn't read vm pool {0}: {1}".format(self._pool_id(plat, purpose), e))
+            doc = None
+        if doc is None and refill:
+            doc = self._refill_pool(plat, purpose)
+        if doc is None:
+            return []
+        return list(doc['free'])
+
+    def _set_vm(self, ip, mutate):
+        '''
+        Applies mutate(doc) to a vm doc with a CAS-checked replace, retrying
+        when someone else changed it in between.  mutate returns False to
+        leave the doc alone; returns the new doc, or None if it wasn't
+        changed.
+        '''
+        for attempt in range(_CAS_RETRIES):
+            try:
+                result = self.vmdb.get(ip)
+                doc = result.value
+                if mutate(doc) is False:
+                    return None
+                self.vmdb.replace(ip, doc, cas=result.cas)
+                return doc
+            except KeyExistsError:
+                continue
+            except CouchbaseError as e:
+                logger.warning("Couldn't update vm {0}: {1}".format(ip, e))
+                return None
+        return None
+
+    def _claim_vm(self, ip, plat, purpose, who, hours):
+        '''
+        Reserves ip if it's still free, with a single CAS-checked replace: of
+        two callers claiming the same vm only one gets it, the other moves
+        on to its next candidate.
+        '''
+        try:
+            result = self.vmdb.get(ip)
+        except CouchbaseError:
+            return False
+        doc = result.value
+        now = int(time.time())
+        if doc.get('os') != plat or purpose not in doc.get('purpose', []):
+            return False
+        if doc.get('state') != 'available' and doc.get('expires', 0) >= now:
+            return False
+        doc['state'] = 'reserved'
+        doc['who'] = who
+        doc['expires'] = int(now + hours*60*60)
+        try:
+            self.vmdb.replace(ip, doc, cas=result.cas)
+        except CouchbaseError:
+            return False
+        return True
+
     def insert_vm(self, vm):
         try:
             docId = vm['ip']
@@ -70,141 +258,248 @@ class DB(object):
                 logger.warning("Couldn't create build history {0} due to error: {1}".format(docId, e))
                 docId = None
 
+        if docId and vm.get('state') == 'available':
+            for purpose in vm.get('purpose', []):
+                self._update_pool(vm['os'], purpose, add=[docId])
         return docId
 
     def update_vm_state(self, ip, state, who, num_hours=3):
-        try:
-            doc = self.get_vm_doc(ip).value
+        def mutate(doc):
             doc['state'] = state
             doc['who'] = who
             if state == 'reserved':
                 doc['expires'] = int(time.time() + num_hours*60*60)
             elif state == 'available':
                 doc['expires'] = 0
-            result = self.vmdb.upsert(ip, doc)
-        except CouchbaseError as e:
-            if e.rc == 12: 
-                logger.warning("Couldn't create build history {0} due to error: {1}".format(docId, e))
-                doc = None
 
+        doc = self._set_vm(ip, mutate)
+        if doc is not None and state == 'available':
+            for purpose in doc.get('purpose', []):
+                self._update_pool(doc['os'], purpose, add=[ip])
         return doc
 
     def provision(self, plat, count, purpose, who, hours=3):
-        curtime = int(time.time())
-        getmore = '10'
-        if int(count) > 10:
-            getmore = count
-        q = N1QLQuery("SELECT ip FROM `default` WHERE (state = 'available' OR expires < {} ) AND os = '{}' AND '{}' IN purpose LIMIT {}".format(curtime, plat, purpose, getmore))
-        vms = []
-        for row in self.vmdb.n1ql_query(q):
-            vms.append(row['ip'])
-        if len(vms) < int(count):
+        '''
+        Reserves count vms of os plat for purpose, all or nothing.
+
+        Candidates come from the vmpool-<os>-<purpose> doc rather than a
+        scan, in random order so concurrent callers mostly go for different
+        vms; each is claimed with a CAS-checked replace and a conflict just
+        moves on to the next one.  Claimed (and stale) ips are dropped from
+        the pool afterwards.  The pool is rescanned when it runs short.
+        '''
+        count = int(count)
+        got = []
+        tried = set()
+        rescanned = False
+        while len(got) < count:
+            free = [ip for ip in self._free_vms(plat, purpose) if ip not in tried]
+            if len(free) < count - len(got):
+                if not rescanned and self._pool_stale(plat, purpose):
+                    rescanned = True
+                    self._refill_pool(plat, purpose)
+                    continue
+                if not free:
+                    break
+            shuffle(free)
+            for ip in free:
+                if len(got) == count:
+                    break
+                tried.add(ip)
+                if self._claim_vm(ip, plat, purpose, who, hours):
+                    got.append(ip)
+
+        # another pool of the same vm may still list it: the next claim of it
+        # there fails its check and drops it
+        self._update_pool(plat, purpose, remove=list(tried))
+        if len(got) < count:
+            self.release(got)
             return []
-        shuffle(vms)
-        ret_vms = vms[:int(count)]
-        for ip in ret_vms:
-            self.update_vm_state(ip, 'reserved', who, hours)
-        return ret_vms
+        return got
+
+    def _pool_stale(self, plat, purpose):
+        try:
+            doc = self.vmdb.get(self._pool_id(plat, purpose)).value
+        except CouchbaseError:
+            return True
+        return doc.get('refilled', 0) < time.time() - _POOL_RESCAN
 
     def release(self, vms):
         for ip in vms:
             self.update_vm_state(ip, 'available', '')
         return vms
 
+    def _last_build(self, version, cond):
+        q = "SELECT build_num FROM `build-history` WHERE type = 'top_level_build' AND version = $ver AND build_num IS NOT MISSING AND {} ORDER BY build_num DESC LIMIT 1".format(cond)
+        for row in self._query(self.blddb, q, ver=version):
+            return row['build_num']
+        return 0
+
     def last_sanity(self, version, result='0'):
+        summary = self.get_summary(version)
+        if summary:
+            if result == '1':
+                return summary['last_sanity_passed']
+            return summary['last_sanity']
         res_q = "sanity_result IS NOT MISSING"
         if result == '1':
             res_q = "sanity_result = 'PASSED'"
-        q = N1QLQuery("SELECT build_num FROM `build-history` WHERE type = 'top_level_build' AND {} AND version = '{}' ORDER BY build_num DESC LIMIT 1".format(res_q, version))
-        bnums = []
-        for row in self.blddb.n1ql_query(q):
-            bnums.append(row['build_num'])
-        if bnums:
-            return bnums[0]
-        else:
-            return 0
+        return self._last_build(version, res_q)
 
     def last_unit(self, version):
-        q = N1QLQuery("SELECT build_num FROM `build-history` WHERE type = 'top_level_build' AND unit = 'true' AND version = '{}' ORDER BY build_num DESC LIMIT 1".format(version))
-        bnums = []
-        for row in self.blddb.n1ql_query(q):
-            bnums.append(row['build_num'])
-        if bnums:
-            return bnums[0]
-        else:
-            return 0
+        summary = self.get_summary(version)
+        if summary:
+            return summary['last_unit']
+        return self._last_build(version, "unit = 'true'")
 
     def last_unit_plus_sanity(self, version):
-        q = N1QLQuery("SELECT build_num FROM `build-history` WHERE type = 'top_level_build' AND unit = 'true' AND sanity_result = 'PASSED' AND version = '{}' ORDER BY build_num DESC LIMIT 1".format(version))
-        bnums = []
-        for row in self.blddb.n1ql_query(q):
-            bnums.append(row['build_num'])
-        if bnums:
-            return bnums[0]
-        else:
-            return 0
+        summary = self.get_summary(version)
+        if summary:
+            return summary['last_unit_sanity']
+        return self._last_build(version, "unit = 'true' AND sanity_result = 'PASSED'")
 
     def last_qe(self, version):
-        q = N1QLQuery("SELECT max(build_num) FROM `build-history` WHERE type = 'top_level_build' AND qe_sanity = 'true' AND version = '{}'".format(version))
-        bnums = []
-        for row in self.blddb.n1ql_query(q):
-            bnums.append(row['$1'])
-            break
-        if bnums:
-            return bnums[0]
-        else:
-            return 0
+        summary = self.get_summary(version)
+        if summary:
+            return summary['last_qe']
+        return self._last_build(version, "qe_sanity = 'true'")
+
+    def _pending(self, summary, frm, limit, ok):
+        bnums = [int(b) for b, e in summary['pending'].items() if int(b) > frm and ok(e)]
+        bnums.sort(reverse=True)
+        return bnums[:int(limit)]
 
     def not_yet_sanity_tested(self, version, limit=3):
+        summary = self.get_summary(version)
+        if summary:
+            return self._pending(summary, summary['last_sanity'], limit,
+                                 lambda e: e['clean'] and not e['sanity_result'])
         frm = self.last_sanity(version)
-        q = N1QLQuery("SELECT build_num FROM `build-history` WHERE type = 'top_level_build' AND build_num > {} AND failed = [] AND incomplete = [] AND sanity_result IS MISSING AND version = '{}' ORDER BY build_num DESC LIMIT {}".format(frm, version, limit))
+        q = "SELECT build_num FROM `build-history` WHERE type = 'top_level_build' AND version = $ver AND build_num > $frm AND failed = [] AND incomplete = [] AND sanity_result IS MISSING ORDER BY build_num DESC LIMIT $limit"
         bnums = []
-        for row in self.blddb.n1ql_query(q):
+        for row in self._query(self.blddb, q, ver=version, frm=frm, limit=int(limit)):
             bnums.append(row['build_num'])
         print 'not_yet_sanity_test: ',
         print bnums
         return bnums
 
     def not_yet_unit_tested(self, version, limit=3):
+        summary = self.get_summary(version)
+        if summary:
+            return self._pending(summary, summary['last_unit'], limit,
+                                 lambda e: not e['unit_result'])
         frm = self.last_unit(version)
-        print frm
-        print "SELECT build_num FROM `build-history` WHERE type = 'top_level_build' AND build_num > {} AND unit_result IS MISSING AND failed = [] AND incomplete = [] AND version = '{}' ORDER BY build_num DESC LIMIT {}".format(frm, version, limit)
-        q = N1QLQuery("SELECT build_num FROM `build-history` WHERE type = 'top_level_build' AND build_num > {} AND unit_result IS MISSING AND version = '{}' ORDER BY build_num DESC LIMIT {}".format(frm, version, limit))
+        q = "SELECT build_num FROM `build-history` WHERE type = 'top_level_build' AND version = $ver AND build_num > $frm AND unit_result IS MISSING ORDER BY build_num DESC LIMIT $limit"
         bnums = []
-        for row in self.blddb.n1ql_query(q):
+        for row in self._query(self.blddb, q, ver=version, frm=frm, limit=int(limit)):
             bnums.append(row['build_num'])
         return bnums
 
+    def iter_log(self, version, from_build, to_build, after=None, limit=None, by_repo=False):
+        '''
+        Yields the commits of the builds in (from_build, to_build] as the
+        query streams them back, ordered by build and commit id (by repo
+        first with by_repo), each with its build_num and the 'cursor' to
+        pass as after to resume behind it.  limit caps how many are yielded.
+        '''
+        q = "SELECT b.build_num, META(c).id AS commit_id, c.* FROM `build-history` AS b " \
+            "JOIN `build-history` AS c ON KEYS b.commits " \
+            "WHERE b.type = 'top_level_build' AND b.version = $ver AND b.build_num > $frm AND b.build_num <= $to " \
+            "AND c.type = 'commit'"
+        params = {'ver': version, 'frm': int(from_build), 'to': int(to_build)}
+        if after:
+            params['abld'], params['acid'] = parse_cursor(after)
+            behind = "(b.build_num > $abld OR (b.build_num = $abld AND META(c).id > $acid))"
+            if by_repo:
+                # commit ids are <repo>-<sha>, so the cursor's repo is known
+                params['arepo'] = params['acid'].rsplit('-', 1)[0]
+                behind = "(c.repo > $arepo OR (c.repo = $arepo AND {}))".format(behind)
+            q += " AND " + behind
+        if by_repo:
+            q += " ORDER BY c.repo, b.build_num, META(c).id"
+        else:
+            q += " ORDER BY b.build_num, META(c).id"
+        if limit:
+            q += " LIMIT $limit"
+            params['limit'] = int(limit)
+        for row in self._query(self.blddb, q, **params):
+            row['cursor'] = '{}:{}'.format(row['build_num'], row.pop('commit_id'))
+            yield row
+
     def get_log(self, version, from_build, to_build):
-        q = N1QLQuery("SELECT b.build_num, c.* FROM `build-history` AS b JOIN `build-history` AS c ON KEYS b.commits WHERE b.type = 'top_level_build' AND c.type = 'commit' AND b.version = '{0}' AND tonumber(b.build_num) > {1} AND tonumber(b.build_num) <={2}".format(version, from_build, to_build))
-        print q
-        log = []
-        for row in self.blddb.n1ql_query(q):
-            log.append(row)
-        return log
+        return list(self.iter_log(version, from_build, to_build))
 
     def fixes_in_build(self, ver, bnum):
-        # Make this a N1QL query
-        tix = []
+        # the poller keeps the tickets a build fixes on its doc; builds from
+        # before it did, and which fix nothing, still need their commits read
         bdoc = self.get_bld_doc(ver, bnum)
-        if bdoc:
-            if bdoc.has_key('commits'):
-                for c in bdoc['commits']:
-                    cdoc = self.get_doc(c)
-                    if cdoc:
-                        if cdoc.has_key('fixes'):
-                            tix = tix + cdoc['fixes']
+        if not bdoc:
+            return []
+        if bdoc.has_key('tickets'):
+            return bdoc['tickets']
+        tix = []
+        if bdoc.get('commits'):
+            try:
+                results = self.blddb.get_multi(bdoc['commits'], quiet=True)
+            except CouchbaseError as e:
+                results = e.all_results
+            for r in results.values():
+                if r.success and r.value.has_key('fixes'):
+                    tix = tix + r.value['fixes']
         tix = list(set(tix))
         tix.sort()
         return tix
-                    
 
     def ticket_in_build(self, tid):
-        q = N1QLQuery("SELECT ARRAY_AGG(z) AS in_build FROM `build-history` b UNNEST in_build z WHERE Array x FOR x IN b.fixes WHEn x = '{}' END;".format(tid))
-        bnums = []
-        for row in self.blddb.n1ql_query(q):
-            inb = row['in_build']
-            if inb:
-                bnums = list(set(inb))
-            break
-        return bnums
+        # ticket-<ID> docs are the poller's inverted index of the commits
+        # fixing a ticket; once it is built (ticket-index) a missing doc
+        # means no build has the ticket
+        tdoc = self.get_doc('ticket-' + tid)
+        if tdoc:
+            return sorted(tdoc['builds'])
+        if self.get_doc('ticket-index'):
+            return []
+        q = "SELECT RAW b.in_build FROM `build-history` b WHERE b.type = 'commit' AND ANY f IN b.fixes SATISFIES f = $ticket END"
+        bnums = set()
+        for in_build in self._query(self.blddb, q, ticket=tid):
+            if in_build:
+                bnums.update(in_build)
+        return list(bnums)
+
+    def test_stats(self, ver, distro, edition='enterprise', kind='unit'):
+        # per test case stats kept by the poller's testanalytics as runs are
+        # ingested, with the name ids resolved
+        docid = 'teststats-{}-{}-{}-{}'.format(ver, distro, edition, kind)
+        stats = self.get_doc(docid)
+        if not stats:
+            return []
+        names = self.get_doc(stats['names']).get('names', [])
+        # the cases are in shard docs; docs from before sharding have them inline
+        all_cases = dict(stats.get('cases', {}))
+        shard_ids = ['{}::{}'.format(docid, n) for n in stats.get('shards', [])]
+        if shard_ids:
+            try:
+                results = self.blddb.get_multi(shard_ids, quiet=True)
+            except CouchbaseError as e:
+                results = e.all_results
+            for result in results.values():
+                if result.success:
+                    all_cases.update(result.value['cases'])
+        cases = []
+        for cid, case in all_cases.items():
+            cid = int(cid)
+            if cid >= len(names):
+                continue
+            case['suite'], case['name'], case['params'] = names[cid]
+            cases.append(case)
+        return cases
+
+    def flaky_tests(self, ver, distro, edition='enterprise', kind='unit', min_rate=0.2, limit=50):
+        cases = [c for c in self.test_stats(ver, distro, edition, kind) if c['flip_rate'] >= min_rate]
+        cases.sort(key=lambda c: c['flip_rate'], reverse=True)
+        return cases[:limit]
+
+    def failing_tests(self, ver, distro, edition='enterprise', kind='unit'):
+        cases = [c for c in self.test_stats(ver, distro, edition, kind) if c['first_failing']]
+        cases.sort(key=lambda c: c['streak'][1], reverse=True)
+        return cases
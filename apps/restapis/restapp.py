@@ -1,12 +1,119 @@
 #!/usr/bin/python
+import os
+import hmac
 import json
-from flask import Flask, request
+import time
+import threading
+from functools import wraps
+from flask import Flask, request, stream_with_context
 from flask.json import jsonify
-from db import DB
+from db import DB, parse_cursor
+from cache import TTLCache
 
 app = Flask(__name__)
 
 db = DB()
+cache = TTLCache(maxsize=4096, ttl=60)
+
+# per endpoint: [hits, ms spent on hits, misses, ms spent on misses]
+latency = {}
+latency_lock = threading.Lock()
+
+def _finished_build(doc):
+    # a build nothing will be added to any more: every distro done and
+    # sanity (and unit tests, if it had them) reported
+    return bool(doc) and doc.get('incomplete') == [] and \
+        doc.get('sanity_result') in ('PASSED', 'FAILED') and \
+        doc.get('unit_result', 'PASSED') != 'INCOMPLETE'
+
+# who may invalidate the cache: callers sending this token, or with no
+# token set, callers from these hosts (the pollers)
+_INVALIDATE_TOKEN = os.environ.get('BBDB_INVALIDATE_TOKEN', '')
+_INVALIDATE_HOSTS = os.environ.get('BBDB_INVALIDATE_HOSTS', '127.0.0.1').split(',')
+
+def _from_poller():
+    if _INVALIDATE_TOKEN:
+        return hmac.compare_digest(str(request.headers.get('X-Invalidate-Token', '')), _INVALIDATE_TOKEN)
+    return request.remote_addr in _INVALIDATE_HOSTS
+
+# streamed responses bigger than this are passed through but not cached
+_MAX_CACHED_STREAM = 4*1024*1024
+
+def _record(path, hit, start):
+    ms = (time.time() - start) * 1000
+    with latency_lock:
+        l = latency.setdefault(path, [0, 0.0, 0, 0.0])
+        if hit:
+            l[0] += 1
+            l[1] += ms
+        else:
+            l[2] += 1
+            l[3] += ms
+
+def _tee(key, chunks, mimetype, tags, ttl, path, start):
+    # streams the response on while keeping a copy to cache, as long as it
+    # stays small enough
+    kept = []
+    size = 0
+    for chunk in chunks:
+        if kept is not None:
+            kept.append(chunk)
+            size += len(chunk)
+            if size > _MAX_CACHED_STREAM:
+                kept = None
+        yield chunk
+    if kept is not None:
+        cache.put(key, (''.join(kept), mimetype), tags, ttl)
+    _record(path, False, start)
+
+def cached(immutable=None):
+    '''
+    Serves a GET endpoint from the cache, keyed by path and query string.
+    Entries are tagged with the build they are about (ver-bnum), else the
+    version (or '*') so the poller can invalidate them, and expire after
+    the cache's ttl.  When
+    immutable(args, result) names a build whose result can't change any
+    more, the entry never expires and is only tagged with that build;
+    for streamed responses result is None.
+    '''
+    def wrap(f):
+        @wraps(f)
+        def handler():
+            start = time.time()
+            key = request.full_path
+            found, entry = cache.get(key)
+            if found:
+                _record(request.path, True, start)
+                return app.response_class(entry[0], mimetype=entry[1])
+
+            res = app.make_response(f())
+            if res.status_code != 200:
+                # errors (bad arguments and such) aren't cached
+                _record(request.path, False, start)
+                return res
+            body = None
+            if not res.is_streamed:
+                body = res.get_data()
+            ver = request.args.get('ver')
+            tags = [ver or '*']
+            if ver and request.args.get('bnum'):
+                tags = ['{}-{}'.format(ver, request.args.get('bnum'))]
+            ttl = 0
+            bnum = None
+            if ver and immutable:
+                bnum = immutable(request.args, json.loads(body) if body is not None else None)
+            if bnum:
+                tags = ['{}-{}'.format(ver, bnum)]
+                ttl = None
+
+            if body is None:
+                return app.response_class(_tee(key, res.response, res.mimetype, tags, ttl, request.path, start),
+                                          mimetype=res.mimetype)
+            cache.put(key, (body, res.mimetype), tags, ttl)
+            _record(request.path, False, start)
+            return app.response_class(body, mimetype=res.mimetype)
+        return handler
+    return wrap
 
 @app.route('/vms/get', methods=['GET'])
 def provision_vms():
@@ -26,27 +133,32 @@ def release_vms():
     return jsonify({'vms': vms})
 
 @app.route('/builds/lastunit', methods=['GET'])
+@cached()
 def last_build_unit_tested():
     v = request.args.get('ver', '4.7.0')
     return jsonify({'build_num': db.last_unit(v)})
 
 @app.route('/builds/lastsanity', methods=['GET'])
+@cached()
 def last_build_sanity():
     v = request.args.get('ver', '4.7.0')
     r = request.args.get('passed', '0')
     return jsonify({'build_num': db.last_sanity(v, r)})
 
 @app.route('/builds/lastunitsanity', methods=['GET'])
+@cached()
 def last_build_with_unit_and_sanity():
     v = request.args.get('ver', '4.7.0')
     return jsonify({'build_num': db.last_unit_plus_sanity(v)})
 
 @app.route('/builds/lastqe', methods=['GET'])
+@cached()
 def last_qe():
     v = request.args.get('ver', '4.7.0')
     return jsonify({'build_num': db.last_qe(v)})
 
 @app.route('/builds/totest', methods=['GET'])
+@cached()
 def builds_to_test():
     t = request.args.get('type', 'unit')
     v = request.args.get('ver', '4.7.0')
@@ -59,38 +171,144 @@ def builds_to_test():
         return jsonify({'build_nums': []})
 
 @app.route('/builds/info', methods=['GET'])
+@cached(lambda args, res: _finished_build(res['build_info']) and args.get('bnum'))
 def get_build_info():
     v = request.args.get('ver')
     b  = request.args.get('bnum')
     return jsonify({'build_info': db.get_bld_doc(v, b)})
 
 @app.route('/changelog', methods=['GET'])
+@cached(lambda args, res: _finished_build(db.get_bld_doc(args.get('ver'), args.get('to'))) and args.get('to'))
 def get_log():
+    # streamed as the query returns rows, never held in memory whole.
+    # format=ndjson gives one commit per line; the default is chunked JSON
+    # in the old {"log": [...]} shape plus "next", the cursor to pass as
+    # after= for the next page when limit= cut it short (null at the end).
+    # order=repo groups the commits by repo, for the buildboard changelog
     ver = request.args.get('ver')
-    frm = request.args.get('from')
-    to = request.args.get('to')
-    clog = db.get_log(ver, frm, to)
-    return jsonify({'log': clog})
+    frm = request.args.get('from', type=int)
+    to = request.args.get('to', type=int)
+    after = request.args.get('after')
+    limit = request.args.get('limit', type=int)
+    fmt = request.args.get('format', 'json')
+    # checked here: once streaming, an error can't be a 400 any more
+    if frm is None or to is None:
+        return jsonify({'error': 'from and to must be build numbers'}), 400
+    if after:
+        try:
+            parse_cursor(after)
+        except ValueError:
+            return jsonify({'error': 'after must be <build_num>:<commit id>'}), 400
+    rows = db.iter_log(ver, frm, to, after, limit, by_repo=request.args.get('order') == 'repo')
+
+    def ndjson():
+        for row in rows:
+            yield json.dumps(row) + '\n'
+
+    def chunked():
+        yield '{"log": ['
+        count = 0
+        cursor = None
+        for row in rows:
+            if count:
+                yield ', '
+            yield json.dumps(row)
+            count += 1
+            cursor = row['cursor']
+        if not (limit and count == limit):
+            cursor = None
+        yield '], "next": %s}' % json.dumps(cursor)
+
+    if fmt == 'ndjson':
+        return app.response_class(stream_with_context(ndjson()), mimetype='application/x-ndjson')
+    return app.response_class(stream_with_context(chunked()), mimetype='application/json')
 
 @app.route('/builds/qekickoff', methods=['GET'])
 def qe_kicked_off():
     ver = request.args.get('ver')
     bnum = request.args.get('bnum')
     ret = db.qe_kicked_off(ver+'-'+bnum)
+    cache.invalidate(ver, '*', ver+'-'+bnum)
     return jsonify({'ver': ret})
 
 @app.route('/builds/hasticket', methods=['GET'])
+@cached()
 def has_ticket():
     t = request.args.get('id')
+    if not t:
+        return jsonify({'error': 'id is required'}), 400
     ret = db.ticket_in_build(t)
     return jsonify({'builds': ret})
 
 @app.route('/builds/tickets', methods=['GET'])
+@cached()
 def included_tickets():
     ver = request.args.get('ver')
     bnum = request.args.get('bnum')
     ret = db.fixes_in_build(ver, bnum)
     return jsonify({'tickets': ret})
 
+@app.route('/tests/stats', methods=['GET'])
+@cached()
+def test_stats():
+    ver = request.args.get('ver')
+    distro = request.args.get('distro')
+    edition = request.args.get('edition', 'enterprise')
+    kind = request.args.get('kind', 'unit')
+    return jsonify({'tests': db.test_stats(ver, distro, edition, kind)})
+
+@app.route('/tests/flaky', methods=['GET'])
+@cached()
+def flaky_tests():
+    ver = request.args.get('ver')
+    distro = request.args.get('distro')
+    edition = request.args.get('edition', 'enterprise')
+    kind = request.args.get('kind', 'unit')
+    rate = float(request.args.get('min_rate', 0.2))
+    limit = int(request.args.get('limit', 50))
+    return jsonify({'tests': db.flaky_tests(ver, distro, edition, kind, rate, limit)})
+
+@app.route('/tests/failing', methods=['GET'])
+@cached()
+def failing_tests():
+    ver = request.args.get('ver')
+    distro = request.args.get('distro')
+    edition = request.args.get('edition', 'enterprise')
+    kind = request.args.get('kind', 'unit')
+    return jsonify({'tests': db.failing_tests(ver, distro, edition, kind)})
+
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    # called by the poller with the builds it wrote since it last called:
+    # drops what's cached about each of those builds and what's cached
+    # about their versions as a whole (latest builds and such), but not
+    # what's cached about the other builds of the version
+    if not _from_poller():
+        return jsonify({'error': 'not allowed'}), 403
+    builds = (request.get_json(silent=True) or {}).get('builds')
+    if builds is None:
+        builds = [{'ver': request.args.get('ver'), 'bnum': request.args.get('bnum')}]
+    tags = set(['*'])
+    for b in builds:
+        if not isinstance(b, dict) or not b.get('ver'):
+            return jsonify({'error': 'ver is required'}), 400
+        tags.add(b['ver'])
+        if b.get('bnum'):
+            tags.add('{}-{}'.format(b['ver'], b['bnum']))
+    return jsonify({'invalidated': cache.invalidate(*tags)})
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    endpoints = {}
+    with latency_lock:
+        for path, (hits, hit_ms, misses, miss_ms) in latency.items():
+            endpoints[path] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_ms': round(hit_ms / hits, 2) if hits else None,
+                'miss_ms': round(miss_ms / misses, 2) if misses else None,
+            }
+    return jsonify({'cache': cache.stats(), 'endpoints': endpoints})
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=8080)
@@ -6,13 +6,21 @@ import time
 import datetime
 import re
 import json
-import requests
 import logging
-import xml.etree.ElementTree as ET
+import threading
+import requests
 from git import Repo
 from db import DB
+from fetcher import Fetcher
+from manifest import ManifestEngine
+from github import GitHubCommits, GitHubError
+from http_client import HttpClient
+from http_cache import HttpCache
 from jira import JIRA
-from jira.exceptions import JIRAError
+from jira_outbox import JiraOutbox
+from pipeline import Pipeline, Stage, Halt
+import testreport
+from testanalytics import TestAnalytics
 from logging.handlers import TimedRotatingFileHandler
 
 #TODO - make build-team-manifest clone location
@@ -43,6 +51,11 @@ btm_manifest_map = {
 }
 update_top = []
 update_distro = []
+# Everything the _parse_one_* methods read from a build's own JSON, so a
+# whole page of builds comes back from the job in a single request
+_BUILD_TREE = 'allBuilds[number,result,building,timestamp,duration,builtOn,url,' \
+              'actions[totalCount,failCount,skipCount,urlName],runs[number,url]]'
+_LIST_PAGE = 100
 
 
 _GITHUB_TOKEN = ''
@@ -50,17 +63,72 @@ with open(os.path.join(os.path.expanduser('~'), '.ssh/githubtoken')) as F:
     _GITHUB_TOKEN = F.read().strip()
 
 _BLDHISTORY_BUCKET = 'couchbase://localhost/build-history'
+_HTTP_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.bbdb', 'http-cache')
+
+def _job_name(url):
+    # absolute job URLs and the relative ones (job/<name>/) the Jenkins
+    # Notification plugin sends both name the same job
+    return ('/' + url.strip('/')).split('/job/')[-1]
+
+def _is_running(bld_js):
+    return bld_js is None or bld_js.get('building') or bld_js.get('result') is None
+
+def _jenkins_immutable(res):
+    '''
+    Env vars are injected once at the start of a build and a build that has
+    a result won't change any more; job summaries and listings always do.
+    '''
+    try:
+        j = res.json()
+    except ValueError:
+        return False
+    if not isinstance(j, dict):
+        return False
+    if j.has_key('envMap'):
+        return True
+    return j.get('building') is False and j.get('result') is not None
+
+def shards_from_constants(constants, releases=None):
+    '''
+    Splits a poll cycle into independent pieces of work: one per release
+    (its top level, unix and windows build jobs, in that order) and one per
+    unit test and build sanity job.
+    '''
+    if not releases:
+        releases = constants['releases']['codes']
+    ret = [('build', rel) for rel in releases]
+    ret += [('unit', url) for url in constants['unit_test_urls']]
+    ret += [('sanity', url) for url in constants['sanity_test_urls']]
+    return ret
 
 class BuildPoller():
-    def __init__(self, log_file='build_poller.log', log_level='DEBUG', loop=True, releases=[]):
+    def __init__(self, log_file='build_poller.log', log_level='DEBUG', loop=True, releases=[], poll_interval=300,
+                 fetch_workers=8, fetch_per_host=4, fetch_batch=16,
+                 cache_dir=_HTTP_CACHE_DIR, cache_bytes=512*1024*1024):
         self.logger = self._init_logger(log_file, log_level)
         self.bldDB = DB(_BLDHISTORY_BUCKET)
+        self.http_cache = HttpCache(cache_dir, cache_bytes)
+        self.http = HttpClient(pool_size=fetch_workers,
+                               host_headers={'api.github.com': {'Authorization': 'token {}'.format(_GITHUB_TOKEN)}},
+                               cache=self.http_cache)
+        self.fetcher = Fetcher(self._fetch_js, fetch_workers, fetch_per_host)
+        self.github = GitHubCommits(self.http)
+        self.fetch_batch = fetch_batch
         self.jira = JIRA( { 'server': 'https://issues.couchbase.com/' } )
+        self.jira_outbox = JiraOutbox(self.jira, self.bldDB)
+        self.jira_outbox.start()
+        self.manifests = ManifestEngine(_GITREPO)
+        self._lock = threading.Lock()
+        self._manifest_shas = {}
+        self._changed = set()
+        self.analytics = TestAnalytics(self.bldDB)
+        self.bldDB.on_build_change = self._invalidate_caches
         self.constants = None
         self.all_releases = None
         self._read_poll_info_from_db()
 
         self.loop = loop
+        self.poll_interval = poll_interval
         self.releases = releases
         if not self.releases:
             self.releases = self.constants['releases']['codes']
@@ -68,81 +136,176 @@ class BuildPoller():
     def poll(self):
         while True:
             self.logger.debug('Begin polling at {}'.format(time.ctime()))
-            for rel in self.releases:
-                self.logger.debug('polling release {}'.format(rel))
+            for shard in self.shards():
+                self.logger.debug('polling {} {}'.format(*shard))
                 try:
-                    #build
-                    top_url = self.constants['build_urls'][rel]['top_level']
-                    unix_url = self.constants['build_urls'][rel]['unix']
-                    win_url = self.constants['build_urls'][rel]['windows']
-                    self._poll_top_level(top_url)
-                    self._poll_distros(unix_url)
-                    self._poll_distros(win_url)
-
-                    #unit-tests
-                    unit_urls = self.constants['unit_test_urls']
-                    for url in unit_urls:
-                        self._poll_unit_results(url)
-
-                    #sanity-test
-                    sanity_matrix_urls = self.constants['sanity_test_urls']
-                    for url in sanity_matrix_urls:
-                        self._poll_build_sanity_results(url)
+                    self.poll_shard(shard)
                 except Exception, e:
                     self.logger.error("Exception during polling. But, ignore and repeat:")
                     self.logger.error(e)
 
             self.logger.debug('End polling at {}'.format(time.ctime()))
+            self.logger.debug('HTTP cache: {}'.format(self.http_cache.stats()))
+            self.logger.debug('GitHub rate limit: {}'.format(self.github.rate_limit()))
 
             if not self.loop:
                 break
-            time.sleep(300)
+            time.sleep(self.poll_interval)
             self._read_poll_info_from_db()
 
+    def _invalidate_caches(self, version, bnum):
+        '''
+        Notes that a build changed, for the apps caching build data; they
+        are told once per shard polled (flush_invalidations).
+        '''
+        with self._lock:
+            self._changed.add((version, bnum))
+
+    def flush_invalidations(self):
+        '''
+        Tells the apps caching build data (constants: cache_invalidate_urls)
+        which builds changed since the last flush, in one POST per app and
+        off the polling thread.
+        '''
+        with self._lock:
+            builds = sorted(self._changed)
+            self._changed = set()
+        urls = self.constants.get('cache_invalidate_urls', [])
+        if not builds or not urls:
+            return
+        body = {'builds': [{'ver': v, 'bnum': b} for v, b in builds]}
+        headers = {'X-Invalidate-Token': self.constants.get('cache_invalidate_token', '')}
+        t = threading.Thread(target=self._post_invalidations, args=(urls, body, headers))
+        t.daemon = True
+        t.start()
+
+    def _post_invalidations(self, urls, body, headers):
+        for url in urls:
+            try:
+                requests.post(url, json=body, headers=headers, timeout=(1, 2))
+            except requests.RequestException as e:
+                self.logger.debug('could not invalidate cache at {}: {}'.format(url, e))
+
+    def shards(self):
+        return shards_from_constants(self.constants, self.releases)
+
+    def poll_shard(self, shard):
+        kind, key = shard
+        try:
+            if kind == 'build':
+                #build
+                self._poll_top_level(self.constants['build_urls'][key]['top_level'])
+                self._poll_distros(self.constants['build_urls'][key]['unix'])
+                self._poll_distros(self.constants['build_urls'][key]['windows'])
+            elif kind == 'unit':
+                #unit-tests
+                self._poll_unit_results(key)
+            elif kind == 'sanity':
+                #sanity-test
+                self._poll_build_sanity_results(key)
+            else:
+                self.logger.error('unknown shard {}'.format(shard))
+        finally:
+            self.flush_invalidations()
+
     def query(self):
         pass
 
     def _poll_top_level(self, url):
-        res = self._get_js(url)
+        res = self._get_js(url, params={'tree': 'lastBuild[number]'})
         if not res:
             self.logger.warning('Nothing to do since Jenkins returned empty')
             return
 
         j = res.json()
         poll_from = int(j['lastBuild']['number'])
+        cursor = self.bldDB.get_cursor(url)
+        if cursor:
+            # the top level doc is written once, whether or not the job is
+            # done, so there is never anything to come back for
+            self._poll_from_cursor(url, cursor, poll_from, self._top_stages(),
+                                   self._top_pipeline, track_running=False)
+            return
+
         poll_till = 0
         if poll_from > 200:
             poll_till = poll_from -  200
 
-        for b in range(poll_from, poll_till, -1):
-            ret = self._parse_one_top_build(url, b)
-            if not ret:
-                self.logger.debug('Reached latest top level build already saved')
+        pipeline = self._top_pipeline()
+        try:
+            pipeline.run(self._build_items(url, poll_from, poll_till, halt=True))
+        finally:
+            self.fetcher.discard()
+        if pipeline.halted.is_set():
+            self.logger.debug('Reached latest top level build already saved')
+        self.logger.debug('top level pipeline: {}'.format(pipeline.stats()))
+
+        self.bldDB.update_cursor(url, poll_from)
+
+    def _top_pipeline(self, done=None):
+        return Pipeline('top-level', [Stage(name, func) for name, func in self._top_stages()], done=done)
+
+    def _top_stages(self):
+        return [('fetch', self._top_fetch),
+                ('parse', self._top_parse),
+                ('diff', self._top_diff),
+                ('persist', self._top_persist)]
+
+    def _build_item(self, url, bnum, bld_js=None, **kwargs):
+        # settled: saved, or found to need nothing; anything else is retried
+        item = {'url': url, 'bnum': bnum, 'bld_js': bld_js, 'update': False, 'force': False,
+                'version_filter': '', 'halt': False, 'ret': None, 'settled': False}
+        item.update(kwargs)
+        return item
+
+    def _build_items(self, url, poll_from, poll_till, **kwargs):
+        for b, bld_js in self._build_window(url, poll_from, poll_till, discard=False):
+            yield self._build_item(url, b, bld_js, **kwargs)
+
+    def _run_stages(self, item, stages):
+        '''
+        Runs one build through the stages of a pipeline on the calling
+        thread, for the callers that handle a single build at a time.
+        '''
+        for name, func in stages:
+            if func(item) is None:
                 break
-            else:
-                if ret.split('-')[1] == poll_till:
-                    self.logger.debug('poll_top_level: reached end. stopping.')
-                    break
+        return item['ret']
+
+    def _parse_one_top_build(self, url, bnum, force=False, version_filter='', bld_js=None):
+        item = self._build_item(url, bnum, bld_js, force=force, version_filter=version_filter)
+        return self._run_stages(item, self._top_stages())
+
+    def _fetch_build(self, item):
+        '''
+        Pipeline stage: fetches the build and injectedEnvVars json from Jenkins.
+        '''
+        url, bnum = item['url'], item['bnum']
+        self.logger.debug('fetching build: url: {}, build_num: {}'.format(url, bnum))
+        if item['bld_js'] is None:
+            bldurl = '{}/{}'.format(url, bnum)
+            res = self._get_js(bldurl)
+            if not res:
+                self.logger.warning('no info from jenkins for {}'.format(bldurl))
+                return
+            item['bld_js'] = res.json()
+        envurl = '{}/{}/injectedEnvVars'.format(url, bnum)
+        res = self._get_js(envurl)
+        item['env_js'] = None
+        if res:
+            item['env_js'] = res.json()
+        return item
 
-    def _parse_one_top_build(self, url, bnum, force=False, version_filter=''):
-        self.logger.debug('_parse_one_top_build: url: {}, build_num: {}'.format(url, bnum))
-        bldurl_fmt = '{}/{}'
-        envurl_fmt = bldurl_fmt + '/injectedEnvVars'
+    def _top_fetch(self, item):
+        return self._fetch_build(item)
 
-        bldurl = bldurl_fmt.format(url, bnum)
-        res = self._get_js(bldurl)
-        if not res:
-            self.logger.warning('no info from jenkins for {}'.format(bldurl))
-            return
-        j = res.json()
+    def _top_parse(self, item):
+        j = item['bld_js']
         build = {}
         build['timestamp'] = j['timestamp']
 
-        envurl = envurl_fmt.format(url, bnum)
-        res = self._get_js(envurl)
-
-        if res:
-            j = res.json()
+        if item['env_js']:
+            j = item['env_js']
             try:
                 #sherlock builds have MANIFEST_FILE, watson and spock have MANIFEST
                 build['manifest'] = ""
@@ -152,10 +315,12 @@ class BuildPoller():
                     build['manifest'] = j['envMap']['MANIFEST_FILE']
                 build['build_num'] = int(j['envMap']['BLD_NUM'])
                 build['version'] = j['envMap']['VERSION']
-                if version_filter:
-                    if build['version'] != version_filter:
-                        self.logger.info('Version filter is set to {}; this build is version {}. Ignoring.'.format(version_filter, build['version']))
-                        return '0-0'
+                if item['version_filter']:
+                    if build['version'] != item['version_filter']:
+                        self.logger.info('Version filter is set to {}; this build is version {}. Ignoring.'.format(item['version_filter'], build['version']))
+                        item['ret'] = '0-0'
+                        item['settled'] = True
+                        return
 
                 #spock builds are not having manifest_sha env variable
                 build['manifest_sha'] = ""
@@ -178,100 +343,285 @@ class BuildPoller():
                 if j['envMap'].has_key('UNIT_TEST'):
                     build['unit'] = j['envMap']['UNIT_TEST']
             except KeyError, e:
-                self.logger.error("_parse_one_top_build: unknown key:" + e.message)
-                return '0-0'
+                self.logger.error("_top_parse: unknown key:" + e.message)
+                item['ret'] = '0-0'
+                return
 
         in_build = build['version'] + '-' + str(build['build_num'])
-        if not force and self.bldDB.doc_exists(in_build):
+        if not item['force'] and self.bldDB.doc_exists(in_build):
             #already there
-            return None
+            item['settled'] = True
+            if item['halt']:
+                raise Halt(in_build)
+            return
+
+        # the next build may be diffed against this one before it is saved
+        with self._lock:
+            self._manifest_shas[in_build] = build['manifest_sha']
+        item['build'] = build
+        item['in_build'] = in_build
+        return item
 
+    def _top_diff(self, item):
+        build = item['build']
         build['commits'] = []
-        if (not start_build_number.has_key(build['product_branch'])) or \
-           (start_build_number[build['product_branch']] != build['build_num'] and build['manifest_sha']):
-            changes, adds, deletes = self._commits(in_build, build['manifest_sha'], build['manifest'])
-            build['commits'] = changes + adds
-            build['repo_deleted'] = deletes
-        build['passed'] = []
-        build['failed'] = []
-        build['incomplete'] = []
-        build['type'] = 'top_level_build'
-        self.logger.debug('inserting top level build {} into db'.format(in_build))
-        return self.bldDB.insert_build_history(build, force)
+        item['commits'] = ([], [])
+        try:
+            if (not start_build_number.has_key(build['product_branch'])) or \
+               (start_build_number[build['product_branch']] != build['build_num'] and build['manifest_sha']):
+                changes, adds, deletes = self._diff_commits(item['in_build'], build['manifest_sha'], build['manifest'])
+                item['commits'] = (changes, adds)
+                build['repo_deleted'] = deletes
+        except Exception:
+            # dropped here, it never gets to _top_persist
+            self._forget_manifest(item)
+            raise
+        return item
+
+    def _top_persist(self, item):
+        try:
+            build = item['build']
+            changes, adds = item['commits']
+            if changes or adds:
+                build['commits'] = self._save_commits(changes, adds)
+            build['tickets'] = sorted(set(t for c in changes + adds for t in c['fixes']))
+            build['passed'] = []
+            build['failed'] = []
+            build['incomplete'] = []
+            build['type'] = 'top_level_build'
+            self.logger.debug('inserting top level build {} into db'.format(item['in_build']))
+            item['ret'] = self.bldDB.insert_build_history(build, item['force'])
+            item['settled'] = item['ret'] is not None
+        finally:
+            self._forget_manifest(item)
+        return item
+
+    def _forget_manifest(self, item):
+        with self._lock:
+            self._manifest_shas.pop(item['in_build'], None)
 
     def _poll_distros(self, url):
-        incomplete = self.bldDB.get_incomplete_builds()
-        for u in incomplete:
-            u = u.strip('/')
-            baseurl = u[0:u.rfind('/')]
-            bnum = u[u.rfind('/')+1:]
-            self.logger.debug('{} - polling incomplete build'.format(baseurl))
-            self._parse_one_distro(baseurl, bnum, True)
-
-        res = self._get_js(url)
+        cursor = self.bldDB.get_cursor(url)
+        running = []
+        if not cursor:
+            incomplete = self.bldDB.get_incomplete_builds()
+            for u in incomplete:
+                u = u.strip('/')
+                baseurl = u[0:u.rfind('/')]
+                bnum = u[u.rfind('/')+1:]
+                self.logger.debug('{} - polling incomplete build'.format(baseurl))
+                self._parse_one_distro(baseurl, bnum, True)
+                if _job_name(baseurl) == _job_name(url):
+                    running.append(int(bnum))
+
+        res = self._get_js(url, params={'tree': 'lastBuild[number]'})
         if not res:
             self.logger.warning('Nothing to do since Jenkins returned empty')
             return
         j = res.json()
         poll_from = int(j['lastBuild']['number'])
+        if cursor:
+            self._poll_from_cursor(url, cursor, poll_from, self._distro_stages(),
+                                   self._distro_pipeline)
+            return
+
         poll_till = 0
         if poll_from > 1500:
             poll_till = poll_from - 1500
 
-        for b in range(poll_from, poll_till, -1):
-            ret = self._parse_one_distro(url, b)
-            if not ret:
-                self.logger.debug('{} - reached latest distro build already saved'.format(url.split('/')[-1]))
-                break
+        def done(item):
+            if _is_running(item['bld_js']):
+                running.append(item['bnum'])
+
+        pipeline = self._distro_pipeline(done)
+        try:
+            pipeline.run(self._build_items(url, poll_from, poll_till, halt=True))
+        finally:
+            self.fetcher.discard()
+        if pipeline.halted_on:
+            self.logger.debug('{} - reached latest distro build already saved'.format(url.split('/')[-1]))
+            done(pipeline.halted_on)
+        self.logger.debug('{} - distro pipeline: {}'.format(url.split('/')[-1], pipeline.stats()))
+
+        self.bldDB.update_cursor(url, poll_from, running=running)
+
+    def _poll_from_cursor(self, url, cursor, poll_from, stages, pipeline, track_running=True):
+        '''
+        Polls a job from its cursor doc instead of walking back from its last
+        build: the builds still running at the last poll and those on its
+        retry list are re-parsed (with update=True) and then only the builds
+        in (last_ingested, poll_from] are run through the ingestion pipeline,
+        oldest first, moving the cursor as each one comes out of it.  Builds
+        that didn't make it (no info from jenkins, failed to parse or save)
+        go on the retry list rather than being skipped.
+        '''
+        job = _job_name(url)
+        for b in list(cursor['running']):
+            self.logger.debug('{} - polling running build {}'.format(job, b))
+            res = self._get_js('{}/{}'.format(url, b))
+            if not res:
+                continue
+            item = self._build_item(url, b, res.json(), update=True)
+            settled = self._run_one(item, stages)
+            if not _is_running(item['bld_js']):
+                if settled:
+                    self.bldDB.update_cursor(url, finished=[b])
+                else:
+                    self.bldDB.update_cursor(url, finished=[b], failed=[b])
+
+        for b in sorted(int(b) for b in cursor.get('retry', {})):
+            self.logger.debug('{} - retrying build {}'.format(job, b))
+            item = self._build_item(url, b, update=True)
+            if not self._run_one(item, stages):
+                self.bldDB.update_cursor(url, failed=[b])
+            elif track_running and _is_running(item['bld_js']):
+                self.bldDB.update_cursor(url, running=[b], retried=[b])
             else:
-                if ret.split('-')[1] == poll_till:
-                    self.logger.debug('{} - reached end'.format(url.split('/')[-1]))
-                    break
+                self.bldDB.update_cursor(url, retried=[b])
 
-    def _parse_one_distro(self, url, bnum, update=False):
-        self.logger.debug('poll_one_distro: url:{}, bnum: {}'.format(url, bnum))
-        bldurl_fmt = '{}/{}'
-        envurl_fmt = '{}/{}/injectedEnvVars'
-        bldurl = bldurl_fmt.format(url, bnum)
-        res = self._get_js(bldurl)
-        if not res:
-            self.logger.warning('no info from jenkins for {}'.format(bldurl))
+        poll_till = cursor['last_ingested']
+        if poll_from <= poll_till:
             return
-        j = res.json()
+        builds = self._list_builds(url, poll_from, poll_till)
+        if builds is None:
+            self.logger.warning('could not list builds of {}; fetching them one by one'.format(url))
+            builds = [(b, None) for b in range(poll_from, poll_till, -1)]
+        else:
+            builds = [(b['number'], b) for b in builds]
+        if not builds:
+            # jenkins listed the range and there is no build in it
+            self.bldDB.update_cursor(url, poll_from)
+            return
+        builds.reverse()
+
+        fed = []
+        def items():
+            for i in range(0, len(builds), self.fetch_batch):
+                batch = builds[i:i + self.fetch_batch]
+                urls = ['{}/{}/injectedEnvVars'.format(url, b) for b, bld_js in batch]
+                urls += ['{}/{}'.format(url, b) for b, bld_js in batch if bld_js is None]
+                self.fetcher.prefetch(urls)
+                for b, bld_js in batch:
+                    item = self._build_item(url, b, bld_js)
+                    fed.append(item)
+                    yield item
+
+        # stages have a single worker, so items come out in the order they
+        # went in: by the time one is done, those before it that aren't
+        # were dropped on the way
+        pending = [0]
+        def upto(item):
+            i = pending[0]
+            while fed[i] is not item:
+                i += 1
+            failed = [f['bnum'] for f in fed[pending[0]:i] if not f['settled']]
+            pending[0] = i + 1
+            return failed
+
+        def done(item):
+            failed = upto(item)
+            running = []
+            if not item['settled']:
+                failed.append(item['bnum'])
+            elif track_running and _is_running(item['bld_js']):
+                running = [item['bnum']]
+            self.bldDB.update_cursor(url, item['bnum'], running=running, failed=failed)
+
+        p = pipeline(done)
+        try:
+            p.run(items())
+        finally:
+            self.fetcher.discard()
+        self.logger.debug('{} - pipeline: {}'.format(job, p.stats()))
+        if pending[0] < len(fed):
+            # dropped after the last one that came out
+            failed = upto(fed[-1]) + [f['bnum'] for f in fed[-1:] if not f['settled']]
+            self.bldDB.update_cursor(url, fed[-1]['bnum'], failed=failed)
+
+    def _run_one(self, item, stages):
+        '''
+        Runs one build through stages; returns whether it is settled: saved,
+        or nothing to do for it.
+        '''
+        try:
+            self._run_stages(item, stages)
+        except Exception:
+            self.logger.error('ingesting {}/{} failed:'.format(item['url'], item['bnum']))
+            self.logger.error(traceback.format_exc())
+        return item['settled']
+
+    def _list_builds(self, url, poll_from, poll_till):
+        '''
+        Lists the builds in (poll_till, poll_from] with tree= queries, newest
+        first; None if the job can't be listed.
+        '''
+        ret = []
+        start = 0
+        size = min(max(poll_from - poll_till, 1), _LIST_PAGE)
+        while True:
+            tree = '%s{%d,%d}' % (_BUILD_TREE, start, start + size)
+            res = self._get_js(url, params={'tree': tree})
+            if not res:
+                return None
+            listed = res.json().get('allBuilds', [])
+            ret += [b for b in listed if poll_till < b['number'] <= poll_from]
+            if len(listed) < size or listed[-1]['number'] <= poll_till + 1:
+                return ret
+            start += size
+            size = _LIST_PAGE
+
+    def _distro_pipeline(self, done=None):
+        return Pipeline('distro', [Stage(name, func) for name, func in self._distro_stages()], done=done)
+
+    def _distro_stages(self):
+        return [('fetch', self._distro_fetch),
+                ('parse', self._distro_parse),
+                ('persist', self._distro_persist)]
+
+    def _parse_one_distro(self, url, bnum, update=False, bld_js=None):
+        item = self._build_item(url, bnum, bld_js, update=update)
+        return self._run_stages(item, self._distro_stages())
+
+    def _distro_fetch(self, item):
+        if self._fetch_build(item) is None:
+            return
+        if not item['env_js']:
+            self.logger.warning('no info from jenkins for {}/{}/injectedEnvVars'.format(item['url'], item['bnum']))
+            return
+        return item
+
+    def _distro_parse(self, item):
+        url = item['url']
+        j = item['bld_js']
         dbuild = {}
         dbuild['timestamp'] = j['timestamp']
         dbuild['duration'] = j['duration']
         dbuild['result'] = j['result']
         dbuild['slave'] = j['builtOn']
         dbuild['type'] = 'distro_level_build'
-        envurl = envurl_fmt.format(url, bnum)
-        res = self._get_js(envurl)
-        if not res:
-            self.logger.warning('no info from jenkins for {}'.format(envurl))
-            return
-        if res:
-            e = res.json()
-            dbuild['build_num'] = int(e['envMap']['BLD_NUM'])
-            dbuild['job_build_num'] = e['envMap']['BUILD_NUMBER']
-            dbuild['version'] = e['envMap']['VERSION']
-            dbuild['unit'] = "false"
-            if e['envMap'].has_key('UNIT_TEST'):
-                dbuild['unit'] = e['envMap']['UNIT_TEST']
-
-            dbuild['edition'] = e['envMap']['EDITION']
-            if url.find('windows') != -1:
-                arch = 'amd64'
-                if e['envMap'].has_key('ARCHITECTURE'):
-                    arch = e['envMap']['ARCHITECTURE']
-                dbuild['distro'] = 'win-' + arch
-            else:
-                if e['envMap'].has_key('DISTRO'):
-                    dbuild['distro'] = e['envMap']['DISTRO']
-                elif e['envMap'].has_key('PLATFORM'):
-                    dbuild['distro'] = e['envMap']['PLATFORM']
+        e = item['env_js']
+        dbuild['build_num'] = int(e['envMap']['BLD_NUM'])
+        dbuild['job_build_num'] = e['envMap']['BUILD_NUMBER']
+        dbuild['version'] = e['envMap']['VERSION']
+        dbuild['unit'] = "false"
+        if e['envMap'].has_key('UNIT_TEST'):
+            dbuild['unit'] = e['envMap']['UNIT_TEST']
+
+        dbuild['edition'] = e['envMap']['EDITION']
+        if url.find('windows') != -1:
+            arch = 'amd64'
+            if e['envMap'].has_key('ARCHITECTURE'):
+                arch = e['envMap']['ARCHITECTURE']
+            dbuild['distro'] = 'win-' + arch
+        else:
+            if e['envMap'].has_key('DISTRO'):
+                dbuild['distro'] = e['envMap']['DISTRO']
+            elif e['envMap'].has_key('PLATFORM'):
+                dbuild['distro'] = e['envMap']['PLATFORM']
 
-            dbuild['url'] = e['envMap']['BUILD_URL']
+        dbuild['url'] = e['envMap']['BUILD_URL']
 
+        item['units'] = []
         for a in j['actions']:
             if a.has_key('totalCount'):
                 dbuild['testcount'] = a['totalCount']
@@ -279,20 +629,28 @@ class BuildPoller():
                 dbuild['skiptests'] = a['skipCount']
                 uniturl = (dbuild['url'] + '/' + a['urlName']).format(dbuild['build_num'])
                 dbuild['test_report_url'] = uniturl
-                tests = self._parse_tests(uniturl)
                 unit = {}
                 unit['build_num'] = dbuild['build_num']
                 unit['version'] = dbuild['version']
                 unit['edition'] = dbuild['edition']
                 unit['distro'] = dbuild['distro']
-                unit['tests'] = tests
                 unit['type'] = 'test_run'
-                self.bldDB.insert_test_history(unit, test_type='unit')
+                stats = self.analytics.run(unit['version'], unit['distro'], unit['edition'], 'unit', unit['build_num'])
+                unit['tests'] = stats.tap(self._parse_tests(uniturl))
+                item['units'].append((unit, stats))
+        item['dbuild'] = dbuild
+        return item
+
+    def _distro_persist(self, item):
+        dbuild = item['dbuild']
+        for unit, stats in item['units']:
+            if self.bldDB.insert_test_history(unit, test_type='unit'):
+                stats.save()
 
         if dbuild['build_num'] in update_distro:
             docid = self.bldDB.insert_distro_history(dbuild, True)
         else:
-            docid = self.bldDB.insert_distro_history(dbuild, update)
+            docid = self.bldDB.insert_distro_history(dbuild, item['update'])
         buildid = dbuild['version'] + '-' + str(dbuild['build_num'])
         current_result = 'incomplete'
         if dbuild['result']:
@@ -300,70 +658,73 @@ class BuildPoller():
                 current_result = 'passed'
             else:
                 current_result = 'failed'
-        if docid:
-            self.bldDB.update_distro_result(buildid, docid, current_result)
-        return docid
+        item['ret'] = docid
+        if not docid:
+            if item['halt']:
+                raise Halt(buildid)
+            return
+        self.bldDB.update_distro_result(buildid, docid, current_result)
+        item['settled'] = True
+        return item
 
     def _parse_tests(self, url, sanity=False):
-        res = self._get_js(url)
+        '''
+        Yields the suites of a test report as they are read off the wire;
+        only the fields kept are asked of Jenkins (testreport.TREE).
+        Nothing is fetched until the first suite is asked for.  A report
+        breaking off half way raises testreport.ReportError.
+        '''
+        res = self.http.get("%s/%s" % (url, "api/json"), params={'tree': testreport.TREE}, stream=True)
         if not res:
             self.logger.warning('no info from jenkins for {}'.format(url))
             return
-        j = res.json()
-        units = []
-        for s in j['suites']:
-            suite = {}
-            suite['suite'] = s['name']
-            suite['duration'] = s['duration']
-            cases = []
-            for c in s['cases']:
-                case = {}
-                if sanity:
-                    n, p = c['name'].split(',', 1)
-                    case['name'] = n
-                    case['params'] = p
-                else:
-                    case['name'] = c['name']
-                    case['params'] = ''
-                case['duration'] = c['duration']
-                case['status'] = c['status']
-                case['failed_since'] = c['failedSince']
-                cases.append(case)
-            suite['cases'] = cases
-            units.append(suite)
-        return units
+        try:
+            for s in testreport.iter_suites(res):
+                suite = {}
+                suite['suite'] = s['name']
+                suite['duration'] = s['duration']
+                cases = []
+                for c in s['cases']:
+                    case = {}
+                    if sanity:
+                        n, p = c['name'].split(',', 1)
+                        case['name'] = n
+                        case['params'] = p
+                    else:
+                        case['name'] = c['name']
+                        case['params'] = ''
+                    case['duration'] = c['duration']
+                    case['status'] = c['status']
+                    case['failed_since'] = c['failedSince']
+                    cases.append(case)
+                suite['cases'] = cases
+                yield suite
+        except (requests.RequestException, ValueError, KeyError) as e:
+            # ijson's parse errors are ValueErrors too
+            raise testreport.ReportError('{}: {}'.format(url, e))
+        finally:
+            res.close()
 
     def _comment_on_ticket(self, commit):
       """
-      Adds a comment from Build Team onto the Jira ticket regarding a commit.
+      Queues a comment from Build Team onto the Jira ticket regarding a commit;
+      the JiraOutbox worker posts it.
       """
       # Don't comment about master builds.
       if commit['in_build'][0].startswith("0.0.0"):
         return
       for ticket in commit['fixes']:
-        jticket = None
-        try:
-          jticket = self.jira.issue(ticket)
-        except JIRAError as e:
-          if e.status_code == 404:
-            self.logger.info("commit references non-existent ticket {}".format(ticket))
-          else:
-            self.logger.warning("error loading JIRA issue {}: {}".format(ticket, e.text))
-
-        if jticket is not None:
-          self.jira.add_comment(jticket,
-            "Build {} contains {} commit {} with commit message:\n{}\n{}".format(
-              commit['in_build'][0],
-              commit['repo'],
-              commit['sha'],
-              commit['message'].split('\n', 1)[0],
-              commit['url']))
+        self.bldDB.enqueue_jira_comment(ticket, commit['in_build'][0], {
+          'repo': commit['repo'],
+          'sha': commit['sha'],
+          'title': commit['message'].split('\n', 1)[0],
+          'url': commit['url'],
+        })
 
     def _handle_commit(self, repo, in_build, c):
       """
-      Constructs a commit object and inserts it into the database.
-      Also updates Jira for any fixed tickets.
-      Returns the new database doc ID.
+      Constructs a commit object; _save_commits inserts all of a build's
+      commits at once and queues Jira updates for any fixed tickets.
       """
       commit = {}
       commit['in_build'] = [in_build]
@@ -377,83 +738,73 @@ class BuildPoller():
       commit['fixes'] = self.get_fixed_jiras(commit['message'])
       self.logger.debug("insert commit {}-{} into db".format(repo, c['sha']))
       self.logger.debug(json.dumps(commit, indent=2))
-      self._comment_on_ticket(commit)
-      return self.bldDB.insert_commit(commit)
+      return commit
 
-    def _commits(self, in_build, man_sha, man_file, branch='master'):
-        self.logger.debug('_commits: in_build {}, man_sha {}, man_file {}'.format(in_build, man_sha, man_file))
+    def _diff_commits(self, in_build, man_sha, man_file, branch='master'):
+        self.logger.debug('_diff_commits: in_build {}, man_sha {}, man_file {}'.format(in_build, man_sha, man_file))
         version, bnum = in_build.split('-')
         prv_bnum = str(int(bnum)-1)
         if special_previous_builds.has_key(bnum):
             prv_bnum = special_previous_builds[bnum]
-        doc = self.bldDB.doc_exists(version + '-' + prv_bnum)
-        if doc:
-            prv_sha = doc.value['manifest_sha']
-        else:
-            prv_sha = man_sha+'~1'
+        prv_build = version + '-' + prv_bnum
+        with self._lock:
+            prv_sha = self._manifest_shas.get(prv_build)
+        if prv_sha is None:
+            doc = self.bldDB.doc_exists(prv_build)
+            if doc:
+                prv_sha = doc.value['manifest_sha']
+            else:
+                prv_sha = man_sha+'~1'
         if not prv_sha:
             prv_sha = man_sha+'~1'
 
-        manifest_mapped_branch = branch
         manifest_mapped_file = man_file
         if btm_manifest_map.has_key(man_file):
-            manifest_mapped_branch = btm_manifest_map[man_file][0]
             manifest_mapped_file = btm_manifest_map[man_file][1]
 
-        _GITREPO.git.checkout(manifest_mapped_branch)
-
-        o = _GITREPO.remotes.origin
-        o.pull()
-        m1 = _GITREPO.git.show("%s:%s" % (man_sha, manifest_mapped_file))
-        m2 = _GITREPO.git.show("%s:%s" % (prv_sha, manifest_mapped_file))
-        mxml1 = ET.fromstring(m1)
-        mxml2 = ET.fromstring(m2)
-        p1list = {}
-        p2list = {}
-        proj1 = mxml1.findall('project')
-        proj2 = mxml2.findall('project')
-        for p in proj1:
-            n = p.get('name')
-            v = p.get('revision')
-            r = p.get('remote') or 'couchbase'
-            p1list[n] = (v,r)
-        for p in proj2:
-            n = p.get('name')
-            v = p.get('revision')
-            r = p.get('remote') or 'couchbase'
-            p2list[n] = (v,r)
-
-        p1projs = p1list.keys()
-        p2projs = p2list.keys()
-        added = [x for x in p1projs if x not in p2projs]
-        deleted = [x for x in p2projs if x not in p1projs]
-        common = [x for x in p1projs if x not in added]
+        p1list, p2list, changed, added, deleted = self.manifests.diff(man_sha, prv_sha, manifest_mapped_file)
 
         repo_changes = []
         repo_added = []
         repo_deleted = []
-        for k in common:
-            if p1list[k][0] == p2list[k][0]:
-                continue
-            giturl = _REMOTES[p1list[k][1]] + k + '/compare/' + p2list[k][0] + '...' + p1list[k][0]
-            res = requests.get(giturl, headers={'Authorization': 'token {}'.format(_GITHUB_TOKEN)})
-            j = res.json()
-            cmts = j['commits']
-            for c in cmts:
+        reqs = []
+        for k in changed:
+            reqs.append((k, _REMOTES[p1list[k][1]] + k + '/', p2list[k][0], p1list[k][0]))
+        for k in added:
+            reqs.append((k, _REMOTES[p1list[k][1]] + k + '/', None, p1list[k][0]))
+        fetched = self.github.fetch(reqs)
+
+        # a build missing a repo's commits is never fixed once saved, so it
+        # isn't: it is left for the cursor to retry
+        for k in changed:
+            if fetched.get(k) is None:
+                raise GitHubError('_diff_commits: no compare info from github for {}'.format(k))
+            for c in fetched[k]:
               repo_changes.append(self._handle_commit(k, in_build, c))
 
         for k in added:
-            giturl = _REMOTES[p1list[k][1]] + k + '/commits?sha=' + p1list[k][0]
-            res = requests.get(giturl, headers={'Authorization': 'token {}'.format(_GITHUB_TOKEN)})
-            j = res.json()
-            for c in j:
+            if fetched.get(k) is None:
+                raise GitHubError('_diff_commits: no commit info from github for {}'.format(k))
+            for c in fetched[k]:
                 repo_added.append(self._handle_commit(k, in_build, c))
 
         for k in deleted:
             self.logger.debug("repo {} was removed in this commit".format(k))
             repo_deleted.append(k)
+
         return repo_changes, repo_added, repo_deleted
 
+    def _save_commits(self, changes, adds):
+        """
+        Inserts a build's commits and queues their Jira comments; returns
+        the ids of the commit docs.
+        """
+        ids = self.bldDB.insert_commits(changes + adds)
+        self.bldDB.index_ticket_commits(changes + adds)
+        for commit in changes + adds:
+            self._comment_on_ticket(commit)
+        return ids
+
 
     def get_fixed_jiras(self, msg):
         fixes = []
@@ -473,7 +824,7 @@ class BuildPoller():
             self.logger.debug('polling incomplete sanity run {}'.format(baseurl))
             self._parse_one_build_sanity(baseurl, bnum)
 
-        res = self._get_js(url)
+        res = self._get_js(url, params={'tree': 'lastBuild[number]'})
         if not res:
             self.logger.warning('_poll_build_sanity: no info from jenkins for {}'.format(url))
             return
@@ -481,20 +832,21 @@ class BuildPoller():
         poll_from = int(j['lastBuild']['number'])
         poll_till = poll_from - 25
 
-        for i in range(poll_from, poll_till, -1):
-            ret = self._parse_one_build_sanity(url, i)
+        for i, bld_js in self._build_window(url, poll_from, poll_till):
+            ret = self._parse_one_build_sanity(url, i, bld_js)
             if ret == "stop":
                 break
 
-    def _parse_one_build_sanity(self, url, jenk_bld):
+    def _parse_one_build_sanity(self, url, jenk_bld, bld_js=None):
         burl = url + '/' + str(jenk_bld)
         env_url = url + '/' + str(jenk_bld) + '/injectedEnvVars'
-        res = self._get_js(burl)
-        if not res:
-            self.logger.warning('_poll_build_sanity: no info from jenkins for {}'.format(url))
-            return "continue"
-
-        j = res.json()
+        j = bld_js
+        if j is None:
+            res = self._get_js(burl)
+            if not res:
+                self.logger.warning('_poll_build_sanity: no info from jenkins for {}'.format(url))
+                return "continue"
+            j = res.json()
 
         res = self._get_js(env_url)
         if not res:
@@ -523,21 +875,24 @@ class BuildPoller():
                 self.logger.debug('_poll_build_sanity: this is a run that is still running {}'.format(burl))
                 return 'continue'
         elif j['building']:
-            bld_doc['sanity_result'] = 'INCOMPLETE'
-            bld_doc['sanity_url'] = burl
+            def mutate(doc):
+                if doc.has_key('sanity_result'):
+                    return False
+                doc['sanity_result'] = 'INCOMPLETE'
+                doc['sanity_url'] = burl
+                return True
             self.logger.debug('update db - incomplete build_sanity for {}'.format(version))
-            self.logger.debug(bld_doc)
-            self.bldDB.insert_build_history(bld_doc, True)
+            self.bldDB.update_build_history(version, mutate)
             return "continue"
 
-        overall_result = 'PASSED' # only centos considered
+        runs = []
         for r in j['runs']:
-            if str(r['number']) != jenk_bld:
+            if str(r['number']) != str(jenk_bld):
                 continue
 
             rurl = r['url']
             res = self._get_js(rurl)
-            j = res.json()
+            rj = res.json()
 
             env_url = r['url'] + 'injectedEnvVars'
             res = self._get_js(env_url)
@@ -548,50 +903,63 @@ class BuildPoller():
                 distro = 'ubuntu14.04'
             elif distro == 'win64':
                 distro = 'win-amd64'
-            clust_type = e['envMap']['TYPE']
+            runs.append((r, rj, distro, e['envMap']['TYPE']))
+
+        # all distro and sanity docs of the runs' distros in two round trips,
+        # rather than a get per run; later runs of the same distro see the
+        # earlier runs' updates through these dicts
+        distro_docs = self.bldDB.get_distro_docs(bld_doc, [run[2] for run in runs], edition)
+        sanity_docs = self.bldDB.get_docs([d + '-sanity-tests' for d in distro_docs.keys()])
 
+        overall_result = 'PASSED' # only centos considered
+        for r, j, distro, clust_type in runs:
             distro_build = version + '-' + distro + '-' + edition
-            dbuild_ret  = self.bldDB.doc_exists(distro_build)
-            if not dbuild_ret:
+            dbuild = distro_docs.get(distro_build)
+            if not dbuild:
                 self.logger.warning('_poll_one_build_sanity: Could not find distro build doc with id {}'.format(distro_build))
                 return 'continue'
 
-
-            dbuild = dbuild_ret.value
-            tc = 0
-            if dbuild.has_key('sanity_testcount'):
-                tc = dbuild['sanity_testcount']
-            fc = 0
-            if dbuild.has_key('sanity_failedtests'):
-                fc = dbuild['sanity_failedtests']
-            sc = 0
-            if dbuild.has_key('sanity_skiptests'):
-                fc = dbuild['sanity_skiptests']
             res_key = 'sanity_result_'+ clust_type
+            counts = None
             for a in j['actions']:
                 if a.has_key('totalCount'):
-                    dbuild['sanity_testcount'] = tc + a['totalCount']
-                    dbuild['sanity_failedtests'] = fc + a['failCount']
-                    dbuild['sanity_skiptests'] = sc + a['skipCount']
-
-                    if j['result'] == 'FAILURE' or j['result'] == 'UNSTABLE':
-                        dbuild[res_key] = 'FAILED'
-                    elif j['result'] == 'SUCCESS':
-                        dbuild[res_key] = 'PASSED'
-                    else:
-                        dbuild[res_key] = 'FAILED'
-                    if distro == 'centos7' and dbuild[res_key] == 'FAILED':
-                        overall_result = 'FAILED'
+                    counts = a
                     break
-
-            sanity_tests = self._parse_tests(r['url'] + 'testReport', sanity=True)
+            run_result = 'FAILED'
+            if j['result'] == 'SUCCESS':
+                run_result = 'PASSED'
+            if counts is not None and distro == 'centos7' and run_result == 'FAILED':
+                overall_result = 'FAILED'
+
+            # counted onto the doc as it is when written: the distro and unit
+            # pollers may update it from other processes in between
+            def mutate_distro(dbuild):
+                if counts is None:
+                    return False
+                tc = 0
+                if dbuild.has_key('sanity_testcount'):
+                    tc = dbuild['sanity_testcount']
+                fc = 0
+                if dbuild.has_key('sanity_failedtests'):
+                    fc = dbuild['sanity_failedtests']
+                sc = 0
+                if dbuild.has_key('sanity_skiptests'):
+                    fc = dbuild['sanity_skiptests']
+                dbuild['sanity_testcount'] = tc + counts['totalCount']
+                dbuild['sanity_failedtests'] = fc + counts['failCount']
+                dbuild['sanity_skiptests'] = sc + counts['skipCount']
+                dbuild[res_key] = run_result
+                return True
+
+            stats = self.analytics.run(ver, distro, edition, 'sanity-' + clust_type, bld)
+            sanity_tests = stats.tap(self._parse_tests(r['url'] + 'testReport', sanity=True))
             stests = {}
             docid = '{}-{}-{}-enterprise-sanity-tests'.format(ver, bld, distro)
-            sdoc = self.bldDB.doc_exists(docid)
+            sdoc = sanity_docs.get(docid)
             update = False
-            if sdoc:
+            if self.bldDB.test_run_saved(sdoc):
                 update = True
-                stests = sdoc.value
+                stests = sdoc
                 stests[clust_type+'_tests'] = sanity_tests
                 if stests['result'] == 'FAILED' or j['result'] == 'FAILED':
                     stests['result'] = 'FAILED'
@@ -605,17 +973,26 @@ class BuildPoller():
                 stests['result'] = j['result']
 
             docId = self.bldDB.insert_test_history(stests, test_type='build_sanity', update=update)
+            if docId:
+                sanity_docs[docId] = stests
+                stats.save()
             self.logger.info('_poll_one_sanity: Added sanity test result for: {}'.format(docId))
             #self.logger.info('Added sanity test result for: {}'.format(json.dumps(stests, indent=1)))
 
-            docId = self.bldDB.insert_distro_history(dbuild, True)
+            docId = None
+            dbuild = self.bldDB.update_distro_history(distro_build, mutate_distro)
+            if dbuild:
+                distro_docs[distro_build] = dbuild
+                docId = distro_build
             self.logger.info('_poll_one_sanity: Updated distro build result for: {}'.format(docId))
             #self.logger.info('Updated distro build result for: {}'.format(json.dumps(dbuild, indent=1)))
 
-        bld_doc['sanity'] = 'true'
-        bld_doc['sanity_url'] = burl
-        bld_doc['sanity_result'] = overall_result
-        docId = self.bldDB.insert_build_history(bld_doc, True)
+        def mutate(doc):
+            doc['sanity'] = 'true'
+            doc['sanity_url'] = burl
+            doc['sanity_result'] = overall_result
+            return True
+        docId = self.bldDB.update_build_history(version, mutate)
         self.logger.info('_poll_one_sanity: Updated build result for {}'.format(docId))
         #self.logger.info('Updated top level build for: {}'.format(json.dumps(bld_doc, indent=1)))
 
@@ -628,7 +1005,7 @@ class BuildPoller():
             self.logger.debug('polling incomplete unit test run {}'.format(url))
             self._parse_one_unit(baseurl, bnum)
 
-        res = self._get_js(url)
+        res = self._get_js(url, params={'tree': 'lastBuild[number]'})
         if not res:
             self.logger.warning('_poll_unit_result: no info from jenkins for {}'.format(url))
             return
@@ -636,20 +1013,21 @@ class BuildPoller():
         poll_from = int(j['lastBuild']['number'])
         poll_till = poll_from - 2
 
-        for i in range(poll_from, poll_till, -1):
-            ret = self._parse_one_unit(url, i)
+        for i, bld_js in self._build_window(url, poll_from, poll_till):
+            ret = self._parse_one_unit(url, i, bld_js)
             if ret == "stop":
                 break
 
-    def _parse_one_unit(self, url, jenk_bld):
+    def _parse_one_unit(self, url, jenk_bld, bld_js=None):
         burl = url + '/' + str(jenk_bld)
         env_url = url + '/' + str(jenk_bld) + '/injectedEnvVars'
-        res = self._get_js(burl)
-        if not res:
-            self.logger.warning('_parse_one_unit: no info from jenkins for {}'.format(url))
-            return "continue"
-
-        j = res.json()
+        j = bld_js
+        if j is None:
+            res = self._get_js(burl)
+            if not res:
+                self.logger.warning('_parse_one_unit: no info from jenkins for {}'.format(url))
+                return "continue"
+            j = res.json()
 
         res = self._get_js(env_url)
         if not res:
@@ -673,72 +1051,74 @@ class BuildPoller():
         distro_build = version + '-' + distro + '-' + edition
 
         docid = distro_build + '-tests'
-        test_doc = self.bldDB.doc_exists(docid)
-        if test_doc:
+        docs = self.bldDB.get_docs([docid, version, distro_build])
+        if self.bldDB.test_run_saved(docs.get(docid)):
             self.logger.debug('_parse_one_unit: reached the unit test run that has already been saved')
             return "stop"
 
-        bld_doc_ret = self.bldDB.doc_exists(version)
-        if not bld_doc_ret:
+        bld_doc = docs.get(version)
+        if not bld_doc:
             self.logger.warning('Could not find build doc with id {}'.format(version))
             return 'continue'
 
-        bld_doc = bld_doc_ret.value
         if j['building']:
-            bld_doc['unit_result'] = 'INCOMPLETE'
-            if bld_doc.has_key('unit_urls'):
-                uurls = bld_doc['unit_urls']
-                found = False
-                for uurl in uurls:
-                    if uurl['url'] == burl:
-                        found = True
-                        break
-                if not found:
-                    bld_doc['unit_urls'].append({"url": burl, "result": "INCOMPLETE"})
-            else:
-                bld_doc['unit_urls'] = [{"url": burl, "result": "INCOMPLETE"}]
+            def mutate(doc):
+                doc['unit_result'] = 'INCOMPLETE'
+                if doc.has_key('unit_urls'):
+                    uurls = doc['unit_urls']
+                    found = False
+                    for uurl in uurls:
+                        if uurl['url'] == burl:
+                            found = True
+                            break
+                    if not found:
+                        doc['unit_urls'].append({"url": burl, "result": "INCOMPLETE"})
+                else:
+                    doc['unit_urls'] = [{"url": burl, "result": "INCOMPLETE"}]
+                return True
             self.logger.debug('update db - incomplete unit tests for {}'.format(version))
-            self.logger.debug(bld_doc)
-            self.bldDB.insert_build_history(bld_doc, True)
+            self.bldDB.update_build_history(version, mutate)
             return "continue"
 
-        dbuild_ret  = self.bldDB.doc_exists(distro_build)
-        if not dbuild_ret:
+        dbuild = docs.get(distro_build)
+        if not dbuild:
             self.logger.warning('_parse_one_unit: Could not find distro build doc with id {}'.format(distro_build))
             return 'continue'
 
-        dbuild = dbuild_ret.value
-        tc = 0
-        if dbuild.has_key('totalcount'):
-            tc = dbuild['totalcount']
-        fc = 0
-        if dbuild.has_key('failedtests'):
-            fc = dbuild['failedtests']
-        sc = 0
-        if dbuild.has_key('skiptests'):
-            fc = dbuild['skiptests']
-
         res_key = 'unit_result'
-        unit_found = False
+        counts = None
         for a in j['actions']:
             if a.has_key('totalCount'):
-                unit_found = True
-                dbuild['testcount'] = tc + a['totalCount']
-                dbuild['failedtests'] = fc + a['failCount']
-                dbuild['skiptests'] = sc + a['skipCount']
-
-                if j['result'] == 'FAILURE' or j['result'] == 'UNSTABLE':
-                    dbuild[res_key] = 'FAILED'
-                elif j['result'] == 'SUCCESS':
-                    dbuild[res_key] = 'PASSED'
-                else:
-                    dbuild[res_key] = 'FAILED'
+                counts = a
                 break
 
-        if not unit_found:
+        if counts is None:
             return
 
-        unit_tests = self._parse_tests(burl + '/testReport')
+        unit_result = 'FAILED'
+        if j['result'] == 'SUCCESS':
+            unit_result = 'PASSED'
+
+        # counted onto the doc as it is when written, not as read above: the
+        # distro poller may update it from another process in between
+        def mutate_distro(dbuild):
+            tc = 0
+            if dbuild.has_key('totalcount'):
+                tc = dbuild['totalcount']
+            fc = 0
+            if dbuild.has_key('failedtests'):
+                fc = dbuild['failedtests']
+            sc = 0
+            if dbuild.has_key('skiptests'):
+                fc = dbuild['skiptests']
+            dbuild['testcount'] = tc + counts['totalCount']
+            dbuild['failedtests'] = fc + counts['failCount']
+            dbuild['skiptests'] = sc + counts['skipCount']
+            dbuild[res_key] = unit_result
+            return True
+
+        stats = self.analytics.run(ver, distro, edition, 'unit', bld)
+        unit_tests = stats.tap(self._parse_tests(burl + '/testReport'))
         utests = {}
         utests['build_num'] = bld
         utests['version'] = ver
@@ -746,36 +1126,42 @@ class BuildPoller():
         utests['distro'] = distro
         utests['type'] = 'test_run'
         utests['tests'] = unit_tests
-        utests['result'] = dbuild[res_key]
+        utests['result'] = unit_result
 
         docId = self.bldDB.insert_test_history(utests)
+        if docId:
+            stats.save()
         self.logger.info('_parse_one_unit: Added unit test result for: {}'.format(docId))
         #self.logger.info('_parse_one_unit: Added unit test result for: {}'.format(json.dumps(utests, indent=1)))
 
-        docId = self.bldDB.insert_distro_history(dbuild, True)
+        docId = None
+        if self.bldDB.update_distro_history(distro_build, mutate_distro):
+            docId = distro_build
         self.logger.info('_parse_one_unit: Updated distro build result for: {}'.format(docId))
         #self.logger.info('_parse_one_unit: Updated distro build result for: {}'.format(json.dumps(dbuild, indent=1)))
 
-        bld_doc['unit'] = 'true'
-        if bld_doc.has_key('unit_urls'):
-            uurls = bld_doc['unit_urls']
-            found = False
-            for uurl in uurls:
-                if uurl['url'] == burl:
-                    uurl["result"] = dbuild[res_key]
-                    found = True
-                    break
-            if not found:
-                bld_doc['unit_urls'].append({"url": burl, "result": dbuild[res_key]})
-        else:
-            bld_doc['unit_urls'] = [{"url": burl, "result": dbuild[res_key]}]
+        def mutate(doc):
+            doc['unit'] = 'true'
+            if doc.has_key('unit_urls'):
+                uurls = doc['unit_urls']
+                found = False
+                for uurl in uurls:
+                    if uurl['url'] == burl:
+                        uurl["result"] = unit_result
+                        found = True
+                        break
+                if not found:
+                    doc['unit_urls'].append({"url": burl, "result": unit_result})
+            else:
+                doc['unit_urls'] = [{"url": burl, "result": unit_result}]
 
-        bld_doc['unit_result'] = 'COMPLETE'
-        for unit in bld_doc['unit_urls']:
-            if unit['result'] == 'INCOMPLETE':
-                bld_doc['unit_result'] = 'INCOMPLETE'
+            doc['unit_result'] = 'COMPLETE'
+            for unit in doc['unit_urls']:
+                if unit['result'] == 'INCOMPLETE':
+                    doc['unit_result'] = 'INCOMPLETE'
+            return True
 
-        docId = self.bldDB.insert_build_history(bld_doc, True)
+        docId = self.bldDB.update_build_history(version, mutate)
         self.logger.info('_parse_one_unit: Updated build result for {}'.format(docId))
         #self.logger.info('_parse_one_unit: Updated top level build for: {}'.format(json.dumps(bld_doc, indent=1)))
 
@@ -806,7 +1192,10 @@ class BuildPoller():
         giturl = 'https://api.github.com/repos/couchbase/build-team-manifests' + '/commits?until={}&&path={}&&sha={}'.format(until, mf, mb)
         self.logger.debug('_get_manifest_sha: polling url: {}'.format(giturl))
 
-        res = requests.get(giturl, headers={'Authorization': 'token {}'.format(_GITHUB_TOKEN)})
+        res = self.github.get(giturl)
+        if not res:
+            self.logger.warning('_get_manifest_sha: no info from github for {}'.format(giturl))
+            return ""
         j = res.json()
         for c in j:
             msg = c['commit']['message']
@@ -841,6 +1230,8 @@ class BuildPoller():
         return logger
 
     def _read_poll_info_from_db(self):
+        # a new poll cycle; build-team-manifests may be fetched once again
+        self.manifests.new_cycle()
         consts = self.bldDB.doc_exists('constants')
         all_rels = self.bldDB.doc_exists('all-releases')
         self.constants = consts.value
@@ -848,22 +1239,87 @@ class BuildPoller():
         self.logger.debug('CONSTANTS: %s' %(str(self.constants)))
         self.logger.debug('ALL_RELEASES: %s' %(str(self.all_releases)))
 
-    def _get_js(self, url, params={"depth" : 0}):
-        res = None
-        for x in range(5):
-            try:
-                res = requests.get("%s/%s" % (url, "api/json"), params = params, timeout=3)
-                if res:
+    def _build_window(self, url, poll_from, poll_till, discard=True):
+        '''
+        Yields (build number, build json) from poll_from down to (excluding)
+        poll_till, newest first.  Builds are listed a page at a time with a
+        tree= query on the job instead of one request per build; pages start
+        small and double up to _LIST_PAGE.  Only the injectedEnvVars, which
+        the listing can't carry, are still fetched per build, a fetch_batch
+        at a time on the fetcher pool ahead of the caller.  If the job can't
+        be listed this falls back to fetching every build on its own.
+        Pipelines pass discard=False, as their fetch stage is still taking
+        from the fetcher after the last build is yielded, and drop whatever
+        is left over themselves.
+        '''
+        start = 0
+        size = 2
+        try:
+            while True:
+                tree = '%s{%d,%d}' % (_BUILD_TREE, start, start + size)
+                res = self._get_js(url, params={'tree': tree})
+                if not res:
                     break
-            except:
-                self.logger.error("url unreachable: %s" % url)
-                time.sleep(5)
+                listed = res.json().get('allBuilds', [])
+                builds = [b for b in listed if poll_till < b['number'] <= poll_from]
+                for i in range(0, len(builds), self.fetch_batch):
+                    batch = builds[i:i + self.fetch_batch]
+                    self.fetcher.prefetch(['{}/{}/injectedEnvVars'.format(url, b['number']) for b in batch])
+                    for b in batch:
+                        yield b['number'], b
+                    poll_from = batch[-1]['number'] - 1
+                if len(listed) < size or listed[-1]['number'] <= poll_till + 1:
+                    return
+                start += size
+                size = min(size * 2, _LIST_PAGE)
+        finally:
+            if discard:
+                self.fetcher.discard()
+
+        self.logger.warning('could not list builds of {}; fetching them one by one'.format(url))
+        for b in self._prefetch_window(url, poll_from, poll_till, discard):
+            yield b, None
+
+    def _prefetch_window(self, url, poll_from, poll_till, discard=True):
+        '''
+        Yields build numbers from poll_from down to (excluding) poll_till, same
+        as range(poll_from, poll_till, -1), while fetching the build and env
+        JSON for the upcoming builds on the fetcher pool.  Batches start small,
+        since usually only a build or two is new, and double up to fetch_batch.
+        The caller's newest-to-oldest, stop-at-first-saved walk is unchanged;
+        whatever was fetched beyond the stopping point is dropped.
+        '''
+        bnums = range(poll_from, poll_till, -1)
+        size = 2
+        try:
+            while bnums:
+                batch, bnums = bnums[:size], bnums[size:]
+                urls = []
+                for b in batch:
+                    urls.append('{}/{}'.format(url, b))
+                    urls.append('{}/{}/injectedEnvVars'.format(url, b))
+                self.fetcher.prefetch(urls)
+                for b in batch:
+                    yield b
+                size = min(size * 2, self.fetch_batch)
+        finally:
+            if discard:
+                self.fetcher.discard()
+
+    def _get_js(self, url, params={"depth" : 0}):
+        if params == {"depth" : 0}:
+            found, res = self.fetcher.take(url)
+            if found:
+                return res
+        return self._fetch_js(url, params)
 
-        return res
+    def _fetch_js(self, url, params={"depth" : 0}):
+        return self.http.get("%s/%s" % (url, "api/json"), params=params, immutable=_jenkins_immutable)
 
 
 if __name__ == "__main__":
     bpoller = BuildPoller()
+    bpoller.bldDB.ensure_ticket_index()
     bpoller.poll()
 
     #bpoller = BuildPoller(log_file="c.log")
@@ -0,0 +1,24 @@
+#!/usr/bin/python
+
+# Shape of the build-summary-<version> docs the poller keeps (DB.update_build_summary)
+# and the restapis build endpoints read.
+
+# newest builds kept in a summary's 'pending' map: with no unit or sanity
+# runs recorded for a version its floor stays at 0, and without a cap every
+# build of the version would pile up in it
+PENDING_BUILDS = 500
+
+def summary_id(version):
+    return 'build-summary-' + version
+
+def prune_pending(summary):
+    '''
+    Drops the pending builds that will never be asked for again: those at
+    or below both last_unit and last_sanity, and all but the newest
+    PENDING_BUILDS.
+    '''
+    floor = min(summary['last_unit'], summary['last_sanity'])
+    bnums = sorted((int(b) for b in summary['pending'].keys()), reverse=True)
+    for i, b in enumerate(bnums):
+        if b <= floor or i >= PENDING_BUILDS:
+            del summary['pending'][str(b)]
@@ -0,0 +1,275 @@
+#!/usr/bin/python
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import traceback
+
+from couchbase.n1ql import N1QLQuery, CONSISTENCY_REQUEST
+from couchbase.exceptions import CouchbaseError
+
+
+logger = logging.getLogger()
+
+TYPES = ('top_level_build', 'distro_level_build', 'commit', 'test_run', 'build_sanity_run')
+# the feed's own bookkeeping, never delivered
+_CHECKPOINT_TYPE = 'changefeed_checkpoint'
+
+class MutationLogSource(object):
+    """
+    Replays a recorded mutation log, one JSON object per line:
+    ``{"seq": 12, "id": "4.7.0-1234", "doc": {...}}`` (``"deleted": true``
+    instead of a doc for deletions), seq going up.  The local stand-in for
+    BucketSource; ChangeFeed.record writes such logs.
+    """
+    # seqs of a log are in order, nothing shows up late
+    overlap = 0
+
+    def __init__(self, path):
+        self.path = path
+
+    def poll(self, since, limit, types=None):
+        ret = []
+        with open(self.path) as F:
+            for line in F:
+                if not line.strip():
+                    continue
+                m = json.loads(line)
+                if m['seq'] <= since:
+                    continue
+                if types and not m.get('deleted') and m['doc'].get('type') not in types:
+                    continue
+                ret.append(m)
+                if len(ret) >= limit:
+                    break
+        return ret
+
+class BucketSource(object):
+    """
+    Tails a bucket by the CAS of its docs (idx_changefeed in the restapis
+    _INDEXES): the docs with a CAS above the last one seen are, roughly,
+    the mutations since.  Only roughly: CAS is a per-node hybrid clock, so
+    a write on one node can carry a lower CAS than one already seen from
+    another, and CAS values are beyond what a JSON double holds exactly.
+    The feed therefore rescans ``overlap`` (in CAS units, nanoseconds) below
+    its checkpoint every time and drops what it already delivered.  Queries
+    are request_plus, so a write isn't missed for not being indexed yet.
+    Deletions aren't seen.
+    """
+    def __init__(self, bucket, overlap=60*10**9):
+        self.bucket = bucket
+        self.overlap = overlap
+
+    def poll(self, since, limit, types=None):
+        q = "SELECT META(b).id AS id, META(b).cas AS seq, b AS doc FROM `build-history` b " \
+            "WHERE META(b).cas > $since AND (b.type IS MISSING OR b.type != $checkpoint)"
+        params = {'since': since, 'limit': limit, 'checkpoint': _CHECKPOINT_TYPE}
+        if types:
+            q += " AND b.type IN $types"
+            params['types'] = list(types)
+        q += " ORDER BY META(b).cas LIMIT $limit"
+        nq = N1QLQuery(q, **params)
+        nq.adhoc = False
+        nq.consistency = CONSISTENCY_REQUEST
+        return list(self.bucket.n1ql_query(nq))
+
+class FileCheckpoint(object):
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as F:
+                return json.load(F)['seq']
+        except (IOError, ValueError, KeyError):
+            return 0
+
+    def save(self, seq):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as F:
+            json.dump({'seq': seq, 'saved': int(time.time())}, F)
+        os.rename(tmp, self.path)
+
+class DocCheckpoint(object):
+    """
+    Keeps a feed's position in a changefeed-<name> doc, so a consumer
+    resumes where it left off from any host.
+    """
+    def __init__(self, db, name):
+        self.db = db
+        self.docId = 'changefeed-' + name
+
+    def load(self):
+        result = self.db.doc_exists(self.docId)
+        if not result:
+            return 0
+        return result.value['seq']
+
+    def save(self, seq):
+        self.db.save_doc(self.docId, {'type': 'changefeed_checkpoint', 'seq': seq, 'saved': int(time.time())})
+
+class ChangeFeed(object):
+    """
+    Fans the mutations of a source out to in-process subscribers, by the
+    ``type`` of the doc, and checkpoints how far it got after every batch.
+
+    Delivery is at least once.  A subscriber raising stops the batch there,
+    and the checkpoint stays below that mutation; the next run delivers it
+    again, to every subscriber of its type, up to max_attempts times before
+    it is logged and skipped.  A crash between delivering and saving the
+    checkpoint also replays.  Within a process, mutations rescanned in the
+    source's overlap window aren't delivered twice.
+    """
+    def __init__(self, source, checkpoint, interval=5, batch=500, max_attempts=5):
+        self.source = source
+        self.checkpoint = checkpoint
+        self.interval = interval
+        self.batch = batch
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._stop = threading.Event()
+        self._seen = {}
+        self._attempts = {}
+        self.seq = None
+        self.delivered = 0
+        self.errors = 0
+        self.skipped = 0
+
+    def subscribe(self, callback, types=None):
+        '''
+        callback(mutation) is called for every mutation of a doc of one of
+        types (all types if None); mutation has id, seq and doc (or deleted).
+        '''
+        with self._lock:
+            self._subscribers.append((callback, set(types or ())))
+
+    def _types(self):
+        with self._lock:
+            if not self._subscribers or [1 for cb, types in self._subscribers if not types]:
+                return None
+            ret = set()
+            for cb, types in self._subscribers:
+                ret |= types
+            return ret
+
+    def _deliver(self, m):
+        '''
+        Returns False if a subscriber failed on m.
+        '''
+        with self._lock:
+            subscribers = list(self._subscribers)
+        t = None
+        if not m.get('deleted'):
+            t = m['doc'].get('type')
+        if t == _CHECKPOINT_TYPE:
+            return True
+        ok = True
+        for cb, types in subscribers:
+            if types and t not in types:
+                continue
+            try:
+                cb(m)
+                self.delivered += 1
+            except Exception:
+                self.errors += 1
+                ok = False
+                logger.error("change feed subscriber failed on {}:".format(m['id']))
+                logger.error(traceback.format_exc())
+        return ok
+
+    def _failed(self, m, key):
+        attempts = self._attempts.get(key, 0) + 1
+        if attempts < self.max_attempts:
+            self._attempts[key] = attempts
+            return False
+        logger.error("change feed giving up on {} after {} attempts".format(m['id'], attempts))
+        self._attempts.pop(key, None)
+        self.skipped += 1
+        return True
+
+    def run_once(self):
+        '''
+        Delivers everything the source has past the checkpoint; returns how
+        many mutations that was.
+        '''
+        if self.seq is None:
+            self.seq = self.checkpoint.load()
+        overlap = getattr(self.source, 'overlap', 0)
+        pos = max(self.seq - overlap, 0)
+        count = 0
+        failed = False
+        while not failed:
+            muts = self.source.poll(pos, self.batch, self._types())
+            for m in muts:
+                key = (m['id'], m['seq'])
+                if self._seen.has_key(key):
+                    continue
+                if not self._deliver(m) and not self._failed(m, key):
+                    # stay below it, so it's delivered again
+                    self.seq = min(self.seq, m['seq'] - 1)
+                    failed = True
+                    break
+                self._attempts.pop(key, None)
+                self._seen[key] = m['seq']
+                self.seq = max(self.seq, m['seq'])
+                count += 1
+            if muts:
+                pos = muts[-1]['seq']
+                self.checkpoint.save(self.seq)
+            if len(muts) < self.batch:
+                break
+
+        for key, seq in self._seen.items():
+            if seq <= self.seq - overlap:
+                del self._seen[key]
+        return count
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except (CouchbaseError, IOError) as e:
+                logger.error("change feed poll failed: {}".format(e))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+        return t
+
+    def stop(self):
+        self._stop.set()
+
+    def record(self, path):
+        '''
+        Subscribes a recorder appending every mutation to a log that
+        MutationLogSource can replay.
+        '''
+        def write(m):
+            with open(path, 'a') as F:
+                F.write(json.dumps(m) + '\n')
+        self.subscribe(write)
+
+
+if __name__ == "__main__":
+    # tail build-history (or replay a mutation log given as argument) and
+    # print what changes
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 1:
+        source = MutationLogSource(sys.argv[1])
+        checkpoint = FileCheckpoint(sys.argv[1] + '.checkpoint')
+    else:
+        from db import DB
+        from bbdb import _BLDHISTORY_BUCKET
+        db = DB(_BLDHISTORY_BUCKET)
+        source = BucketSource(db.db)
+        checkpoint = DocCheckpoint(db, 'cli')
+    feed = ChangeFeed(source, checkpoint)
+    def show(m):
+        print m['seq'], m['id'], m.get('doc', {}).get('type', 'deleted')
+    feed.subscribe(show, TYPES)
+    feed.run()
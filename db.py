@@ -1,7 +1,10 @@
 #!/usr/bin/python
 
 import os
+import time
+import json
 import logging
+import threading
 
 from couchbase.bucket import Bucket
 from couchbase.n1ql import N1QLQuery
@@ -10,13 +13,36 @@ from couchbase.bucket import LOCKMODE_WAIT
 from couchbase.exceptions import CouchbaseError, KeyExistsError, NotFoundError
 from couchbase.views.iterator import RowProcessor
 
+import testcolumns
+import testreport
+from buildsummary import summary_id, prune_pending
+
 
 logger = logging.getLogger()
 
+# How often a CAS-checked read-modify-write is retried before giving up
+_CAS_RETRIES = 10
+# How often a build that failed to ingest is retried from its poll cursor
+_CURSOR_RETRIES = 10
+# Test cases per chunk doc of a test run; keeps docs far below the 20MB limit
+_TEST_CHUNK_CASES = 2000
+# A test run doc still 'writing' after this long (seconds) was left by a
+# poller that died half way and is taken over; it expires on its own later
+_TEST_CLAIM_STALE = 30 * 60
+_TEST_CLAIM_TTL = 6 * 60 * 60
+
+def _is_tests_field(field):
+    return field == 'tests' or field.endswith('_tests')
+
 class DB(object):
-    def __init__(self, bucket):
+    def __init__(self, bucket, compress_tests=True):
         self.bucket = bucket
         self.db = Bucket(bucket, lockmode=LOCKMODE_WAIT)
+        self.compress_tests = compress_tests
+        # called with (version, build_num) after a top level build changed
+        self.on_build_change = None
+        self._names = {}
+        self._names_lock = threading.Lock()
 
     def doc_exists(self, docId):
         try:
@@ -26,6 +52,34 @@ class DB(object):
 
         return result
 
+    def get_docs(self, docIds):
+        '''
+        Fetches many docs in one round trip; returns a dict of docId -> value
+        holding only the docs that exist.
+        '''
+        docIds = list(set(docIds))
+        if not docIds:
+            return {}
+        try:
+            results = self.db.get_multi(docIds, quiet=True)
+        except CouchbaseError as e:
+            logger.warning("Couldn't get all of {0} due to error: {1}".format(docIds, e))
+            results = e.all_results
+        docs = {}
+        for docId, result in results.items():
+            if result.success:
+                docs[docId] = result.value
+        return docs
+
+    def get_distro_docs(self, build, distros, edition='enterprise'):
+        '''
+        Returns a dict of docId -> value of the distro builds of the given
+        distros on the (already loaded) top level build doc, whether or not
+        they made it into its passed/failed/incomplete lists.
+        '''
+        buildId = build['version'] + "-" + str(build['build_num'])
+        return self.get_docs([buildId + "-" + d + "-" + edition for d in distros])
+
     def insert_build_history(self, build, update=False):
         try:
             docId = build['version']+"-"+str(build['build_num'])
@@ -34,6 +88,7 @@ class DB(object):
             else:
                 result = self.db.insert(docId, build)
             logger.debug("{0}".format(result))
+            self.update_build_summary(build)
         except CouchbaseError as e:
             if e.rc == 12: 
                 logger.warning("Couldn't create build history {0} due to error: {1}".format(docId, e))
@@ -41,14 +96,104 @@ class DB(object):
 
         return docId
 
+    def _seed_build_summary(self, version):
+        '''
+        Builds the summary doc of a version that doesn't have one yet from
+        its top level build docs; from then on it is kept up to date by
+        update_build_summary.
+        '''
+        summary = {
+            'type': 'build_summary',
+            'version': version,
+            'last_unit': 0,
+            'last_sanity': 0,
+            'last_sanity_passed': 0,
+            'last_unit_sanity': 0,
+            'last_qe': 0,
+            'pending': {},
+        }
+        q = N1QLQuery("SELECT MAX(CASE WHEN unit = 'true' THEN build_num ELSE 0 END) AS last_unit, "
+                      "MAX(CASE WHEN sanity_result IS NOT MISSING THEN build_num ELSE 0 END) AS last_sanity, "
+                      "MAX(CASE WHEN sanity_result = 'PASSED' THEN build_num ELSE 0 END) AS last_sanity_passed, "
+                      "MAX(CASE WHEN unit = 'true' AND sanity_result = 'PASSED' THEN build_num ELSE 0 END) AS last_unit_sanity, "
+                      "MAX(CASE WHEN qe_sanity = 'true' THEN build_num ELSE 0 END) AS last_qe "
+                      "FROM `build-history` WHERE type = 'top_level_build' AND version = $ver", ver=version)
+        for row in self.db.n1ql_query(q):
+            for k, v in row.items():
+                summary[k] = v or 0
+        q = N1QLQuery("SELECT build_num, unit_result IS NOT MISSING AS unit_result, "
+                      "sanity_result IS NOT MISSING AS sanity_result, "
+                      "(failed = [] AND incomplete = []) AS clean "
+                      "FROM `build-history` WHERE type = 'top_level_build' AND version = $ver AND build_num > $floor",
+                      ver=version, floor=min(summary['last_unit'], summary['last_sanity']))
+        for row in self.db.n1ql_query(q):
+            summary['pending'][str(row['build_num'])] = {
+                'unit_result': row.get('unit_result') is True,
+                'sanity_result': row.get('sanity_result') is True,
+                'clean': row.get('clean') is True,
+            }
+        return summary
+
+    def update_build_summary(self, build):
+        '''
+        Folds a top level build doc, as just written, into the build-summary
+        doc of its version: the last unit tested / sanity tested / sanity
+        passed / QE'd build and the builds still waiting for unit or sanity
+        tests, which is everything the restapis build endpoints answer.
+        '''
+        if build.get('type') != 'top_level_build':
+            return
+        version = build['version']
+        bnum = int(build['build_num'])
+        unit = build.get('unit') == 'true'
+        sanity = build.get('sanity_result')
+
+        def mutate(summary):
+            before = json.dumps(summary, sort_keys=True)
+            for key, cond in (('last_unit', unit),
+                              ('last_sanity', sanity is not None),
+                              ('last_sanity_passed', sanity == 'PASSED'),
+                              ('last_unit_sanity', unit and sanity == 'PASSED'),
+                              ('last_qe', build.get('qe_sanity') == 'true')):
+                if cond and bnum > summary[key]:
+                    summary[key] = bnum
+            summary['pending'][str(bnum)] = {
+                'unit_result': build.has_key('unit_result'),
+                'sanity_result': sanity is not None,
+                'clean': build.get('failed') == [] and build.get('incomplete') == [],
+            }
+            prune_pending(summary)
+            return json.dumps(summary, sort_keys=True) != before
+
+        docId = summary_id(version)
+        initial = None
+        current = self.doc_exists(docId)
+        if not current:
+            current = None
+            initial = self._seed_build_summary(version)
+            mutate(initial)
+        if not self._mutate(docId, mutate, initial=initial, current=current):
+            logger.warning("Couldn't update build summary {0}".format(docId))
+        if self.on_build_change:
+            try:
+                self.on_build_change(version, bnum)
+            except Exception as e:
+                logger.warning("build change hook failed for {0}-{1}: {2}".format(version, bnum, e))
+
     def insert_distro_history(self, distro, update=False):
         try:
             docId = distro['version']+"-"+str(distro['build_num'])+"-"+distro['distro']+"-"+distro['edition']
             if update:
-                result = self.db.upsert(docId, distro)
+                # merged into what's there: the unit and sanity pollers add
+                # their results to the same doc from other processes
+                def merge(doc):
+                    doc.update(distro)
+                    return True
+                if not self._mutate(docId, merge, initial=distro):
+                    docId = None
             else:
                 result = self.db.insert(docId, distro)
-            logger.debug("{0}".format(result))
+                logger.debug("{0}".format(result))
         except CouchbaseError as e:
             if e.rc == 12:
                 logger.warning("Couldn't create distro history {0} due to error: {1}".format(docId, e))
@@ -56,62 +201,558 @@ class DB(object):
 
         return docId
 
+    def update_distro_history(self, docId, mutate):
+        '''
+        Sets fields of an existing distro build doc through mutate (see
+        _mutate).  Returns the updated doc, or None if it couldn't be.
+        '''
+        updated = []
+        def wrapped(ret):
+            del updated[:]
+            updated.append(ret)
+            return mutate(ret)
+
+        if not self._mutate(docId, wrapped) or not updated:
+            logger.warning("Couldn't update distro history {0}".format(docId))
+            return None
+        return updated[0]
+
     def insert_test_history(self, unit, test_type='unit', update=False):
+        '''
+        Saves a test run.  The suites of the run ('tests', or '<cluster>_tests'
+        for sanity runs, either a list or a generator streaming them in) are
+        written to chunk docs as they come, and the run doc only keeps a
+        summary of them; get_test_history puts a run back together.
+
+        Chunks are columnar: suite, case and params names are interned in
+        a per-version name dictionary doc (testnames-<version>) and each
+        chunk holds arrays of name ids, status codes, durations (in ms) and
+        failed_since build numbers, see testcolumns.
+        '''
         try:
             if test_type == 'unit':
                 docId = unit['version']+"-"+str(unit['build_num'])+"-"+unit['distro']+"-"+unit['edition']+'-tests'
             elif test_type == 'build_sanity':
                 docId = unit['version']+"-"+str(unit['build_num'])+"-"+unit['distro']+"-"+unit['edition']+'-sanity-tests'
 
-            if update:
-                result = self.db.upsert(docId, unit)
-            else:
-                result = self.db.insert(docId, unit)
+            fields = [f for f in unit.keys() if _is_tests_field(f) and not isinstance(unit[f], dict)]
+            if not update:
+                # claimed before any chunk is written, so a run polled twice
+                # stops here rather than leaving the second one's chunks behind
+                claim = dict((k, v) for k, v in unit.items() if not k in fields)
+                self._claim_test_run(docId, claim)
+
+            written = []
+            try:
+                for field in fields:
+                    unit[field] = self._write_test_chunks(docId, unit['version'], field, unit[field] or [])
+                    written.append(field)
+            except Exception as e:
+                self._remove_docs([self._test_chunk_id(docId, f, i)
+                                   for f in written for i in range(unit[f]['chunks'])])
+                if not update:
+                    self._remove_docs([docId])
+                if not isinstance(e, (testreport.ReportError, CouchbaseError)):
+                    raise
+                logger.warning("Couldn't save test run {0}: {1}".format(docId, e))
+                return None
+
+            result = self.db.upsert(docId, unit)
             logger.debug("{0}".format(result))
         except CouchbaseError as e:
             if e.rc == 12:
                 logger.warning("Couldn't create test history {0} due to error: {1}".format(docId, e))
-                docId = None
+            docId = None
 
         return docId
 
-    def insert_commit(self, commit):
-        docId = commit['repo']+"-"+str(commit['sha'])
-        inb = commit['in_build'][0]
+    def _claim_test_run(self, docId, claim):
+        claim['state'] = 'writing'
+        claim['claimed'] = int(time.time())
         try:
+            self.db.insert(docId, claim, ttl=_TEST_CLAIM_TTL)
+        except KeyExistsError:
             result = self.db.get(docId)
-            val = result.value
-            if not inb in val['in_build']:
-                val['in_build'].append(inb)
-                result = self.db.upsert(docId, val)
+            if not self._stale_test_claim(result.value):
+                raise
+            logger.info("Taking over stale test run claim {0}".format(docId))
+            self.db.replace(docId, claim, cas=result.cas, ttl=_TEST_CLAIM_TTL)
+
+    def _stale_test_claim(self, doc):
+        return doc.get('state') == 'writing' and doc.get('claimed', 0) < time.time() - _TEST_CLAIM_STALE
+
+    def test_run_saved(self, doc):
+        '''
+        Whether a test run doc as read back is a saved run, rather than
+        missing or the claim of a run still (or no longer) being written.
+        '''
+        return bool(doc) and doc.get('state') != 'writing'
+
+    def _remove_docs(self, docIds):
+        if not docIds:
+            return
+        try:
+            self.db.remove_multi(docIds, quiet=True)
         except CouchbaseError as e:
-            if e.rc == 13:
-                try: 
-                    result = self.db.insert(docId, commit)
+            logger.warning("Couldn't remove all of {0}: {1}".format(docIds, e))
+
+    def _test_chunk_id(self, docId, field, seq):
+        return '{}::{}::{}'.format(docId, field, seq)
+
+    def _test_names_id(self, version):
+        return 'testnames-' + version
+
+    def test_names(self, version, refresh=False):
+        '''
+        Returns the test name dictionary of a version: the list of
+        [suite, name, params] a name id indexes, and the reverse mapping.
+        '''
+        with self._names_lock:
+            names = self._names.get(version)
+        if names is None or refresh:
+            docId = self._test_names_id(version)
+            doc = self.get_docs([docId]).get(docId)
+            entries = []
+            if doc:
+                entries = doc['names']
+            names = (entries, dict((tuple(e), i) for i, e in enumerate(entries)))
+            with self._names_lock:
+                self._names[version] = names
+        return names
+
+    def intern_tests(self, version, keys):
+        '''
+        Maps (suite, name, params) keys to their ids in the name dictionary
+        of version, adding the ones it doesn't have yet.
+        '''
+        entries, index = self.test_names(version)
+        missing = []
+        for k in keys:
+            if not index.has_key(k) and not k in missing:
+                missing.append(k)
+        if missing:
+            def mutate(doc):
+                known = set(tuple(e) for e in doc['names'])
+                new = [list(k) for k in missing if not k in known]
+                doc['names'] += new
+                return len(new) > 0
+            initial = {'type': 'test_names', 'version': version, 'names': [list(k) for k in missing]}
+            if not self._mutate(self._test_names_id(version), mutate, initial=initial):
+                raise CouchbaseError("couldn't add test names of {0}".format(version))
+            entries, index = self.test_names(version, refresh=True)
+        return [index[k] for k in keys]
+
+    def update_test_stats(self, docId, mutate, initial):
+        '''
+        CAS update of a teststats doc, see testanalytics.TestAnalytics.
+        '''
+        return self._mutate(docId, mutate, initial=initial)
+
+    def _write_test_chunks(self, docId, version, field, suites):
+        '''
+        Writes suites to chunk docs of _TEST_CHUNK_CASES cases each, a big
+        suite being split across chunks; returns the summary kept in the
+        run doc.
+        '''
+        summary = {'chunks': 0, 'suites': 0, 'cases': 0, 'failed': 0,
+                   'names': self._test_names_id(version)}
+        chunk = []
+        size = 0
+
+        def flush(chunk):
+            doc = testcolumns.encode(chunk, lambda keys: self.intern_tests(version, keys),
+                                     self.compress_tests)
+            doc.update({
+                'type': 'test_chunk',
+                'run': docId,
+                'field': field,
+                'seq': summary['chunks'],
+            })
+            self.db.upsert(self._test_chunk_id(docId, field, summary['chunks']), doc)
+            summary['chunks'] += 1
+
+        try:
+            for s in suites:
+                summary['suites'] += 1
+                cases = s['cases']
+                summary['cases'] += len(cases)
+                summary['failed'] += len([c for c in cases if c['status'] in ('FAILED', 'REGRESSION')])
+                part = dict(s)
+                first = True
+                while True:
+                    part['cases'] = cases[:_TEST_CHUNK_CASES - size]
+                    cases = cases[len(part['cases']):]
+                    if not first:
+                        part['continued'] = True
+                    chunk.append(part)
+                    size += len(part['cases'])
+                    if size < _TEST_CHUNK_CASES:
+                        break
+                    flush(chunk)
+                    chunk = []
+                    size = 0
+                    if not cases:
+                        break
+                    part = {'suite': s['suite']}
+                    first = False
+            if chunk:
+                flush(chunk)
+        except Exception:
+            # a report that broke off half way: none of it is kept
+            self._remove_docs([self._test_chunk_id(docId, field, i) for i in range(summary['chunks'])])
+            raise
+        return summary
+
+    def _read_test_chunk(self, chunk, version):
+        if not chunk.has_key('cases'):
+            # written before chunks went columnar
+            return chunk['suites']
+        entries, index = self.test_names(version)
+        ids = testcolumns.unpack(chunk['cases']['id'])
+        if ids and max(ids) >= len(entries):
+            entries, index = self.test_names(version, refresh=True)
+        return testcolumns.decode(chunk, entries)
+
+    def get_test_history(self, docId):
+        '''
+        Returns a test run doc with its chunked suites read back in, in the
+        shape it was handed to insert_test_history; None if there is none.
+        '''
+        run = self.get_docs([docId]).get(docId)
+        if run is None:
+            return None
+        for field, summary in run.items():
+            if not (_is_tests_field(field) and isinstance(summary, dict)):
+                continue
+            ids = [self._test_chunk_id(docId, field, i) for i in range(summary['chunks'])]
+            chunks = self.get_docs(ids)
+            suites = []
+            for i in ids:
+                if not chunks.has_key(i):
+                    logger.warning("test run {0} is missing chunk {1}".format(docId, i))
+                    continue
+                for s in self._read_test_chunk(chunks[i], run['version']):
+                    if s.pop('continued', False) and suites and suites[-1]['suite'] == s['suite']:
+                        suites[-1]['cases'] += s['cases']
+                    else:
+                        suites.append(s)
+            run[field] = suites
+        return run
+
+    def _mutate(self, docId, mutate, initial=None, current=None):
+        '''
+        Read-modify-write of docId that is safe against concurrent writers.
+        mutate(value) changes value in place and returns False if there was
+        nothing to change.  The write is a CAS-checked replace; when another
+        writer got in between, the doc is re-read and mutate applied again.
+        A missing doc is inserted as initial (if given).  current is an
+        already fetched result to start from.  Returns True on success.
+        '''
+        for attempt in range(_CAS_RETRIES):
+            try:
+                if current is None:
+                    current = self.db.get(docId)
+                val = current.value
+                if not mutate(val):
+                    return True
+                result = self.db.replace(docId, val, cas=current.cas)
+                logger.debug("{0}".format(result))
+                return True
+            except KeyExistsError:
+                logger.debug("{0} changed underneath us, retrying".format(docId))
+            except NotFoundError:
+                if initial is None:
+                    logger.warning("Couldn't update {0}: not found".format(docId))
+                    return False
+                try:
+                    result = self.db.insert(docId, initial)
                     logger.debug("{0}".format(result))
-                except CouchbaseError as e:
-                    print e.rc
-                    if e.rc == 12: 
-                        logger.error("Couldn't create commit history {0} due to error: {1}".format(docId, e))
-                        docId = None
+                    return True
+                except KeyExistsError:
+                    logger.debug("{0} created underneath us, retrying".format(docId))
+            except CouchbaseError as e:
+                logger.warning("Couldn't update {0} due to error: {1}".format(docId, e))
+                return False
+            current = None
+
+        logger.error("Couldn't update {0}: gave up after {1} tries".format(docId, _CAS_RETRIES))
+        return False
+
+    def _add_in_build(self, in_build):
+        def mutate(val):
+            added = False
+            for inb in in_build:
+                if not inb in val['in_build']:
+                    val['in_build'].append(inb)
+                    added = True
+            return added
+        return mutate
+
+    def insert_commit(self, commit):
+        docId = commit['repo']+"-"+str(commit['sha'])
+        if not self._mutate(docId, self._add_in_build(commit['in_build']), initial=commit):
+            logger.error("Couldn't create commit history {0}".format(docId))
+            docId = None
 
         return docId
 
-    def update_distro_result(self, docId, distroId, result):
+    def insert_commits(self, commits):
+        '''
+        Bulk version of insert_commit: one multi-get to find the commits that
+        are already known and one multi-insert for the new ones.  Known
+        commits, and new ones another poller inserted first, go through the
+        CAS-checked path of insert_commit.
+        Returns the docIds in the order of commits, None for failed ones.
+        '''
+        docIds = []
+        new = {}
+        for commit in commits:
+            docId = commit['repo']+"-"+str(commit['sha'])
+            docIds.append(docId)
+            if new.has_key(docId):
+                self._add_in_build(commit['in_build'])(new[docId])
+            else:
+                new[docId] = commit
+
+        if not new:
+            return docIds
         try:
-            ret = self.db.get(docId).value
+            existing = self.db.get_multi(new.keys(), quiet=True)
+        except CouchbaseError as e:
+            existing = e.all_results
+
+        to_insert = {}
+        to_mutate = {}
+        for docId, commit in new.items():
+            result = existing.get(docId)
+            if result is not None and result.success:
+                to_mutate[docId] = result
+            else:
+                to_insert[docId] = commit
+
+        if to_insert:
+            try:
+                result = self.db.insert_multi(to_insert)
+                logger.debug("{0}".format(result))
+            except CouchbaseError as e:
+                for docId, result in e.all_results.items():
+                    if not result.success:
+                        to_mutate[docId] = None
+
+        failed = set()
+        for docId, current in to_mutate.items():
+            if not self._mutate(docId, self._add_in_build(new[docId]['in_build']),
+                                initial=new[docId], current=current):
+                logger.error("Couldn't create commit history {0}".format(docId))
+                failed.add(docId)
+
+        return [None if docId in failed else docId for docId in docIds]
+
+    def update_distro_result(self, docId, distroId, result):
+        updated = []
+        def mutate(ret):
+            del updated[:]
+            updated.append(ret)
+            changed = False
             if not distroId in ret[result]:
                 ret[result].append(distroId)
+                changed = True
             if result != 'incomplete':
                 if distroId in ret['incomplete']:
                     ret['incomplete'].remove(distroId)
-            self.db.upsert(docId, ret)
+                    changed = True
+            return changed
+
+        if not self._mutate(docId, mutate):
+            logger.warning("Couldn't update distro result on {0}".format(docId))
+        elif updated:
+            self.update_build_summary(updated[0])
+
+        return
+
+    def update_build_history(self, docId, mutate):
+        '''
+        Sets fields of an existing top level build doc through mutate (see
+        _mutate), instead of writing back a copy read earlier, which would
+        drop the distro results and commits recorded on it in between.
+        Returns docId, or None if the doc couldn't be updated.
+        '''
+        updated = []
+        def wrapped(ret):
+            del updated[:]
+            if mutate(ret) is False:
+                return False
+            updated.append(ret)
+            return True
+
+        if not self._mutate(docId, wrapped):
+            logger.warning("Couldn't update build history {0}".format(docId))
+            return None
+        if updated:
+            self.update_build_summary(updated[0])
+        return docId
+
+    def _cursor_id(self, job_url):
+        return 'cursor-' + job_url.strip('/').split('/job/')[-1]
+
+    def get_cursor(self, job_url):
+        result = self.doc_exists(self._cursor_id(job_url))
+        if not result:
+            return None
+        return result.value
+
+    def update_cursor(self, job_url, last_ingested=None, running=(), finished=(), failed=(), retried=()):
+        '''
+        Atomically moves the poll cursor of a Jenkins job: last_ingested only
+        ever goes up, builds in running are added to the still-running set
+        and builds in finished are taken out of it.  Builds in failed go on
+        the retry list (or have their attempts counted up), those in retried
+        come off it; a build failing _CURSOR_RETRIES times is given up on.
+        '''
+        initial = {
+            'type': 'poll_cursor',
+            'url': job_url,
+            'last_ingested': last_ingested or 0,
+            'running': sorted(set(running)),
+            'retry': dict((str(b), 1) for b in failed),
+        }
+        def mutate(cur):
+            changed = False
+            if last_ingested is not None and last_ingested > cur['last_ingested']:
+                cur['last_ingested'] = last_ingested
+                changed = True
+            for b in running:
+                if not b in cur['running']:
+                    cur['running'].append(b)
+                    changed = True
+            for b in finished:
+                if b in cur['running']:
+                    cur['running'].remove(b)
+                    changed = True
+            retry = cur.setdefault('retry', {})
+            for b in failed:
+                attempts = retry.get(str(b), 0) + 1
+                if attempts > _CURSOR_RETRIES:
+                    logger.warning("giving up on build {0} of {1} after {2} attempts".format(b, job_url, attempts - 1))
+                    del retry[str(b)]
+                else:
+                    retry[str(b)] = attempts
+                changed = True
+            for b in retried:
+                if retry.has_key(str(b)):
+                    del retry[str(b)]
+                    changed = True
+            return changed
+
+        return self._mutate(self._cursor_id(job_url), mutate, initial=initial)
+
+    def _ticket_id(self, ticket):
+        return 'ticket-' + ticket
+
+    def index_ticket_commits(self, commits):
+        '''
+        Adds commits to the ticket-<ID> doc of every ticket they fix, the
+        inverted index /builds/hasticket reads: the (repo, sha, in_build)
+        of each commit and all builds the ticket's commits are in.
+        '''
+        by_ticket = {}
+        for c in commits:
+            for t in c.get('fixes') or []:
+                by_ticket.setdefault(t, []).append(c)
+
+        for ticket, cmts in by_ticket.items():
+            def mutate(doc, cmts=cmts):
+                changed = False
+                for c in cmts:
+                    entry = None
+                    for e in doc['commits']:
+                        if e['repo'] == c['repo'] and e['sha'] == c['sha']:
+                            entry = e
+                            break
+                    if entry is None:
+                        entry = {'repo': c['repo'], 'sha': c['sha'], 'in_build': []}
+                        doc['commits'].append(entry)
+                        changed = True
+                    for b in c['in_build']:
+                        if not b in entry['in_build']:
+                            entry['in_build'].append(b)
+                            changed = True
+                        if not b in doc['builds']:
+                            doc['builds'].append(b)
+                            changed = True
+                return changed
+
+            initial = {'type': 'ticket', 'ticket': ticket, 'commits': [], 'builds': []}
+            mutate(initial)
+            if not self._mutate(self._ticket_id(ticket), mutate, initial=initial):
+                logger.warning("Couldn't index commits of ticket {0}".format(ticket))
+
+        return sorted(by_ticket.keys())
+
+    def backfill_ticket_index(self):
+        '''
+        Builds the ticket docs and the per build tickets lists from the
+        commits already stored; safe to run again.  Leaves a ticket-index
+        doc behind so readers know the index is complete.
+        '''
+        q = N1QLQuery("SELECT c.repo, c.sha, c.in_build, c.fixes FROM `build-history` c "
+                      "WHERE c.type = 'commit' AND ARRAY_LENGTH(c.fixes) > 0")
+        commits = []
+        for row in self.db.n1ql_query(q):
+            commits.append(row)
+        self.index_ticket_commits(commits)
+
+        builds = {}
+        for c in commits:
+            for b in c['in_build']:
+                builds.setdefault(b, set()).update(c['fixes'])
+        for b, tickets in builds.items():
+            def mutate(doc, tickets=tickets):
+                have = set(doc.get('tickets', []))
+                if tickets <= have:
+                    return False
+                doc['tickets'] = sorted(have | tickets)
+                return True
+            self._mutate(b, mutate)
+
+        logger.info("indexed {0} commits fixing tickets in {1} builds".format(len(commits), len(builds)))
+        return self.save_doc('ticket-index', {'type': 'ticket_index', 'built': int(time.time())})
+
+    def ensure_ticket_index(self, lock_ttl=6*60*60):
+        '''
+        Runs backfill_ticket_index once per bucket: not at all when the
+        ticket-index doc says it's done, and only in the process that gets
+        to insert the ticket-index-lock doc otherwise (which expires, should
+        that process die half way).  Returns whether the index is complete.
+        '''
+        if self.doc_exists('ticket-index'):
+            return True
+        try:
+            self.db.insert('ticket-index-lock', {'type': 'ticket_index_lock', 'started': int(time.time())},
+                           ttl=lock_ttl)
+        except KeyExistsError:
+            logger.info("ticket index is being built elsewhere")
+            return False
+        except CouchbaseError as e:
+            logger.warning("Couldn't lock ticket index backfill: {0}".format(e))
+            return False
+        try:
+            return self.backfill_ticket_index() is not None
+        finally:
+            try:
+                self.db.remove('ticket-index-lock')
+            except CouchbaseError:
+                pass
+
+    def save_doc(self, docId, doc):
+        try:
+            result = self.db.upsert(docId, doc)
             logger.debug("{0}".format(result))
         except CouchbaseError as e:
-            logger.warning("Couldn't update distro result on {0} due to error: {1}".format(docId, e))
+            logger.warning("Couldn't save {0} due to error: {1}".format(docId, e))
             docId = None
 
-        return
+        return docId
 
     def get_incomplete_builds(self):
         q = N1QLQuery("select url from `build-history` where result is NULL")
@@ -136,3 +777,85 @@ class DB(object):
                 if u['result'] == 'INCOMPLETE':
                     urls.append(u['url'])
         return urls
+
+    def enqueue_jira_comment(self, ticket, in_build, commit):
+        '''
+        Queues a Jira comment about commit (a dict with repo, sha, title and
+        url) being in build in_build.  There is one outbox doc per ticket
+        and build; commits already on it are not added twice.
+        '''
+        docId = 'jira-outbox-'+ticket+'-'+in_build
+        initial = {
+            'type': 'jira_outbox',
+            'ticket': ticket,
+            'in_build': in_build,
+            'commits': [commit],
+            'sent': [],
+            'state': 'pending',
+            'attempts': 0,
+            'next_try': 0,
+        }
+        def mutate(doc):
+            for c in doc['commits']:
+                if c['sha'] == commit['sha']:
+                    return False
+            doc['commits'].append(commit)
+            if doc['state'] != 'sending':
+                doc['state'] = 'pending'
+            return True
+
+        if not self._mutate(docId, mutate, initial=initial):
+            docId = None
+        return docId
+
+    def get_pending_jira_comments(self, limit=50, stale=600):
+        '''
+        Outbox docs due to be sent, including ones claimed by a sender that
+        hasn't finished them in stale seconds.
+        '''
+        now = int(time.time())
+        q = N1QLQuery("SELECT META(b).id AS id, b.* FROM `build-history` b WHERE b.type = 'jira_outbox' AND "
+                      "((b.state = 'pending' AND b.next_try <= $now) OR (b.state = 'sending' AND b.claimed < $stale)) "
+                      "LIMIT $limit", now=now, stale=now - stale, limit=limit)
+        docs = []
+        for row in self.db.n1ql_query(q):
+            docs.append(row)
+        return docs
+
+    def claim_jira_comment(self, docId, stale=600):
+        '''
+        Marks an outbox doc as being sent; False if another sender got it.
+        '''
+        claimed = []
+        def mutate(doc):
+            now = int(time.time())
+            if doc['state'] == 'pending' or (doc['state'] == 'sending' and doc.get('claimed', 0) < now - stale):
+                doc['state'] = 'sending'
+                doc['claimed'] = now
+                claimed.append(docId)
+                return True
+            return False
+
+        return self._mutate(docId, mutate) and bool(claimed)
+
+    def finish_jira_comment(self, docId, sent=(), state='sent', next_try=0, error=''):
+        '''
+        Records the outcome of sending an outbox doc: the shas now commented
+        on, and its next state ('sent', 'pending' for a retry at next_try,
+        'missing' or 'failed').  Commits queued while it was being sent put
+        it back to pending.
+        '''
+        def mutate(doc):
+            for sha in sent:
+                if not sha in doc['sent']:
+                    doc['sent'].append(sha)
+            doc['state'] = state
+            if state == 'pending':
+                doc['attempts'] += 1
+                doc['next_try'] = next_try
+            if state == 'sent' and [c for c in doc['commits'] if not c['sha'] in doc['sent']]:
+                doc['state'] = 'pending'
+            doc['error'] = error
+            return True
+
+        return self._mutate(docId, mutate)
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+import logging
+import threading
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+
+logger = logging.getLogger()
+
+class Fetcher(object):
+    """
+    Fetches many URLs at once on a bounded pool of worker threads.
+
+    ``get`` is the callable doing the actual request for one URL; it must
+    return the response (or None) and never raise.  At most ``per_host``
+    requests are in flight against any single host, whatever the pool size.
+
+    Results fetched through ``prefetch`` are parked until ``take`` claims
+    them, so callers can keep walking builds one at a time while the
+    network work for the next ones has already been done.
+    """
+    def __init__(self, get, workers=8, per_host=4):
+        self.get = get
+        self.workers = workers
+        self.per_host = per_host
+        self.pool = ThreadPool(workers)
+        self._lock = threading.Lock()
+        self._host_limits = {}
+        self._prefetched = {}
+
+    def _host_limit(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            if not self._host_limits.has_key(host):
+                self._host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_limits[host]
+
+    def _fetch(self, url):
+        with self._host_limit(url):
+            try:
+                return url, self.get(url)
+            except Exception as e:
+                logger.error("fetch of {} failed: {}".format(url, e))
+                return url, None
+
+    def fetch_all(self, urls):
+        """
+        Fetches all ``urls`` concurrently; returns a dict of url -> response.
+        """
+        if not urls:
+            return {}
+        return dict(self.pool.map(self._fetch, urls))
+
+    def prefetch(self, urls):
+        with self._lock:
+            todo = [u for u in urls if not self._prefetched.has_key(u)]
+        fetched = self.fetch_all(todo)
+        with self._lock:
+            self._prefetched.update(fetched)
+
+    def take(self, url):
+        """
+        Returns ``(True, response)`` if ``url`` was prefetched, ``(False, None)``
+        otherwise.  A prefetched response is handed out only once.
+        """
+        with self._lock:
+            if self._prefetched.has_key(url):
+                return True, self._prefetched.pop(url)
+        return False, None
+
+    def discard(self):
+        with self._lock:
+            self._prefetched.clear()
+
+    def close(self):
+        self.discard()
+        self.pool.close()
+        self.pool.join()
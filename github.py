@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+import re
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from lru import LRUCache
+
+
+logger = logging.getLogger()
+
+_SHA_PATTERN = r'^[0-9a-f]{40}$'
+_PER_PAGE = 100
+
+def _is_sha(rev):
+    return re.match(_SHA_PATTERN, rev or '') is not None
+
+class GitHubError(Exception):
+    """
+    Raised when the commits of a repo couldn't be had from GitHub.
+    """
+    pass
+
+class GitHubCommits(object):
+    """
+    Fetches the commits between manifest revisions from the GitHub API.
+
+    Compares are fetched concurrently on a small thread pool and followed
+    through every page (a single compare response stops at 250 commits).
+    The commits between two SHAs are cached by (repo, base, head), up to
+    cache_size commits in all, so release lines sharing repos at the same
+    revisions don't re-fetch the same history; a range that merely
+    overlaps a cached one is fetched whole, as GitHub can't be asked for
+    only the commits missing from it.  The rate limit headers of every response
+    are tracked; ``throttle`` waits for the reset when headroom runs low.
+    """
+    def __init__(self, http, workers=4, cache_size=20000, min_remaining=100):
+        self.http = http
+        self.pool = ThreadPool(workers)
+        self.min_remaining = min_remaining
+        self.ranges = LRUCache(cache_size, sizeof=lambda cmts: max(len(cmts), 1))
+        self._lock = threading.Lock()
+        self._rate = {'limit': None, 'remaining': None, 'reset': None}
+
+    def get(self, url, immutable=False):
+        res = self.http.get(url, immutable=immutable)
+        if res is not None and res.headers.get('X-RateLimit-Remaining') is not None:
+            with self._lock:
+                self._rate['limit'] = int(res.headers.get('X-RateLimit-Limit', 0))
+                self._rate['remaining'] = int(res.headers['X-RateLimit-Remaining'])
+                self._rate['reset'] = int(res.headers.get('X-RateLimit-Reset', 0))
+        return res
+
+    def rate_limit(self):
+        with self._lock:
+            return dict(self._rate)
+
+    def throttle(self, needed=0):
+        """
+        Sleeps until the rate limit resets if fewer than min_remaining (plus
+        needed) requests are left in the current window.
+        """
+        rate = self.rate_limit()
+        if rate['remaining'] is None or rate['remaining'] >= self.min_remaining + needed:
+            return
+        wait = max(rate['reset'] - time.time(), 0) + 1
+        logger.warning("GitHub rate limit low ({} left); waiting {}s for reset".format(rate['remaining'], int(wait)))
+        time.sleep(wait)
+
+    def _pages(self, url, immutable):
+        """
+        Yields the responses of url and all its next pages; raises IOError
+        at the first page that can't be fetched.
+        """
+        while url:
+            res = self.get(url, immutable)
+            if not res:
+                logger.warning("no info from github for {}".format(url))
+                raise IOError(url)
+            yield res
+            url = None
+            if res.links.has_key('next'):
+                url = res.links['next']['url']
+
+    def compare(self, repo, base, head):
+        """
+        Returns all commits in base...head of repo (an api.github.com repo
+        URL ending in '/'), oldest first, or None if GitHub didn't answer.
+        """
+        immutable = _is_sha(base) and _is_sha(head)
+        key = (repo, base, head)
+        if immutable:
+            cmts = self.ranges.get(key)
+            if cmts is not None:
+                return list(cmts)
+
+        url = '{}compare/{}...{}?per_page={}'.format(repo, base, head, _PER_PAGE)
+        cmts = []
+        total = None
+        try:
+            for res in self._pages(url, immutable):
+                j = res.json()
+                total = j.get('total_commits', total)
+                cmts += j['commits']
+        except IOError:
+            return None
+        if total is not None and len(cmts) < total:
+            logger.warning("compare {} returned {} of {} commits".format(url, len(cmts), total))
+
+        if immutable:
+            self.ranges.put(key, cmts)
+        return cmts
+
+    def history(self, repo, head):
+        """
+        Returns the first page of commits leading up to head, the way a repo
+        added to the manifest has always been recorded; its full history
+        would be thousands of commits.
+        """
+        key = (repo, None, head)
+        if _is_sha(head):
+            cmts = self.ranges.get(key)
+            if cmts is not None:
+                return list(cmts)
+        url = '{}commits?sha={}'.format(repo, head)
+        res = self.get(url, immutable=_is_sha(head))
+        if not res:
+            logger.warning("no info from github for {}".format(url))
+            return None
+        cmts = res.json()
+        if _is_sha(head):
+            self.ranges.put(key, cmts)
+        return cmts
+
+    def _fetch_one(self, req):
+        key, repo, base, head = req
+        try:
+            if base is None:
+                return key, self.history(repo, head)
+            return key, self.compare(repo, base, head)
+        except Exception as e:
+            logger.error("fetching {} from github failed: {}".format(req, e))
+            return key, None
+
+    def fetch(self, reqs):
+        """
+        Runs many (key, repo, base, head) requests concurrently; base None
+        asks for history(repo, head), anything else for compare.  Returns a
+        dict of key -> commits (None where GitHub didn't answer).
+        """
+        if not reqs:
+            return {}
+        self.throttle(len(reqs))
+        return dict(self.pool.map(self._fetch_one, reqs))
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from requests.utils import parse_header_links
+
+from lru import LRUCache
+
+
+logger = logging.getLogger()
+
+class CachedResponse(object):
+    """
+    Stands in for a ``requests`` response that was served from the cache.
+    """
+    from_cache = True
+
+    def __init__(self, url, content, headers):
+        self.url = url
+        self.status_code = 200
+        self.content = content
+        self.headers = headers
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    @property
+    def links(self):
+        ret = {}
+        header = self.headers.get('Link')
+        if header:
+            for link in parse_header_links(header):
+                ret[link.get('rel') or link.get('url')] = link
+        return ret
+
+    def __nonzero__(self):
+        return True
+
+class HttpCache(object):
+    """
+    On-disk response cache keyed by URL.
+
+    Every entry is a body file plus a small JSON file with the URL, the
+    validators (ETag / Last-Modified) and whether the entry is immutable.
+    Immutable entries are served without touching the network; the rest
+    are revalidated with If-None-Match / If-Modified-Since.  The cache is
+    bounded by ``max_bytes`` of body and evicts least recently used first.
+    """
+    def __init__(self, path, max_bytes=512*1024*1024):
+        self.path = path
+        self.revalidated = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+        self.index = LRUCache(max_bytes, sizeof=lambda e: e['size'], on_evict=self._evict)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._load()
+
+    def _key(self, url):
+        return hashlib.sha1(url).hexdigest()
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def _load(self):
+        # Oldest first, so what was used last survives eviction on reload
+        metas = [f for f in os.listdir(self.path) if f.endswith('.json')]
+        metas.sort(key=lambda f: os.path.getmtime(os.path.join(self.path, f)))
+        for f in metas:
+            try:
+                with open(os.path.join(self.path, f)) as F:
+                    entry = json.load(F)
+                self.index.put(f[:-len('.json')], entry)
+            except (IOError, ValueError) as e:
+                logger.warning("dropping unreadable cache entry {}: {}".format(f, e))
+                self._evict(f[:-len('.json')], None)
+        self.index.hits = self.index.misses = 0
+
+    def _evict(self, key, entry):
+        for ext in ('.json', '.body'):
+            try:
+                os.remove(self._file(key, ext))
+            except OSError:
+                pass
+
+    def lookup(self, url):
+        """
+        Returns ``(entry, response)`` for a cached url, ``(None, None)`` if
+        there is nothing usable on disk.
+        """
+        key = self._key(url)
+        entry = self.index.get(key)
+        if entry is None:
+            return None, None
+        try:
+            with open(self._file(key, '.body'), 'rb') as F:
+                content = F.read()
+            os.utime(self._file(key, '.json'), None)
+        except (IOError, OSError):
+            self.index.pop(key)
+            return None, None
+        return entry, CachedResponse(url, content, entry['headers'])
+
+    def validators(self, entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, res, immutable=False):
+        etag = res.headers.get('ETag')
+        last_modified = res.headers.get('Last-Modified')
+        if not (immutable or etag or last_modified):
+            # Nothing to revalidate with; caching it would only cost disk
+            return
+        key = self._key(url)
+        entry = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'immutable': immutable,
+            'headers': {'Content-Type': res.headers.get('Content-Type', ''),
+                        'Link': res.headers.get('Link', '')},
+            'size': len(res.content),
+        }
+        with self._lock:
+            for ext, data in (('.body', res.content), ('.json', json.dumps(entry))):
+                tmp = self._file(key, ext + '.tmp')
+                with open(tmp, 'wb') as F:
+                    F.write(data)
+                os.rename(tmp, self._file(key, ext))
+            self.stores += 1
+        self.index.put(key, entry)
+
+    def stats(self):
+        ret = self.index.stats()
+        ret['revalidated'] = self.revalidated
+        ret['stores'] = self.stores
+        return ret
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+import time
+import random
+import logging
+import threading
+import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger()
+
+# Worth another try: throttling and transient server side trouble.
+_RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+class HttpClient(object):
+    """
+    One pooled, keep-alive ``requests.Session`` per host (Jenkins, GitHub, ...)
+    with retries that back off exponentially with full jitter.
+
+    ``get`` returns the response on success and None when the request failed
+    for good: a non-retryable status (404, 401, ...) is returned as None right
+    away, connection errors and retryable statuses are retried up to
+    ``retries`` times first.
+
+    With an ``HttpCache`` attached, responses are looked up by URL first:
+    immutable entries never hit the network and the rest are sent as
+    conditional requests, a 304 being answered from the cache.
+    """
+    def __init__(self, retries=5, backoff=0.5, max_backoff=30, timeout=(3.05, 30),
+                 pool_size=10, host_headers={}, cache=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.host_headers = host_headers
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def session(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            if not self._sessions.has_key(host):
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                s.headers.update(self.host_headers.get(host, {}))
+                self._sessions[host] = s
+            return self._sessions[host]
+
+    def _delay(self, attempt, res=None):
+        if res is not None:
+            # Server told us how long to wait
+            after = res.headers.get('Retry-After')
+            if after and after.isdigit():
+                return min(int(after), self.max_backoff)
+            reset = res.headers.get('X-RateLimit-Reset')
+            if res.headers.get('X-RateLimit-Remaining') == '0' and reset and reset.isdigit():
+                return min(max(int(reset) - time.time(), 0) + 1, self.max_backoff)
+        cap = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return random.uniform(0, cap)
+
+    def _retryable(self, res):
+        if res.status_code in _RETRY_STATUS:
+            return True
+        # GitHub signals an exhausted rate limit with a 403
+        return res.status_code == 403 and res.headers.get('X-RateLimit-Remaining') == '0'
+
+    def get(self, url, params=None, headers=None, timeout=None, immutable=False, stream=False):
+        '''
+        ``immutable`` says whether a successful response may be cached for
+        good; it is either a bool or a callable deciding from the response.
+        ``stream`` returns the response before its body is read, for the
+        caller to consume from ``res.raw`` and close; it bypasses the cache.
+        '''
+        sess = self.session(url)
+        if timeout is None:
+            timeout = self.timeout
+
+        entry = cached = None
+        if self.cache is not None and not stream:
+            full_url = requests.Request('GET', url, params=params).prepare().url
+            entry, cached = self.cache.lookup(full_url)
+            if cached is not None:
+                if entry['immutable']:
+                    return cached
+                headers = dict(headers or {})
+                headers.update(self.cache.validators(entry))
+
+        for attempt in range(self.retries):
+            res = None
+            try:
+                res = sess.get(url, params=params, headers=headers, timeout=timeout, stream=stream)
+            except requests.RequestException as e:
+                logger.error("url unreachable: {} ({})".format(url, e))
+            else:
+                if res.status_code == 304 and cached is not None:
+                    self.cache.revalidated += 1
+                    return cached
+                if res.status_code < 400:
+                    if self.cache is not None and not stream:
+                        frozen = immutable(res) if callable(immutable) else immutable
+                        self.cache.store(full_url, res, frozen)
+                    return res
+                if stream:
+                    res.close()
+                if not self._retryable(res):
+                    logger.warning("{} returned {}; not retrying".format(url, res.status_code))
+                    return None
+                logger.warning("{} returned {}; will retry".format(url, res.status_code))
+
+            if attempt + 1 < self.retries:
+                time.sleep(self._delay(attempt, res))
+
+        logger.error("giving up on {} after {} tries".format(url, self.retries))
+        return None
+
+    def close(self):
+        with self._lock:
+            for s in self._sessions.values():
+                s.close()
+            self._sessions = {}
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+import sys
+import time
+import itertools
+import threading
+import traceback
+import Queue
+from flask import Flask, request
+from flask.json import jsonify
+
+from bbdb import BuildPoller, _job_name
+
+# Webhook events jump ahead of the reconciliation pass' shards
+_EVENT = 0
+_RECONCILE = 1
+
+
+class Ingestor(object):
+    '''
+    Turns Jenkins notification webhooks into exactly one _parse_one_* call
+    for the build that changed, instead of waiting for the next scan.
+
+    Everything runs on a single worker thread that owns the BuildPoller:
+    webhook events are queued (deduplicated while still waiting) and a
+    low-frequency reconciliation pass queues the regular poll shards
+    behind them, to pick up whatever a lost notification missed.
+    '''
+    def __init__(self, poller, reconcile_interval=3600):
+        self.poller = poller
+        self.reconcile_interval = reconcile_interval
+        self.queue = Queue.PriorityQueue()
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.seq = itertools.count()
+        self.jobs = {}
+        self.stats = {'received': 0, 'ignored': 0, 'duplicates': 0, 'processed': 0, 'errors': 0}
+        self._map_jobs()
+
+    def start(self):
+        for target in (self._work, self._reconcile):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def _map_jobs(self):
+        jobs = {}
+        consts = self.poller.constants
+        for rel in self.poller.releases:
+            urls = consts['build_urls'][rel]
+            jobs[_job_name(urls['top_level'])] = ('top', urls['top_level'])
+            jobs[_job_name(urls['unix'])] = ('distro', urls['unix'])
+            jobs[_job_name(urls['windows'])] = ('distro', urls['windows'])
+        for url in consts['unit_test_urls']:
+            jobs[_job_name(url)] = ('unit', url)
+        for url in consts['sanity_test_urls']:
+            jobs[_job_name(url)] = ('sanity', url)
+        self.jobs = jobs
+
+    def submit(self, item, priority=_EVENT):
+        with self.lock:
+            if item in self.queued:
+                self.stats['duplicates'] += 1
+                return False
+            self.queued.add(item)
+        self.queue.put((priority, next(self.seq), item))
+        return True
+
+    def notify(self, payload):
+        '''
+        Queues the build a Jenkins notification is about.  Returns the queued
+        item, or None if the job is not one we poll.
+        '''
+        self.stats['received'] += 1
+        build = payload.get('build', {})
+        job = self.jobs.get(_job_name(payload.get('url') or ''))
+        if job is None:
+            job = self.jobs.get(payload.get('name'))
+        if job is None or not build.has_key('number'):
+            self.stats['ignored'] += 1
+            return None
+        kind, url = job
+        item = (kind, url, str(build['number']))
+        self.poller.logger.debug('ingest: {} {} for {}'.format(payload.get('name'), build.get('phase'), item))
+        self.submit(item)
+        return item
+
+    def _work(self):
+        while True:
+            priority, seq, item = self.queue.get()
+            with self.lock:
+                self.queued.discard(item)
+            try:
+                self._process(item)
+                self.stats['processed'] += 1
+            except Exception, e:
+                self.stats['errors'] += 1
+                self.poller.logger.error("Exception during ingest of {}. But, ignore and go on:".format(item))
+                self.poller.logger.error(traceback.format_exc())
+            if self.queue.empty():
+                self.poller.flush_invalidations()
+
+    def _process(self, item):
+        kind = item[0]
+        if kind == 'refresh':
+            self.poller._read_poll_info_from_db()
+            self._map_jobs()
+        elif kind == 'shard':
+            self.poller.poll_shard(item[1])
+        elif kind == 'top':
+            self.poller._parse_one_top_build(item[1], item[2])
+        elif kind == 'distro':
+            self.poller._parse_one_distro(item[1], item[2], True)
+        elif kind == 'unit':
+            self.poller._parse_one_unit(item[1], item[2])
+        elif kind == 'sanity':
+            self.poller._parse_one_build_sanity(item[1], item[2])
+
+    def _reconcile(self):
+        while True:
+            self.submit(('refresh',), _RECONCILE)
+            for shard in self.poller.shards():
+                self.submit(('shard', shard), _RECONCILE)
+            time.sleep(self.reconcile_interval)
+
+    def status(self):
+        ret = dict(self.stats)
+        ret['queue_depth'] = self.queue.qsize()
+        return ret
+
+
+app = Flask(__name__)
+ingestor = None
+
+@app.route('/jenkins/notify', methods=['POST'])
+def jenkins_notify():
+    payload = request.get_json(force=True, silent=True) or {}
+    item = ingestor.notify(payload)
+    return jsonify({'queued': item is not None}), 202
+
+@app.route('/status', methods=['GET'])
+def status():
+    return jsonify(ingestor.status())
+
+if __name__ == '__main__':
+    reconcile_interval = 3600
+    if len(sys.argv) > 1:
+        reconcile_interval = int(sys.argv[1])
+    poller = BuildPoller(log_file='ingest.log', loop=False)
+    poller.bldDB.ensure_ticket_index()
+    ingestor = Ingestor(poller, reconcile_interval)
+    ingestor.start()
+    app.run(host='0.0.0.0', port=8181, threaded=True)
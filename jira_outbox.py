@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+import time
+import random
+import logging
+import threading
+from jira.exceptions import JIRAError
+
+from lru import LRUCache
+
+
+logger = logging.getLogger()
+
+_MISSING = 'missing'
+
+class JiraOutbox(object):
+    """
+    Drains the jira-outbox docs that commit ingestion queues up (see
+    DB.enqueue_jira_comment) on a background thread.
+
+    Each doc holds every commit of one build that fixes one ticket, so a
+    ticket gets a single comment per build.  Docs are claimed with CAS
+    before sending, so several pollers can drain the same outbox.  Ticket
+    lookups, 404s included, are cached; failed sends are retried with
+    exponential backoff and jitter, up to max_attempts.
+    """
+    def __init__(self, jira, db, batch=50, interval=30, max_attempts=8, backoff=60):
+        self.jira = jira
+        self.db = db
+        self.batch = batch
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.tickets = LRUCache(5000)
+        self.stats = {'sent': 0, 'missing': 0, 'retried': 0, 'failed': 0}
+
+    def start(self):
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error("error draining jira outbox: {}".format(e))
+            time.sleep(self.interval)
+
+    def drain(self):
+        docs = self.db.get_pending_jira_comments(self.batch)
+        for doc in docs:
+            try:
+                if self.db.claim_jira_comment(doc['id']):
+                    self._send(doc)
+            except Exception as e:
+                # left 'sending', it is picked up again once the claim is stale
+                logger.error("error sending jira comment {}: {}".format(doc['id'], e))
+        if docs:
+            logger.debug("jira outbox: {}".format(self.stats))
+        return len(docs)
+
+    def _issue(self, ticket):
+        issue = self.tickets.get(ticket)
+        if issue is None:
+            try:
+                issue = self.jira.issue(ticket)
+            except JIRAError as e:
+                if e.status_code != 404:
+                    raise
+                logger.info("commit references non-existent ticket {}".format(ticket))
+                issue = _MISSING
+            self.tickets.put(ticket, issue)
+        if issue is _MISSING:
+            return None
+        return issue
+
+    def _send(self, doc):
+        cmts = [c for c in doc['commits'] if not c['sha'] in doc['sent']]
+        sent = []
+        try:
+            issue = self._issue(doc['ticket'])
+            if issue is None:
+                self.stats['missing'] += 1
+                self.db.finish_jira_comment(doc['id'], state='missing')
+                return
+            if cmts:
+                self.jira.add_comment(issue, '\n\n'.join(
+                    "Build {} contains {} commit {} with commit message:\n{}\n{}".format(
+                        doc['in_build'], c['repo'], c['sha'], c['title'], c['url'])
+                    for c in cmts))
+                sent = [c['sha'] for c in cmts]
+            self.db.finish_jira_comment(doc['id'], sent=sent)
+            self.stats['sent'] += 1
+        except Exception as e:
+            # JIRA, connection and couchbase errors alike; shas already
+            # commented on are recorded so a retry doesn't post them twice
+            error = str(getattr(e, 'text', None) or e)
+            attempts = doc.get('attempts', 0) + 1
+            if attempts >= self.max_attempts:
+                logger.error("giving up on jira comment {}: {}".format(doc['id'], error))
+                self.stats['failed'] += 1
+                self.db.finish_jira_comment(doc['id'], sent=sent, state='failed', error=error)
+                return
+            delay = random.uniform(0, self.backoff * (2 ** attempts))
+            logger.warning("error commenting on {} (try {}), retrying in {}s: {}".format(
+                doc['ticket'], attempts, int(delay), error))
+            self.stats['retried'] += 1
+            self.db.finish_jira_comment(doc['id'], sent=sent, state='pending',
+                                        next_try=int(time.time() + delay), error=error)
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread safe least-recently-used map bounded by ``maxsize``.
+
+    By default every entry counts as 1 towards ``maxsize``; pass ``sizeof``
+    to bound the cache by some other weight (e.g. bytes).  ``on_evict`` is
+    called with ``(key, value)`` for every entry pushed out.
+    """
+    def __init__(self, maxsize=1024, sizeof=None, on_evict=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof or (lambda v: 1)
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            value = self._data.pop(key)
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self.size -= self.sizeof(self._data.pop(key))
+            self._data[key] = value
+            self.size += self.sizeof(value)
+            while self.size > self.maxsize and len(self._data) > 1:
+                k, v = self._data.popitem(last=False)
+                self.size -= self.sizeof(v)
+                self.evictions += 1
+                if self.on_evict:
+                    self.on_evict(k, v)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data.pop(key)
+            self.size -= self.sizeof(value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'entries': len(self._data), 'size': self.size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
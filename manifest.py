@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+import logging
+import threading
+import xml.etree.ElementTree as ET
+from git.exc import BadName, BadObject
+
+from lru import LRUCache
+
+
+logger = logging.getLogger()
+
+class ManifestEngine(object):
+    """
+    Reads manifests straight out of the object database of a local clone of
+    build-team-manifests, without checking anything out.
+
+    Parsed manifests are kept in an LRU as ``{project: (revision, remote)}``
+    keyed by (commit sha, path), so the previous build's manifest is usually
+    still there when the next build is diffed against it.  The clone is
+    fetched at most once per poll cycle, and only when a revision asked for
+    isn't known locally yet.
+    """
+    def __init__(self, repo, cache_size=64):
+        self.repo = repo
+        self.cache = LRUCache(cache_size)
+        self.fetched = False
+        self._lock = threading.Lock()
+
+    def new_cycle(self):
+        self.fetched = False
+
+    def refresh(self):
+        with self._lock:
+            if not self.fetched:
+                logger.debug('fetching {}'.format(self.repo.working_dir))
+                self.repo.remotes.origin.fetch()
+                self.fetched = True
+
+    def _resolve(self, rev):
+        try:
+            return self.repo.rev_parse(rev)
+        except (BadName, BadObject, ValueError):
+            if self.fetched:
+                raise
+        self.refresh()
+        return self.repo.rev_parse(rev)
+
+    def projects(self, rev, path):
+        commit = self._resolve(rev)
+        key = (commit.hexsha, path)
+        projects = self.cache.get(key)
+        if projects is None:
+            blob = commit.tree / path
+            mxml = ET.fromstring(blob.data_stream.read())
+            projects = {}
+            for p in mxml.findall('project'):
+                n = p.get('name')
+                v = p.get('revision')
+                r = p.get('remote') or 'couchbase'
+                projects[n] = (v, r)
+            self.cache.put(key, projects)
+        return projects
+
+    def diff(self, new_rev, old_rev, path):
+        """
+        Returns ``(new projects, old projects, changed, added, deleted)`` of
+        manifest path between the two revisions, the last three as lists
+        of project names.
+        """
+        p1list = self.projects(new_rev, path)
+        p2list = self.projects(old_rev, path)
+        added = [x for x in p1list if not p2list.has_key(x)]
+        deleted = [x for x in p2list if not p1list.has_key(x)]
+        changed = [x for x in p1list if p2list.has_key(x) and p1list[x][0] != p2list[x][0]]
+        return p1list, p2list, changed, added, deleted
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+
+import time
+import logging
+import threading
+import traceback
+import Queue
+
+
+logger = logging.getLogger()
+
+_END = object()
+
+class Halt(Exception):
+    """
+    Raised by a stage function to stop the pipeline: nothing more is fed
+    and items behind the halting one are dropped.
+    """
+    pass
+
+class Stage(object):
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.processed = 0
+        self.dropped = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.queue = None
+
+    def stats(self):
+        return {
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'per_sec': round(self.processed / self.busy, 2) if self.busy else 0,
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'max_queue_depth': self.max_depth,
+        }
+
+class Pipeline(object):
+    """
+    Runs items through a chain of stages, each on its own thread(s) with a
+    bounded queue in front of it, so one build can be fetched from Jenkins
+    while the one before it is being diffed and the one before that saved.
+
+    A stage function takes an item and returns it (changed as it likes)
+    for the next stage, or None to drop it.  ``done`` is called with every
+    item coming out of the last stage.  Stages with a single worker keep
+    items in order.  Exceptions drop the item they happened on, except
+    ``Halt``, which stops feeding and drops every item behind the halting
+    one; items already past that stage still run to the end.
+    """
+    def __init__(self, name, stages, maxsize=4, done=None):
+        self.name = name
+        self.stages = stages
+        self.maxsize = maxsize
+        self.done = done
+        self.halted = threading.Event()
+        self.halt_stage = -1
+        self.halted_on = None
+        self.results = []
+
+    def halt(self, stage=None):
+        if stage is None:
+            stage = len(self.stages)
+        self.halt_stage = max(self.halt_stage, stage)
+        self.halted.set()
+
+    def _put(self, stage, item):
+        stage.queue.put(item)
+        stage.max_depth = max(stage.max_depth, stage.queue.qsize())
+
+    def _work(self, i, remaining):
+        stage = self.stages[i]
+        nxt = None
+        if i + 1 < len(self.stages):
+            nxt = self.stages[i + 1]
+        while True:
+            item = stage.queue.get()
+            if item is _END:
+                with remaining[i][0]:
+                    remaining[i][1] -= 1
+                    last = remaining[i][1] == 0
+                if last and nxt is not None:
+                    for w in range(nxt.workers):
+                        self._put(nxt, _END)
+                return
+            if self.halted.is_set() and i <= self.halt_stage:
+                stage.dropped += 1
+                continue
+            start = time.time()
+            try:
+                item = stage.func(item)
+            except Halt:
+                self.halted_on = item
+                self.halt(i)
+                item = None
+            except Exception:
+                logger.error("{}/{} failed:".format(self.name, stage.name))
+                logger.error(traceback.format_exc())
+                item = None
+            stage.busy += time.time() - start
+            if item is None:
+                stage.dropped += 1
+                continue
+            stage.processed += 1
+            if nxt is not None:
+                self._put(nxt, item)
+            else:
+                self.results.append(item)
+                if self.done:
+                    try:
+                        self.done(item)
+                    except Exception:
+                        logger.error("{}: done callback failed:".format(self.name))
+                        logger.error(traceback.format_exc())
+
+    def run(self, items):
+        """
+        Feeds items (any iterable, consumed lazily) through the stages and
+        returns the items that made it out of the last one.
+        """
+        threads = []
+        remaining = []
+        for i, stage in enumerate(self.stages):
+            stage.queue = Queue.Queue(self.maxsize)
+            remaining.append([threading.Lock(), stage.workers])
+            for w in range(stage.workers):
+                t = threading.Thread(target=self._work, args=(i, remaining),
+                                     name='{}-{}-{}'.format(self.name, stage.name, w))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+        try:
+            for item in items:
+                if self.halted.is_set():
+                    break
+                self._put(self.stages[0], item)
+        finally:
+            for w in range(self.stages[0].workers):
+                self._put(self.stages[0], _END)
+            for t in threads:
+                t.join()
+            if hasattr(items, 'close'):
+                items.close()
+
+        logger.debug("pipeline {}: {}".format(self.name, self.stats()))
+        return self.results
+
+    def stats(self):
+        return dict((stage.name, stage.stats()) for stage in self.stages)
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import signal
+import logging
+import traceback
+import multiprocessing
+import Queue
+from logging.handlers import TimedRotatingFileHandler
+
+from db import DB
+from bbdb import BuildPoller, shards_from_constants, _BLDHISTORY_BUCKET
+
+# Seconds between two polls of the same shard, per kind of shard. Can be
+# overridden with a 'poll_intervals' dict in the constants doc.
+_DEFAULT_SCHEDULES = {
+    'build': 300,
+    'unit': 300,
+    'sanity': 300,
+}
+_TICK = 5
+_REPORT_INTERVAL = 60
+_HEALTH_DOC = 'poller-health'
+
+
+def _shard_name(shard):
+    return '{}:{}'.format(*shard)
+
+def _run_worker(wid, shards, schedules, stop, health, log_file, log_level):
+    '''
+    Body of a worker process: polls each of its shards whenever it is due
+    and reports every step on the health queue, until stop is set.
+    '''
+    # the supervisor decides when we stop; SIGTERM is its hard kill
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    poller = BuildPoller(log_file=log_file, log_level=log_level, loop=False)
+    due = dict((s, 0) for s in shards)
+    while not stop.is_set():
+        ready = [s for s in shards if due[s] <= time.time()]
+        if ready:
+            poller._read_poll_info_from_db()
+        for shard in ready:
+            if stop.is_set():
+                break
+            health.put((wid, _shard_name(shard), 'polling', 0, time.time()))
+            start = time.time()
+            status = 'ok'
+            try:
+                poller.poll_shard(shard)
+            except Exception, e:
+                poller.logger.error("Exception during polling {}. But, ignore and repeat:".format(shard))
+                poller.logger.error(traceback.format_exc())
+                status = 'error: {}'.format(e)
+            due[shard] = start + schedules.get(shard[0], 300)
+            health.put((wid, _shard_name(shard), status, time.time() - start, time.time()))
+        health.put((wid, None, 'idle', 0, time.time()))
+        stop.wait(_TICK)
+
+class Supervisor(object):
+    '''
+    Runs the poller as a pool of worker processes, the shards of a poll
+    cycle (see shards_from_constants) dealt round robin across them.
+
+    Workers that die, or are stuck on a shard for longer than
+    stall_timeout, are restarted with the same shards.  SIGHUP re-reads the
+    constants doc and restarts all workers gracefully with a fresh plan;
+    SIGTERM/SIGINT let the workers finish their current shard and exit.
+    Worker health is logged and saved as the poller-health doc.
+    '''
+    def __init__(self, workers=None, log_file='build_poller.log', log_level='DEBUG',
+                 releases=[], stall_timeout=3600, grace=600):
+        self.logger = self._init_logger('supervisor.log', log_level)
+        self.bldDB = DB(_BLDHISTORY_BUCKET)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.log_file = log_file
+        self.log_level = log_level
+        self.releases = releases
+        self.stall_timeout = stall_timeout
+        self.grace = grace
+
+        self.health = multiprocessing.Queue()
+        self.stop = multiprocessing.Event()
+        self.schedules = {}
+        self.procs = {}
+        self.status = {}
+        self.running = True
+        self.replan = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_replan)
+
+        # once, here, rather than in every worker
+        self.bldDB.ensure_ticket_index()
+        self._launch()
+        last_report = 0
+        while self.running:
+            self._drain_health()
+            self._check_workers()
+            if self.replan:
+                self.logger.info('re-reading constants and restarting workers')
+                self._stop_all()
+                self._launch()
+                self.replan = False
+            if time.time() - last_report > _REPORT_INTERVAL:
+                self._report()
+                last_report = time.time()
+
+        self.logger.info('stopping workers')
+        self._stop_all()
+        self._report()
+
+    def _on_stop(self, signum, frame):
+        self.running = False
+
+    def _on_replan(self, signum, frame):
+        self.replan = True
+
+    def _plan(self):
+        consts = self.bldDB.doc_exists('constants').value
+        shards = shards_from_constants(consts, self.releases)
+        schedules = dict(_DEFAULT_SCHEDULES)
+        schedules.update(consts.get('poll_intervals', {}))
+        n = max(1, min(self.workers, len(shards)))
+        return [shards[i::n] for i in range(n)], schedules
+
+    def _launch(self):
+        plan, self.schedules = self._plan()
+        self.procs = {}
+        self.status = {}
+        for wid, shards in enumerate(plan):
+            self._start(wid, shards)
+
+    def _start(self, wid, shards):
+        root, ext = os.path.splitext(self.log_file)
+        log_file = '{}.{}{}'.format(root, wid, ext)
+        p = multiprocessing.Process(target=_run_worker, name='poller-{}'.format(wid),
+                                    args=(wid, shards, self.schedules, self.stop, self.health,
+                                          log_file, self.log_level))
+        p.daemon = True
+        p.start()
+        restarts = -1
+        if self.status.has_key(wid):
+            restarts = self.status[wid]['restarts']
+        self.procs[wid] = (p, shards)
+        self.status[wid] = {
+            'pid': p.pid,
+            'shards': [_shard_name(s) for s in shards],
+            'started': time.time(),
+            'last_seen': time.time(),
+            'state': 'starting',
+            'shard': None,
+            'restarts': restarts + 1,
+            'last_durations': {},
+            'errors': 0,
+        }
+        self.logger.info('started worker {} (pid {}) for {}'.format(wid, p.pid, self.status[wid]['shards']))
+
+    def _drain_health(self):
+        timeout = _TICK
+        while True:
+            try:
+                wid, shard, state, duration, when = self.health.get(timeout=timeout)
+            except Queue.Empty:
+                return
+            except (IOError, OSError):
+                # interrupted by one of our signals
+                return
+            timeout = 0.01
+            st = self.status.get(wid)
+            if st is None:
+                continue
+            st['last_seen'] = when
+            st['state'] = state
+            st['shard'] = shard
+            if shard and state != 'polling':
+                st['last_durations'][shard] = round(duration, 1)
+                if state != 'ok':
+                    st['errors'] += 1
+                    self.logger.warning('worker {}: {} failed: {}'.format(wid, shard, state))
+
+    def _check_workers(self):
+        for wid, (p, shards) in self.procs.items():
+            st = self.status[wid]
+            if not p.is_alive():
+                self.logger.error('worker {} (pid {}) died with exit code {}; restarting'.format(wid, p.pid, p.exitcode))
+                self._start(wid, shards)
+            elif st['state'] == 'polling' and time.time() - st['last_seen'] > self.stall_timeout:
+                self.logger.error('worker {} stuck on {} for {}s; restarting'.format(wid, st['shard'], int(time.time() - st['last_seen'])))
+                p.terminate()
+                p.join()
+                self._start(wid, shards)
+
+    def _stop_all(self):
+        self.stop.set()
+        deadline = time.time() + self.grace
+        for wid, (p, shards) in self.procs.items():
+            p.join(max(0, deadline - time.time()))
+            if p.is_alive():
+                self.logger.warning('worker {} did not stop in time; terminating'.format(wid))
+                p.terminate()
+                p.join()
+        self._drain_health()
+        # workers of the next generation get a fresh event
+        self.stop = multiprocessing.Event()
+
+    def _report(self):
+        for wid in sorted(self.status.keys()):
+            st = self.status[wid]
+            self.logger.info('worker {}: {} {} (last seen {}s ago, restarts {}, errors {})'.format(
+                wid, st['state'], st['shard'] or '', int(time.time() - st['last_seen']),
+                st['restarts'], st['errors']))
+        health = {
+            'type': 'poller_health',
+            'updated': int(time.time()),
+            'workers': dict((str(wid), st) for wid, st in self.status.items()),
+        }
+        self.bldDB.save_doc(_HEALTH_DOC, health)
+
+    def _init_logger(self, log_file, log_level):
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        logger = logging.getLogger('supervisor')
+        logger.setLevel(getattr(logging, log_level.upper(), logging.ERROR))
+        handler = TimedRotatingFileHandler(log_file,
+                                       when="d",
+                                       interval=1,
+                                       backupCount=7)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+        logger.propagate = False
+        return logger
+
+
+if __name__ == "__main__":
+    workers = None
+    if len(sys.argv) > 1:
+        workers = int(sys.argv[1])
+    Supervisor(workers=workers).run()
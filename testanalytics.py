@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+import logging
+
+
+logger = logging.getLogger()
+
+_PASS = 'P'
+_FAIL = 'F'
+_SKIP = 'S'
+_STATES = {
+    'PASSED': _PASS,
+    'FIXED': _PASS,
+    'FAILED': _FAIL,
+    'REGRESSION': _FAIL,
+    'SKIPPED': _SKIP,
+}
+
+# cases per teststats shard doc, by name id: with the window of results
+# each case keeps, a shard stays well under a MB
+_SHARD_CASES = 1000
+# cases a TestRun holds before folding them into the shard docs, so memory
+# is bounded by this rather than by the size of the run
+_FLUSH_CASES = 2000
+
+def stats_id(version, distro, edition, kind):
+    return 'teststats-{}-{}-{}-{}'.format(version, distro, edition, kind)
+
+def shard_id(docId, shard):
+    return '{}::{}'.format(docId, shard)
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+def _streak(recent):
+    # [state, length, first build] of the latest run of passes or fails
+    streak = None
+    for build, state, ms in reversed(recent):
+        if state == _SKIP:
+            continue
+        if streak is None:
+            streak = [state, 0, build]
+        elif state != streak[0]:
+            break
+        streak[1] += 1
+        streak[2] = build
+    return streak
+
+class TestRun(object):
+    """
+    Collects the cases of one test run while they stream into the DB
+    (see ``tap``), folding them into the shard docs every _FLUSH_CASES,
+    and adds the build to the stats doc once the run is saved.  A run that
+    isn't saved may have had some of its cases counted; as a build is only
+    ever counted once, the retry that saves it sets them right.
+    """
+    def __init__(self, analytics, version, distro, edition, kind, build):
+        self.analytics = analytics
+        self.version = version
+        self.distro = distro
+        self.edition = edition
+        self.kind = kind
+        self.build = int(build)
+        self.cases = []
+        self.shards = set()
+        self.ok = True
+
+    def tap(self, suites):
+        for s in suites or []:
+            for c in s['cases']:
+                self.cases.append(((s['suite'], c['name'], c['params']),
+                                   _STATES.get(c['status'], _SKIP),
+                                   int(round((c['duration'] or 0) * 1000)),
+                                   c['failed_since']))
+            if len(self.cases) >= _FLUSH_CASES:
+                self.flush()
+            yield s
+        self.flush()
+
+    def flush(self):
+        self.analytics.record_cases(self)
+
+    def save(self):
+        return self.analytics.record(self)
+
+class TestAnalytics(object):
+    """
+    Keeps running per test case stats for every (version, distro, edition,
+    kind) of test run, kind being 'unit' or 'sanity-<cluster type>'.  The
+    teststats-... doc lists the builds seen and the shards; the cases are
+    in teststats-...::<n> shard docs of _SHARD_CASES each, keyed by the
+    case's id in the name dictionary, so no doc grows with the number of
+    cases and parallel runs mostly update different docs.
+
+    Each case has its last ``window`` results ([build, P/F/S, ms]) and, kept
+    up to date from them as runs come in: the current pass/fail streak,
+    flip rate, duration percentiles, the product build the current failure
+    started in and Jenkins' failedSince.  Runs may come in any order and
+    more than once; a build is only ever counted once.
+    """
+    def __init__(self, db, window=20):
+        self.db = db
+        self.window = window
+
+    def run(self, version, distro, edition, kind, build):
+        return TestRun(self, version, distro, edition, kind, build)
+
+    def record_cases(self, run):
+        '''
+        Folds the cases run holds into its shard docs and lets go of them.
+        '''
+        if not run.cases:
+            return
+        ids = self.db.intern_tests(run.version, [c[0] for c in run.cases])
+        docId = stats_id(run.version, run.distro, run.edition, run.kind)
+
+        shards = {}
+        for cid, case in zip(ids, run.cases):
+            shards.setdefault(cid / _SHARD_CASES, []).append((cid, case))
+        run.cases = []
+
+        for shard, cases in sorted(shards.items()):
+            def mutate(doc, cases=cases):
+                for cid, (key, state, ms, failed_since) in cases:
+                    case = doc['cases'].setdefault(str(cid), {'recent': [], 'runs': 0, 'failures': 0})
+                    self._update(case, run.build, state, ms, failed_since)
+                return True
+
+            initial = {'type': 'test_stats_shard', 'stats': docId, 'shard': shard, 'cases': {}}
+            mutate(initial)
+            if not self.db.update_test_stats(shard_id(docId, shard), mutate, initial):
+                run.ok = False
+            run.shards.add(shard)
+
+    def record(self, run):
+        self.record_cases(run)
+        if not run.shards:
+            return run.ok
+        docId = stats_id(run.version, run.distro, run.edition, run.kind)
+        ok = run.ok
+
+        def mutate(doc):
+            changed = False
+            # docs from before sharding have their cases inline, and no shards
+            doc.setdefault('shards', [])
+            for shard in run.shards:
+                if not shard in doc['shards']:
+                    doc['shards'] = sorted(doc['shards'] + [shard])
+                    changed = True
+            if not run.build in doc['builds']:
+                doc['builds'] = sorted(doc['builds'] + [run.build])[-self.window:]
+                changed = True
+            return changed
+
+        initial = {
+            'type': 'test_stats',
+            'version': run.version,
+            'distro': run.distro,
+            'edition': run.edition,
+            'kind': run.kind,
+            'names': 'testnames-' + run.version,
+            'window': self.window,
+            'builds': [],
+            'shards': [],
+        }
+        mutate(initial)
+        if not self.db.update_test_stats(docId, mutate, initial):
+            ok = False
+        if not ok:
+            logger.warning("couldn't update test stats {0} with build {1}".format(docId, run.build))
+        return ok
+
+    def _update(self, case, build, state, ms, failed_since):
+        recent = case['recent']
+        old = [r for r in recent if r[0] == build]
+        if old:
+            recent.remove(old[0])
+            if old[0][1] == _FAIL:
+                case['failures'] -= 1
+        else:
+            case['runs'] += 1
+        if state == _FAIL:
+            case['failures'] += 1
+
+        latest = not recent or build > recent[-1][0]
+        recent.append([build, state, ms])
+        if not latest:
+            recent.sort()
+        del recent[:-self.window]
+
+        streak = case.get('streak')
+        if latest and not old and streak and state in (_SKIP, streak[0]):
+            if state == streak[0]:
+                streak[1] += 1
+        else:
+            # out of order or re-ingested: start over from the window
+            streak = _streak(recent)
+        case['streak'] = streak
+
+        states = [r[1] for r in recent if r[1] != _SKIP]
+        flips = len([i for i in range(1, len(states)) if states[i] != states[i - 1]])
+        case['flip_rate'] = 0.0
+        if len(states) > 1:
+            case['flip_rate'] = round(float(flips) / (len(states) - 1), 3)
+
+        durations = [r[2] for r in recent if r[1] != _SKIP]
+        case['p50'] = _percentile(durations, 50)
+        case['p90'] = _percentile(durations, 90)
+        case['p99'] = _percentile(durations, 99)
+
+        case['first_failing'] = None
+        if streak and streak[0] == _FAIL:
+            case['first_failing'] = streak[2]
+        if state == _FAIL and latest:
+            case['failed_since'] = failed_since
+        elif state == _PASS and latest:
+            case['failed_since'] = 0
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import sys
+import zlib
+import array
+import base64
+
+
+# array typecodes of the per-case columns of a test chunk
+ID = 'i'
+STATUS = 'b'
+MILLIS = 'i'
+BUILD = 'i'
+
+def pack(values, typecode, compress=False):
+    """
+    Packs a list of numbers into a JSON-able column: the plain list, which
+    N1QL can read, or with compress an array of typecode, zlib compressed
+    and base64 encoded.
+    """
+    if not compress:
+        return {'t': typecode, 'v': list(values)}
+    a = array.array(typecode, values)
+    return {'t': typecode, 'z': 1, 'o': sys.byteorder,
+            'v': base64.b64encode(zlib.compress(a.tostring()))}
+
+def unpack(col):
+    if not col.get('z'):
+        return col['v']
+    a = array.array(str(col['t']))
+    a.fromstring(zlib.decompress(base64.b64decode(col['v'])))
+    if col['o'] != sys.byteorder:
+        a.byteswap()
+    return a.tolist()
+
+def encode(suites, intern, compress=True):
+    """
+    Turns suites of cases ({suite, duration, cases: [{name, params, duration,
+    status, failed_since}]}) into columns.  intern maps a list of
+    (suite, name, params) to ids in the run's name dictionary.
+
+    compress only applies to the id and failed_since columns; status and
+    duration are always kept as plain lists so N1QL can scan them (status
+    codes index into the chunk's 'statuses').
+    """
+    heads = []
+    keys = []
+    statuses = []
+    codes = []
+    millis = []
+    since = []
+    for s in suites:
+        heads.append([s['suite'], s.get('duration'), len(s['cases']), s.get('continued', False)])
+        for c in s['cases']:
+            keys.append((s['suite'], c['name'], c['params']))
+            if not c['status'] in statuses:
+                statuses.append(c['status'])
+            codes.append(statuses.index(c['status']))
+            millis.append(int(round((c['duration'] or 0) * 1000)))
+            since.append(c['failed_since'] or 0)
+    return {
+        'suites': heads,
+        'statuses': statuses,
+        'cases': {
+            'id': pack(intern(keys), ID, compress),
+            'status': pack(codes, STATUS),
+            'duration': pack(millis, MILLIS),
+            'failed_since': pack(since, BUILD, compress),
+        },
+    }
+
+def decode(chunk, names):
+    """
+    Rebuilds the suites of a chunk written by encode; names is the name
+    dictionary, a list of [suite, name, params] indexed by id.
+    """
+    ids = unpack(chunk['cases']['id'])
+    codes = unpack(chunk['cases']['status'])
+    millis = unpack(chunk['cases']['duration'])
+    since = unpack(chunk['cases']['failed_since'])
+    suites = []
+    i = 0
+    for name, duration, count, continued in chunk['suites']:
+        cases = []
+        for n in range(i, i + count):
+            cases.append({
+                'name': names[ids[n]][1],
+                'params': names[ids[n]][2],
+                'duration': millis[n] / 1000.0,
+                'status': chunk['statuses'][codes[n]],
+                'failed_since': since[n],
+            })
+        i += count
+        suite = {'suite': name, 'duration': duration, 'cases': cases}
+        if continued:
+            suite['continued'] = True
+        suites.append(suite)
+    return suites
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+
+import logging
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+logger = logging.getLogger()
+
+class ReportError(Exception):
+    """
+    A test report that couldn't be read to the end: the connection broke
+    off or the body didn't parse.
+    """
+    pass
+
+# Jenkins tree= projection of a testReport: only what _parse_tests keeps
+TREE = 'suites[name,duration,cases[name,duration,status,failedSince]]'
+
+def _plain(v):
+    # ijson hands numbers with a fraction back as Decimal
+    if isinstance(v, dict):
+        return dict((k, _plain(x)) for k, x in v.iteritems())
+    if isinstance(v, list):
+        return [_plain(x) for x in v]
+    if v.__class__.__name__ == 'Decimal':
+        return float(v)
+    return v
+
+def iter_suites(res):
+    """
+    Yields the suites of a testReport/api/json response one at a time.
+
+    With ijson installed the body is parsed incrementally off the socket
+    (the request has to be made with stream=True), so only one suite is
+    ever held in memory; without it the whole response is loaded with
+    res.json() as before.
+    """
+    if ijson is None:
+        for s in res.json().get('suites', []):
+            yield s
+        return
+    res.raw.decode_content = True
+    for s in ijson.items(res.raw, 'suites.item'):
+        yield _plain(s)
@@ -0,0 +1,71 @@
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ingest import Ingestor
+
+
+class FakePoller(object):
+    releases = ['watson']
+    logger = logging.getLogger()
+    constants = {
+        'build_urls': {'watson': {
+            'top_level': 'http://server.jenkins.couchbase.com/job/watson-build/',
+            'unix': 'http://server.jenkins.couchbase.com/job/watson-unix/',
+            'windows': 'http://server.jenkins.couchbase.com/job/watson-windows/',
+        }},
+        'unit_test_urls': ['http://cv.jenkins.couchbase.com/job/watson-unix-simple-test/'],
+        'sanity_test_urls': ['http://server.jenkins.couchbase.com/job/build_sanity_matrix/'],
+    }
+
+
+# what the Jenkins Notification plugin POSTs: the job url is relative
+PLUGIN_PAYLOAD = {
+    'name': 'watson-build',
+    'url': 'job/watson-build/',
+    'build': {
+        'full_url': 'http://server.jenkins.couchbase.com/job/watson-build/1234/',
+        'number': 1234,
+        'phase': 'COMPLETED',
+        'status': 'SUCCESS',
+        'url': 'job/watson-build/1234/',
+    },
+}
+
+
+class IngestorNotifyTest(unittest.TestCase):
+    def setUp(self):
+        self.ingestor = Ingestor(FakePoller())
+
+    def test_plugin_payload_is_queued(self):
+        item = self.ingestor.notify(PLUGIN_PAYLOAD)
+        self.assertEqual(item, ('top', FakePoller.constants['build_urls']['watson']['top_level'], '1234'))
+        self.assertEqual(self.ingestor.stats['ignored'], 0)
+        self.assertEqual(self.ingestor.queue.qsize(), 1)
+
+    def test_absolute_url_is_queued(self):
+        payload = dict(PLUGIN_PAYLOAD, url='http://cv.jenkins.couchbase.com/job/watson-unix-simple-test/')
+        item = self.ingestor.notify(payload)
+        self.assertEqual(item[0], 'unit')
+
+    def test_name_only(self):
+        payload = dict(PLUGIN_PAYLOAD, url=None, name='build_sanity_matrix')
+        self.assertEqual(self.ingestor.notify(payload)[0], 'sanity')
+
+    def test_unknown_job_is_ignored(self):
+        payload = dict(PLUGIN_PAYLOAD, url='job/something-else/', name='something-else')
+        self.assertIsNone(self.ingestor.notify(payload))
+        self.assertEqual(self.ingestor.stats['ignored'], 1)
+
+    def test_duplicate_is_queued_once(self):
+        self.ingestor.notify(PLUGIN_PAYLOAD)
+        self.ingestor.notify(PLUGIN_PAYLOAD)
+        self.assertEqual(self.ingestor.queue.qsize(), 1)
+        self.assertEqual(self.ingestor.stats['duplicates'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()